@@ -0,0 +1,111 @@
+from __future__ import division
+from __future__ import absolute_import
+import numpy as np
+from scitbx.array_family import flex
+
+def _unit(v):
+  return v/np.sqrt((v*v).sum(axis=-1))[...,np.newaxis]
+
+def _frame(p, r1, r2):
+  e1 = _unit(r1-p)
+  w = r2-p
+  e2 = _unit(w-(w*e1).sum(axis=-1)[...,np.newaxis]*e1)
+  e3 = np.cross(e1, e2)
+  return e1, e2, e3
+
+class capping_template(object):
+  """
+  Cap atoms that completion.run(model_completion=False) appends to a fragment,
+  recorded once so that at each step they are placed geometrically instead of
+  re-running completion. A cap on a cut bond is a link atom: it sits at a
+  fixed distance from its parent atom along the bond to the atom outside the
+  fragment. Any other added atom rides on its parent in the frame of two
+  bonded fragment atoms. valid is False if the capped hierarchy does not start
+  with the fragment atoms or a cap cannot be described this way.
+  """
+
+  def __init__(self, capped_hierarchy, fragment_indices, super_sites_cart,
+               bond_distance=2.0, min_cosine=0.8, tolerance=0.01):
+    self.valid = False
+    self.fragment = np.array(list(fragment_indices), dtype=np.int64)
+    xyz = super_sites_cart.as_numpy_array()
+    capped = capped_hierarchy.atoms().extract_xyz().as_numpy_array()
+    n = self.fragment.size
+    fragment_xyz = xyz[self.fragment]
+    if(capped.shape[0] < n or
+       not np.allclose(capped[:n], fragment_xyz, atol=tolerance)):
+      return
+    caps = capped[n:]
+    self.n_caps = caps.shape[0]
+    outside = np.ones(xyz.shape[0], dtype=bool)
+    outside[self.fragment] = False
+    link, ride = [], []
+    for k in range(self.n_caps):
+      d = np.sqrt(((fragment_xyz-caps[k])**2).sum(axis=1))
+      p = int(np.argmin(d))
+      v = caps[k]-fragment_xyz[p]
+      # link atom: along the bond to an atom outside the fragment
+      d_super = np.sqrt(((xyz-fragment_xyz[p])**2).sum(axis=1))
+      partners = np.flatnonzero(outside & (d_super < bond_distance) &
+                                (d_super > 0))
+      if(partners.size > 0):
+        cosines = (_unit(xyz[partners]-fragment_xyz[p])*_unit(v)).sum(axis=1)
+        best = int(np.argmax(cosines))
+        if(cosines[best] >= min_cosine):
+          link.append((k, p, partners[best], d[p]))
+          continue
+      # riding atom: frame of two bonded fragment atoms
+      d_fragment = np.sqrt(((fragment_xyz-fragment_xyz[p])**2).sum(axis=1))
+      bonded = [j for j in np.argsort(d_fragment)
+                if j != p and d_fragment[j] < bond_distance]
+      if(len(bonded) == 0): return
+      r1 = bonded[0]
+      if(len(bonded) > 1): r2 = bonded[1]
+      else:
+        d_r1 = np.sqrt(((fragment_xyz-fragment_xyz[r1])**2).sum(axis=1))
+        r2 = [j for j in np.argsort(d_r1)
+              if j not in (p, r1) and d_r1[j] < bond_distance]
+        if(len(r2) == 0): return
+        r2 = r2[0]
+      e1, e2, e3 = _frame(fragment_xyz[p], fragment_xyz[r1], fragment_xyz[r2])
+      ride.append((k, p, r1, r2, [v.dot(e1), v.dot(e2), v.dot(e3)]))
+    self.link_cap = np.array([l[0] for l in link], dtype=np.int64)
+    self.link_parent = np.array([l[1] for l in link], dtype=np.int64)
+    self.link_partner = np.array([l[2] for l in link], dtype=np.int64)
+    self.link_length = np.array([l[3] for l in link], dtype=np.float64)
+    self.ride_cap = np.array([r[0] for r in ride], dtype=np.int64)
+    self.ride_parent = np.array([r[1] for r in ride], dtype=np.int64)
+    self.ride_r1 = np.array([r[2] for r in ride], dtype=np.int64)
+    self.ride_r2 = np.array([r[3] for r in ride], dtype=np.int64)
+    self.ride_local = np.array([r[4] for r in ride], dtype=np.float64)
+    self.valid = True
+
+  def sites_cart(self, super_sites_cart):
+    """
+    Coordinates of the capped fragment (fragment atoms, then caps) for the
+    given super-sphere coordinates.
+    """
+    assert self.valid
+    xyz = super_sites_cart.as_numpy_array()
+    fragment_xyz = xyz[self.fragment]
+    caps = np.zeros((self.n_caps, 3))
+    if(self.link_cap.size > 0):
+      p = fragment_xyz[self.link_parent]
+      u = _unit(xyz[self.link_partner]-p)
+      caps[self.link_cap] = p+u*self.link_length[:,np.newaxis]
+    if(self.ride_cap.size > 0):
+      p = fragment_xyz[self.ride_parent]
+      e1, e2, e3 = _frame(p, fragment_xyz[self.ride_r1],
+        fragment_xyz[self.ride_r2])
+      local = self.ride_local
+      caps[self.ride_cap] = p+local[:,0:1]*e1+local[:,1:2]*e2+local[:,2:3]*e3
+    result = np.concatenate([fragment_xyz, caps])
+    return flex.vec3_double(flex.double(result.ravel().tolist()))
+
+  def capped_hierarchy(self, capped_initial, super_sites_cart):
+    """
+    Copy of the initial capped hierarchy moved to the given coordinates.
+    """
+    result = capped_initial.deep_copy()
+    result.atoms().set_xyz(self.sites_cart(super_sites_cart))
+    return result
@@ -3,13 +3,19 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import os
+import time
+import atexit
+import hashlib
+import collections
+import multiprocessing
 from libtbx import Auto
 from libtbx.utils import Sorry
 from libtbx import adopt_init_args
-from libtbx.easy_mp import parallel_map
+from libtbx.easy_mp import parallel_map, get_processes
 from scitbx.array_family import flex
 from .fragment import write_cluster_and_fragments_pdbs
 from .restraints import from_qm
+from .plugin.ase import async_qr
 from libtbx import group_args
 
 def check_no_altlocs(h, file_name):
@@ -26,9 +32,429 @@ def check_no_altlocs(h, file_name):
     if(len(a)==0): cntr+=1
   assert cntr==1, [file_name, altlocs]
 
+_worker_restraints_manager = None
+
+def _init_worker(restraints_manager):
+  global _worker_restraints_manager
+  _worker_restraints_manager = restraints_manager
+
+class fragment_task(object):
+  """
+  Evaluate one fragment; returns the fragment index, the energy and
+  gradients, the time it took, the process that did it and the traceback if
+  it failed.
+  """
+
+  def __init__(self, restraints_manager):
+    self.restraints_manager = restraints_manager
+
+  def __call__(self, selection_and_sites_cart):
+    t0 = time.time()
+    cwd = os.getcwd()
+    result, error = None, None
+    try:
+      result = self.restraints_manager(selection_and_sites_cart)
+    except Exception:
+      import traceback
+      error = traceback.format_exc()
+      os.chdir(cwd)
+    return (selection_and_sites_cart[2], result, time.time()-t0, os.getpid(),
+      error)
+
+def _evaluate_fragment(index_and_sites_cart):
+  index, sites_cart = index_and_sites_cart
+  fragment_extracts = _worker_restraints_manager.fragment_extracts
+  fragment_extracts.pdb_hierarchy_super.atoms().set_xyz(sites_cart)
+  return fragment_task(_worker_restraints_manager)(
+    [fragment_extracts.fragment_selections[index], sites_cart, index])
+
+# QM cost grows about linearly with fragment size for these, cubically else
+linear_cost_engines = ["mopac", "mopac-api", "xtb", "torchani", "aimnet2",
+                       "aimnet2-old", "server"]
+
+class fragment_scheduler(object):
+  """
+  Orders fragments longest-first for dynamic dispatch. The cost of a fragment
+  is its measured time from earlier steps or, until measured, an estimate from
+  its atom count (cubic for HF/DFT, linear for semi-empirical and ML engines
+  and cctbx) scaled by the mean ratio of measured to estimated cost. Only the
+  persistent worker pool dispatches dynamically (parallel.persistent_pool);
+  the other parallel methods get the fragments in this order.
+  """
+
+  def __init__(self, engine_name=None):
+    self.exponent = 1
+    if(engine_name is not None and engine_name not in linear_cost_engines):
+      self.exponent = 3
+    self.plan = None
+    self.sizes = []
+    self.measured = {}
+
+  def reset(self, plan, sizes):
+    if(plan is self.plan): return
+    self.plan = plan
+    self.sizes = sizes
+    self.measured = {}
+
+  def estimate(self, index):
+    return float(self.sizes[index])**self.exponent
+
+  def costs(self):
+    scale = 1.
+    if(len(self.measured)>0):
+      scale = sum([t/self.estimate(i) for i, t in self.measured.items()])/ \
+        len(self.measured)
+    return [self.measured.get(i, scale*self.estimate(i))
+      for i in range(len(self.sizes))]
+
+  def order(self):
+    costs = self.costs()
+    return sorted(range(len(costs)), key=lambda i: costs[i], reverse=True)
+
+  def update(self, timings, wall_time, log=None):
+    """
+    Record (index, time, worker) of each fragment and report load balance.
+    """
+    busy = {}
+    for index, elapsed, worker in timings:
+      self.measured[index] = elapsed
+      busy[worker] = busy.get(worker, 0) + elapsed
+    if(len(busy)==0): return
+    busy_max = max(busy.values())
+    busy_mean = sum(busy.values())/len(busy)
+    print("fragment scheduling: %d fragments, %d workers, load balance %.2f"
+      " (busy max %.2fs, mean %.2fs, wall %.2fs)"%(len(timings), len(busy),
+      busy_mean/max(busy_max, 1.e-9), busy_max, busy_mean, wall_time),
+      file=log)
+
+class fragment_cache(object):
+  """
+  Bounded LRU cache of fragment energies and gradients. The key covers the
+  restraints manager and its settings, the fragment charge, its atoms,
+  elements and gradient scales, and its coordinates (and those of the atoms
+  its link caps point at) rounded to tolerance; a fragment seen again at the
+  same coordinates is not recomputed.
+  """
+
+  def __init__(self, size=1000, tolerance=1.e-5):
+    self.size = size
+    self.tolerance = tolerance
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, restraints_manager, fragment_extracts, sites_cart, index):
+    plan = fragment_extracts.fragment_plan
+    atoms = plan.fragment(index)
+    capping = fragment_extracts.fragment_capping[index]
+    if(capping is not None):
+      atoms = atoms.concatenate(flex.size_t(capping.link_partner.tolist()))
+    elements = fragment_extracts.pdb_hierarchy_super.atoms().extract_element()
+    xyz = sites_cart.select(atoms).as_double()/self.tolerance
+    h = hashlib.sha1()
+    h.update(repr((type(restraints_manager).__name__,
+      [getattr(restraints_manager, name, None) for name in
+        ["qm_engine_name", "method", "basis", "qm_addon", "qm_addon_method"]],
+      fragment_extracts.fragment_charges[index])).encode())
+    h.update("".join(elements.select(plan.fragment(index))).encode())
+    h.update(atoms.as_numpy_array().tobytes())
+    h.update(plan.cluster(index).as_numpy_array().tobytes())
+    h.update(plan.scales(index).as_numpy_array().tobytes())
+    h.update(xyz.as_numpy_array().round().astype("int64").tobytes())
+    return h.hexdigest()
+
+  def get(self, key):
+    result = self.entries.get(key)
+    if(result is None):
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.entries.move_to_end(key)
+    return result
+
+  def put(self, key, result):
+    self.entries[key] = result
+    self.entries.move_to_end(key)
+    while(len(self.entries) > self.size):
+      self.entries.popitem(last=False)
+
+  def show(self, hits, misses, log=None):
+    print("fragment cache: %d hits, %d misses (total %d hits, %d misses,"
+      " %d of %d entries)"%(hits, misses, self.hits, self.misses,
+      len(self.entries), self.size), file=log)
+
+class stale_gradients(object):
+  """
+  Multiple-time-step fragment restraints: the last energy and gradients of a
+  fragment are reused while none of its atoms moved more than
+  shift_tolerance since it was computed, for at most max_steps steps in a
+  row. The error of reused gradients is estimated from how much the
+  fragment's gradients changed per Angstrom of shift when it was last
+  recomputed.
+  """
+
+  def __init__(self, shift_tolerance, max_steps=5):
+    self.shift_tolerance = shift_tolerance
+    self.max_steps = max_steps
+    self.plan = None
+    self.last = {}
+    self.slope = {}
+    self.reused = 0
+    self.computed = 0
+    self.error = 0
+
+  def shift(self, sites_cart, index, xyz):
+    return flex.max(flex.sqrt(
+      (sites_cart.select(self.plan.fragment(index))-xyz).dot()))
+
+  def reuse(self, plan, sites_cart, log=None):
+    """
+    Fragments whose last result is still good enough: {index: result}.
+    """
+    if(plan is not self.plan):
+      self.plan = plan
+      self.last = {}
+      self.slope = {}
+    result = {}
+    self.error = 0
+    for index, (xyz, value, steps) in self.last.items():
+      if(steps >= self.max_steps): continue
+      shift = self.shift(sites_cart, index, xyz)
+      if(shift > self.shift_tolerance): continue
+      self.last[index][2] += 1
+      result[index] = value
+      self.error = max(self.error, self.slope.get(index, 0)*shift)
+    self.reused += len(result)
+    self.computed += plan.n_fragments-len(result)
+    print("gradient reuse: %d of %d fragments reused, estimated gradient"
+      " error %.4f (total %d reused, %d computed)"%(len(result),
+      plan.n_fragments, self.error, self.reused, self.computed), file=log)
+    return result
+
+  def store(self, sites_cart, index, result):
+    xyz = sites_cart.select(self.plan.fragment(index))
+    if(index in self.last):
+      shift = self.shift(sites_cart, index, self.last[index][0])
+      if(shift > 0):
+        self.slope[index] = flex.max(flex.sqrt(
+          (result[1]-self.last[index][1][1]).dot()))/shift
+    self.last[index] = [xyz, result, 0]
+
+class fragment_batch_task(object):
+  """
+  Evaluate fragments in one call of the restraints manager; returns the same
+  per fragment as fragment_task, the time of the call shared evenly. If the
+  call fails the fragments are evaluated one at a time, so that only those
+  that fail on their own are reported (and retried).
+  """
+
+  def __init__(self, restraints_manager):
+    self.restraints_manager = restraints_manager
+
+  def __call__(self, selection_and_sites_cart, indices):
+    t0 = time.time()
+    try:
+      results = self.restraints_manager.target_and_gradients_batch(
+        selections = [selection_and_sites_cart[i][0] for i in indices],
+        indices    = indices)
+    except Exception as e:
+      print("batch of %d fragments failed, evaluating them one at a time: %s"%(
+        len(indices), str(e)))
+      task = fragment_task(self.restraints_manager)
+      return [task(selection_and_sites_cart[index]) for index in indices]
+    elapsed = (time.time()-t0)/max(1, len(indices))
+    return [(index, result, elapsed, os.getpid(), None)
+            for index, result in zip(indices, results)]
+
+class fragment_async_task(object):
+  """
+  Evaluate fragments from this process, with up to processes external QM
+  programs running at the same time (engines with submit_qr); returns the
+  same per fragment as fragment_task. Restraints without submit are
+  evaluated one after the other.
+  """
+
+  def __init__(self, restraints_manager, processes):
+    self.restraints_manager = restraints_manager
+    self.processes = processes
+
+  def supported(self):
+    restraints_manager = self.restraints_manager
+    return (isinstance(restraints_manager, from_qm) and
+            not restraints_manager.in_memory() and
+            hasattr(restraints_manager.qm_engine, "submit_qr"))
+
+  def __call__(self, selection_and_sites_cart, indices):
+    if(not self.supported()):
+      task = fragment_task(self.restraints_manager)
+      return [task(selection_and_sites_cart[index]) for index in indices]
+    async def evaluate(index):
+      t0 = time.time()
+      result, error = None, None
+      try:
+        result = await self.restraints_manager.submit(
+          sites_cart = selection_and_sites_cart[index][1],
+          selection  = selection_and_sites_cart[index][0],
+          index      = index)
+      except Exception:
+        import traceback
+        error = traceback.format_exc()
+      return (index, result, time.time()-t0, os.getpid(), error)
+    return async_qr.gather([evaluate(index) for index in indices],
+      max_in_flight=self.processes)
+
+class worker_pool(object):
+  """
+  Long-lived pool of forked worker processes. Each worker holds its own copy
+  of the restraints manager (QM engine, fragment extracts) for the lifetime
+  of the pool and receives only the super-sphere coordinates and the fragment
+  index per task. ML model weights loaded in the main process are shared
+  copy-on-write.
+  """
+
+  def __init__(self, restraints_manager, processes):
+    self.processes = processes
+    self.pool = multiprocessing.get_context("fork").Pool(
+      processes   = processes,
+      initializer = _init_worker,
+      initargs    = (restraints_manager,))
+    # shut the workers down at exit unless closed before
+    atexit.register(self.close)
+
+  def imap(self, sites_cart, indices):
+    """
+    Evaluate fragments in the given order, each handed to the next idle
+    worker; results are yielded as they complete.
+    """
+    return self.pool.imap_unordered(_evaluate_fragment,
+      [(index, sites_cart) for index in indices], chunksize=1)
+
+  def close(self):
+    if(self.pool is None): return
+    self.pool.close()
+    self.pool.join()
+    self.pool = None
+    atexit.unregister(self.close)
+
+  def terminate(self):
+    if(self.pool is None): return
+    self.pool.terminate()
+    self.pool.join()
+    self.pool = None
+    atexit.unregister(self.close)
+
 class from_cluster(object):
-  def __init__(self, restraints_manager, fragment_manager, parallel_params):
+  def __init__(self, restraints_manager, fragment_manager, parallel_params,
+               fallback_restraints_manager=None, fragment_cache=None,
+               stale_gradients=None):
     adopt_init_args(self, locals())
+    self.worker_pool = None
+    self.worker_pool_plan = None
+    self.scheduler = fragment_scheduler(
+      engine_name = getattr(restraints_manager, "qm_engine_name", None))
+
+  def use_worker_pool(self):
+    return (getattr(self.parallel_params, "persistent_pool", False) and
+            self.parallel_params.method == "multiprocessing" and
+            get_processes(self.parallel_params.nproc) > 1)
+
+  def use_batch(self):
+    return (getattr(self.parallel_params, "batch_fragments", False) and
+            isinstance(self.restraints_manager, from_qm) and
+            self.restraints_manager.batched())
+
+  def get_worker_pool(self):
+    # workers hold the fragment extracts: start over once fragments changed
+    if(self.worker_pool is not None and
+       self.worker_pool_plan is not self.fragment_manager.fragment_plan):
+      self.close()
+    if(self.worker_pool is None):
+      self.worker_pool = worker_pool(
+        restraints_manager = self.restraints_manager,
+        processes          = get_processes(self.parallel_params.nproc))
+      self.worker_pool_plan = self.fragment_manager.fragment_plan
+    return self.worker_pool
+
+  def close(self):
+    """
+    Shut down the worker pool, if any.
+    """
+    if(self.worker_pool is not None):
+      self.worker_pool.close()
+      self.worker_pool = None
+
+  def evaluate(self, sites_cart, selection_and_sites_cart, indices):
+    """
+    Evaluate the given fragments in the given order, yielding results as
+    they complete. Failures of single fragments are returned; failures of the
+    parallel machinery are fatal.
+    """
+    try:
+      if(self.use_batch()):
+        results = fragment_batch_task(self.restraints_manager)(
+          selection_and_sites_cart = selection_and_sites_cart,
+          indices                  = indices)
+      elif(self.parallel_params.method == "asyncio"):
+        results = fragment_async_task(
+          restraints_manager = self.restraints_manager,
+          processes          = get_processes(self.parallel_params.nproc))(
+            selection_and_sites_cart = selection_and_sites_cart,
+            indices                  = indices)
+      elif(self.use_worker_pool()):
+        results = self.get_worker_pool().imap(
+          sites_cart = sites_cart,
+          indices    = indices)
+      else:
+        results = parallel_map(
+          func                       = fragment_task(self.restraints_manager),
+          iterable                   = [selection_and_sites_cart[i]
+                                          for i in indices],
+          method                     = self.parallel_params.method,
+          preserve_exception_message = True,
+          processes                  = self.parallel_params.nproc,
+          qsub_command               = self.parallel_params.qsub_command,
+          use_manager                = True)
+      for result in results:
+        yield result
+    except Exception as e:
+      if(self.worker_pool is not None):
+        self.worker_pool.terminate()
+        self.worker_pool = None
+      import sys, traceback
+      print("check independent QM jobs")
+      # Sometimes the 'standard' traceback is not available.
+      # Below sort of forces the same information at the risk of doing things twice.
+      # It was needed to find some bugs, but perhaps needs to revisisted later.
+      exc_type, exc_value, exc_traceback = sys.exc_info()
+      traceback_template = ''' ** qrefine exception handler: **
+      %(type)s => File "%(filename)s" \n line %(lineno)s, in %(name)s: \n %(message)s
+       \n'''
+      traceback_details = {
+                       'filename': exc_traceback.tb_frame.f_code.co_filename,
+                       'lineno'  : exc_traceback.tb_lineno,
+                       'name'    : exc_traceback.tb_frame.f_code.co_name,
+                       'type'    : exc_type.__name__,
+                       'message' : exc_value.args[0]
+                      }
+      del(exc_type, exc_value, exc_traceback)
+      print(traceback.format_exc())
+      print(traceback_template % traceback_details)
+      raise Sorry('process finished with error: %s' % e)
+
+  def save_failed_fragment(self, index, directory="ase_error"):
+    """
+    Keep the working folder of a failed fragment for inspection.
+    """
+    import shutil
+    source = os.path.join(self.fragment_manager.working_folder, str(index))
+    target = os.path.join(directory, str(index))
+    if os.path.exists(target):
+      shutil.rmtree(target)
+    try:
+      shutil.copytree(source, target)
+    # Any error saying that the directory doesn't exist
+    except (shutil.Error, OSError) as e:
+      print('Directory not copied. Error: %s' % e)
 
   def energies_sites(self, sites_cart, compute_gradients=True):
     tg = self.target_and_gradients(sites_cart=sites_cart)
@@ -41,16 +467,17 @@ class from_cluster(object):
     system_size = sites_cart.size()
     self.fragment_manager.update_xyz(sites_cart)
     sites_cart = self.fragment_manager.pdb_hierarchy_super.atoms().extract_xyz()
-    #
-    self.fragment_manager.pdb_hierarchy_super.write_pdb_file(
-      file_name=self.restraints_manager.file_name,
-      crystal_symmetry=self.fragment_manager.expansion.cs_box)
     fragment_extracts_obj = self.fragment_manager.get_fragment_extracts()
     # super_sphere_geometry_restraints_manager will cause qusb submits
     # a single job instead of batch jobs
     if(isinstance(self.restraints_manager, from_qm)):
       fragment_extracts_obj.super_sphere_geometry_restraints_manager=None
     self.restraints_manager.fragment_extracts = fragment_extracts_obj
+    if(not (isinstance(self.restraints_manager, from_qm) and
+            self.restraints_manager.in_memory())):
+      self.fragment_manager.pdb_hierarchy_super.write_pdb_file(
+        file_name=self.restraints_manager.file_name,
+        crystal_symmetry=self.fragment_manager.expansion.cs_box)
     selection_and_sites_cart=[]
 
     #
@@ -85,76 +512,93 @@ class from_cluster(object):
        ## DEBUG end
     if(self.parallel_params.nproc is None):
       self.parallel_params.nproc = Auto
-    ncount=0
-    energy_gradients=None
-    while(ncount<5 and energy_gradients is None):
-      try:
-        energy_gradients = parallel_map(
-          func                       = self.restraints_manager,
-          iterable                   = selection_and_sites_cart,
-          method                     = self.parallel_params.method,
-          preserve_exception_message = True,
-          processes                  = self.parallel_params.nproc,
-          qsub_command               = self.parallel_params.qsub_command,
-          use_manager                = True)
-      except Exception as e:
-        import sys, traceback
-        import shutil
-        if os.path.exists('ase_error'):
-          shutil.rmtree('ase_error')
-        try:
-          shutil.copytree('ase', 'ase_error')
-        # Directories are the same
-        except shutil.Error as e:
-          print('Directory not copied. Error: %s' % e)
-        # Any error saying that the directory doesn't exist
-        except OSError as e:
-          print('Directory not copied. Error: %s' % e)
-        ncount=ncount+1
-        energy_gradients=None
-        print("check independent QM jobs")
-        # Sometimes the 'standard' traceback is not available.
-        # Below sort of forces the same information at the risk of doing things twice.
-        # It was needed to find some bugs, but perhaps needs to revisisted later.
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        traceback_template = ''' ** qrefine exception handler: **
-        %(type)s => File "%(filename)s" \n line %(lineno)s, in %(name)s: \n %(message)s
-         \n'''
-        traceback_details = {
-                         'filename': exc_traceback.tb_frame.f_code.co_filename,
-                         'lineno'  : exc_traceback.tb_lineno,
-                         'name'    : exc_traceback.tb_frame.f_code.co_name,
-                         'type'    : exc_type.__name__,
-                         'message' : exc_value.args[0]
-                        }
-        del(exc_type, exc_value, exc_traceback)
-        print(traceback.format_exc())
-        print(traceback_template % traceback_details)
-        raise Sorry('process finished with error: %s' % e)
-    target=0
-    gradients=flex.vec3_double(system_size)
-
-    for index, item in enumerate(energy_gradients):
-      t = item[0]
-      g = item[1]
-      selection_fragment = self.fragment_manager.fragment_selections[index]
-      selection_buffer =  self.fragment_manager.buffer_selections[index]
-      gradients_i = flex.vec3_double(system_size)
-      gradients_i = gradients_i.set_selected(selection_fragment, g)
-      gradients_i = gradients_i.set_selected(selection_buffer,[0,0,0])
-      gradients += gradients_i
-      target += t
-    ### for debugging parallel_map, remove later.
-    if(0):
-      for selection_fragment, selection_buffer in zip(
-                                      self.fragment_manager.fragment_selections,
-                                      self.fragment_manager.buffer_selections):
-        t, g =  self.restraints_manager.target_and_gradients(
-                           sites_cart=sites_cart, selection=selection_fragment)
-        # XXX INEFFICIENT, MOVE TO C++
-        gradients_i = flex.vec3_double(system_size)
-        gradients_i = gradients_i.set_selected(selection_fragment, g)
-        gradients_i = gradients_i.set_selected(selection_buffer,[0,0,0])
-        gradients += gradients_i
-        target += t
+    self.scheduler.reset(
+      plan  = self.fragment_manager.fragment_plan,
+      sizes = [h.atoms_size() for h in
+               self.fragment_manager.fragment_capped_initial])
+    order = self.scheduler.order()
+    retries = getattr(self.parallel_params, "fragment_retries", 0)
+    backoff = getattr(self.parallel_params, "retry_backoff", 0)
+    # gradients of cluster atoms are scatter-added as fragments complete
+    plan = self.fragment_manager.fragment_plan
+    target = 0
+    gradients = flex.vec3_double(system_size)
+    timings = []
+    t0 = time.time()
+    pending = order
+    # fragments whose atoms all moved less than the shift tolerance since
+    # they were last computed keep their gradients (for at most max_steps)
+    if(self.stale_gradients is not None):
+      reused = self.stale_gradients.reuse(plan=plan, sites_cart=sites_cart)
+      for index, result in reused.items():
+        target += result[0]*plan.multiplicities[index]
+        plan.add_gradients(gradients=gradients, i=index,
+          fragment_gradients=result[1])
+      order = [index for index in order if index not in reused]
+      pending = order
+    # fragments seen before at the same coordinates (not with point charges,
+    # which depend on the whole environment)
+    keys = {}
+    if(self.fragment_cache is not None and
+       not fragment_extracts_obj.charge_embedding):
+      cached = set()
+      for index in order:
+        keys[index] = self.fragment_cache.key(
+          restraints_manager = self.restraints_manager,
+          fragment_extracts  = fragment_extracts_obj,
+          sites_cart         = sites_cart,
+          index              = index)
+        result = self.fragment_cache.get(keys[index])
+        if(result is None): continue
+        cached.add(index)
+        if(self.stale_gradients is not None):
+          self.stale_gradients.store(sites_cart, index, result)
+        target += result[0]*plan.multiplicities[index]
+        plan.add_gradients(gradients=gradients, i=index,
+          fragment_gradients=result[1])
+      pending = [index for index in order if index not in cached]
+      self.fragment_cache.show(hits=len(cached), misses=len(pending))
+    for attempt in range(retries+1):
+      if(attempt>0):
+        wait = backoff*2**(attempt-1)
+        print("retrying %d failed fragment(s) in %.1fs (attempt %d of %d)"%(
+          len(pending), wait, attempt, retries))
+        time.sleep(wait)
+      failed = {}
+      for index, result, elapsed, worker, error in self.evaluate(
+          sites_cart, selection_and_sites_cart, pending):
+        timings.append((index, elapsed, worker))
+        if(error is not None):
+          failed[index] = error
+          continue
+        if(index in keys): self.fragment_cache.put(keys[index], result)
+        if(self.stale_gradients is not None):
+          self.stale_gradients.store(sites_cart, index, result)
+        target += result[0]*plan.multiplicities[index]
+        plan.add_gradients(gradients=gradients, i=index,
+          fragment_gradients=result[1])
+      pending = [index for index in pending if index in failed]
+      if(len(pending)==0): break
+    if(len(pending)>0):
+      for index in pending:
+        print("fragment %d failed:\n%s"%(index, failed[index]))
+        self.save_failed_fragment(index)
+      if(self.fallback_restraints_manager is None):
+        raise Sorry("QM calculation failed for fragment(s): %s"%(
+          " ".join([str(index) for index in pending])))
+      self.fallback_restraints_manager.fragment_extracts = fragment_extracts_obj
+      for index in pending:
+        print("fragment %d: falling back to %s"%(index, getattr(
+          self.fallback_restraints_manager, "qm_engine_name", "fallback")))
+        index, result, elapsed, worker, error = fragment_task(
+          self.fallback_restraints_manager)(selection_and_sites_cart[index])
+        if(error is not None):
+          raise Sorry("fragment %d failed with fallback engine:\n%s"%(
+            index, error))
+        if(self.stale_gradients is not None):
+          self.stale_gradients.store(sites_cart, index, result)
+        target += result[0]*plan.multiplicities[index]
+        plan.add_gradients(gradients=gradients, i=index,
+          fragment_gradients=result[1])
+    self.scheduler.update(timings = timings, wall_time = time.time()-t0)
     return target, gradients
@@ -2,6 +2,7 @@ from __future__ import division
 from __future__ import absolute_import
 import sys
 import time
+import numpy as np
 from qrefine import qr
 import iotbx.pdb
 from boost_adaptbx import graph
@@ -80,8 +81,128 @@ class girvan_nweman_clustering(object):
        self.sub_clustering(cluster,final_clusters)
     return final_clusters
 
+class edge_centrality_cache(object):
+  """
+  Edge betweenness centralities of an undirected graph, kept per connected
+  component. Each component has its own Boost graph with the vertex and edge
+  order of the full graph, so its centralities are the same numbers that
+  Brandes' algorithm gives on the full graph. Removing an edge recomputes only
+  the component it belonged to (or the two components it splits into).
+  """
+
+  def __init__(self, n_vertices, edges):
+    self.edges = edges
+    self.n_edges = len(edges)
+    self.centrality = np.full(len(edges), -np.inf)
+    self.neighbours = [dict() for i in range(n_vertices)]
+    for k, (i, j) in enumerate(edges):
+      self.neighbours[i][j] = k
+      self.neighbours[j][i] = k
+    self.edge_graph = [None]*len(edges)
+    self.n_evaluations = 0
+    seen = set()
+    for v in range(n_vertices):
+      if(v in seen or len(self.neighbours[v])==0): continue
+      component = self._component(v)
+      seen.update(component)
+      self._update(self._new_graph(component))
+
+  def _component(self, v):
+    result = set([v])
+    frontier = [v]
+    while frontier:
+      new = []
+      for u in frontier:
+        for w in self.neighbours[u]:
+          if(w not in result):
+            result.add(w)
+            new.append(w)
+      frontier = new
+    return result
+
+  def _split(self, i, j):
+    """
+    Grow the components of i and j alternately; returns None if they meet,
+    otherwise the vertices of the smaller one.
+    """
+    reached = [set([i]), set([j])]
+    frontiers = [[i], [j]]
+    side = 0
+    while True:
+      new = []
+      for u in frontiers[side]:
+        for w in self.neighbours[u]:
+          if(w in reached[1-side]): return None
+          if(w not in reached[side]):
+            reached[side].add(w)
+            new.append(w)
+      if(len(new)==0): return reached[side]
+      frontiers[side] = new
+      side = 1-side
+
+  def _new_graph(self, vertices):
+    g = graph.adjacency_list(
+      graph_type="undirected",
+      vertex_type="vector",
+      edge_type="set")
+    vertex_map = dict([(v, g.add_vertex()) for v in sorted(vertices)])
+    edge_ids = sorted(set([k for v in vertices
+      for k in self.neighbours[v].values()]))
+    g_edges = {}
+    for k in edge_ids:
+      i, j = self.edges[k]
+      ed = g.add_edge(vertex1=vertex_map[i], vertex2=vertex_map[j], weight=1)[0]
+      g_edges[k] = ed
+      self.edge_graph[k] = (g, g_edges)
+    return g, g_edges
+
+  def _update(self, component_graph):
+    g, g_edges = component_graph
+    if(len(g_edges)==0): return
+    # threshold=inf: Brandes once, no edge removed
+    edge_centrality_map = clustering_algorithm.\
+      betweenness_centrality_clustering(graph=g, threshold=float("inf"))
+    self.n_evaluations += 1
+    for k, ed in g_edges.items():
+      self.centrality[k] = edge_centrality_map[ed]
+
+  def remove_edge(self, k):
+    i, j = self.edges[k]
+    del self.neighbours[i][j]
+    del self.neighbours[j][i]
+    self.centrality[k] = -np.inf
+    self.n_edges -= 1
+    g, g_edges = self.edge_graph[k]
+    g.remove_edge(edge=g_edges.pop(k))
+    self.edge_graph[k] = None
+    split = self._split(i, j)
+    if(split is not None):
+      # move the smaller part into its own graph; its vertices stay behind
+      # in g as isolated vertices, which do not change any centrality
+      for v in split:
+        for w, e in self.neighbours[v].items():
+          if(e in g_edges):
+            g.remove_edge(edge=g_edges.pop(e))
+      self._update(self._new_graph(split))
+    self._update((g, g_edges))
+
+  def remove_edges(self, threshold):
+    """
+    Same as Boost betweenness_centrality_clustering: remove the (first) edge
+    of highest centrality until it falls below threshold. Returns the indices
+    of the removed edges.
+    """
+    result = []
+    while(self.n_edges > 0):
+      k = int(np.argmax(self.centrality))
+      if(self.centrality[k] < threshold): break
+      self.remove_edge(k)
+      result.append(k)
+    return result
+
 class betweenness_centrality_clustering(object):
-  def __init__(self, interaction_list,maxnum_residues_in_cluster=20,bcc_threshold=9,size=None):
+  def __init__(self, interaction_list,maxnum_residues_in_cluster=20,bcc_threshold=9,size=None,
+               cached_centrality=True):
     self.interaction_list = interaction_list
     self.g = graph.adjacency_list(
       graph_type="undirected",
@@ -90,14 +211,23 @@ class betweenness_centrality_clustering(object):
     self.maxnum_residues_in_cluster=maxnum_residues_in_cluster
     self.bcc_threshold=bcc_threshold
     self.size = size
+    self.cached_centrality = cached_centrality
 
   def get_clusters(self):
     self.build_graph()
+    if(self.cached_centrality):
+      centrality = edge_centrality_cache(
+        n_vertices = self.size,
+        edges      = [edge[:2] for edge in self.edges])
     threshold = self.bcc_threshold
     clustering = True
     while (clustering and threshold >=4):
-      edge_centrality_map = clustering_algorithm.\
-        betweenness_centrality_clustering(graph=self.g, threshold=threshold)
+      if(self.cached_centrality):
+        for k in centrality.remove_edges(threshold):
+          self.g.remove_edge(edge=self.edges[k][2])
+      else:
+        edge_centrality_map = clustering_algorithm.\
+          betweenness_centrality_clustering(graph=self.g, threshold=threshold)
       components = cca.connected_components(graph=self.g)
       components_size = [ len(component) for component in components]
       #print "max(components_size): ",max(components_size)
@@ -126,9 +256,216 @@ class betweenness_centrality_clustering(object):
       self.size = max(merged)
     for i in range(self.size):
       vertices.append(self.g.add_vertex())
+    # (vertex1, vertex2, edge) of the edges added, in interaction_list order
+    self.edges = []
     for pair in self.interaction_list:
-      self.g.add_edge(vertex1 = vertices[pair[0]-1],
+      edge, added = self.g.add_edge(vertex1 = vertices[pair[0]-1],
         vertex2 = vertices[pair[1]-1], weight = 1)
+      if(added): self.edges.append((pair[0]-1, pair[1]-1, edge))
+
+class multilevel_bisection_clustering(object):
+  """
+  Recursive bisection of the residue interaction graph weighted by atom
+  count. A cluster is bisected while its fragment, the cluster plus the
+  residues it interacts with (its buffer), has more than
+  maxnum_atoms_in_fragment atoms. Each bisection is multilevel: the graph is
+  coarsened by heavy-edge matching, split by greedy graph growing and the
+  split is refined by boundary moves while uncoarsening, keeping the halves
+  balanced in atoms and the number of cut interactions small.
+  """
+
+  def __init__(self, interaction_list, residue_atoms,
+               maxnum_atoms_in_fragment=500, imbalance=0.05, coarsest_size=20,
+               n_seeds=8, n_refinement_passes=8):
+    self.interaction_list = interaction_list
+    self.residue_atoms = residue_atoms
+    self.size = len(residue_atoms)
+    self.maxnum_atoms_in_fragment = maxnum_atoms_in_fragment
+    self.imbalance = imbalance
+    self.coarsest_size = coarsest_size
+    self.n_seeds = n_seeds
+    self.n_refinement_passes = n_refinement_passes
+
+  def get_clusters(self):
+    self.build_graph()
+    clusters = []
+    self._split(list(range(self.size)), clusters)
+    return [sorted([v+1 for v in cluster]) for cluster in clusters]
+
+  def build_graph(self):
+    self.adj = [dict() for i in range(self.size)]
+    for pair in self.interaction_list:
+      i, j = pair[0]-1, pair[1]-1
+      if(i == j): continue
+      self.adj[i][j] = 1
+      self.adj[j][i] = 1
+
+  def fragment_atoms(self, vertices):
+    """
+    Atoms in the cluster of the given vertices and in its buffer.
+    """
+    cluster = set(vertices)
+    buffer = set([u for v in vertices for u in self.adj[v]]) - cluster
+    return sum([self.residue_atoms[v] for v in cluster|buffer])
+
+  def _components(self, vertices):
+    vertices = set(vertices)
+    result = []
+    seen = set()
+    for v in sorted(vertices):
+      if(v in seen): continue
+      component = [v]
+      seen.add(v)
+      frontier = [v]
+      while frontier:
+        new = []
+        for u in frontier:
+          for w in self.adj[u]:
+            if(w in vertices and w not in seen):
+              seen.add(w)
+              component.append(w)
+              new.append(w)
+        frontier = new
+      result.append(sorted(component))
+    return result
+
+  def _split(self, vertices, clusters):
+    if(len(vertices) == 1 or
+       self.fragment_atoms(vertices) <= self.maxnum_atoms_in_fragment):
+      clusters.append(vertices)
+      return
+    components = self._components(vertices)
+    if(len(components) > 1):
+      for component in components:
+        self._split(component, clusters)
+      return
+    index = dict([(v, i) for i, v in enumerate(vertices)])
+    adj = [dict([(index[u], w) for u, w in self.adj[v].items() if u in index])
+      for v in vertices]
+    vw = [self.residue_atoms[v] for v in vertices]
+    part = self.bisection(adj, vw)
+    if(len(set(part)) == 1):
+      clusters.append(vertices)
+      return
+    for side in [0, 1]:
+      self._split([v for v, p in zip(vertices, part) if p == side], clusters)
+
+  def bisection(self, adj, vw):
+    """
+    Multilevel bisection of a connected graph: adj[v] maps neighbours of v to
+    edge weights, vw are vertex weights. Returns the side (0/1) of each
+    vertex.
+    """
+    levels = []
+    while(len(adj) > self.coarsest_size):
+      cmap, coarse_adj, coarse_vw = self._coarsen(adj, vw)
+      if(len(coarse_adj) > 0.95*len(adj)): break
+      levels.append((adj, vw, cmap))
+      adj, vw = coarse_adj, coarse_vw
+    part = self._initial_bisection(adj, vw)
+    for fine_adj, fine_vw, cmap in reversed(levels):
+      part = self._refine(fine_adj, fine_vw, [part[c] for c in cmap])
+    return part
+
+  def _coarsen(self, adj, vw):
+    """
+    Heavy-edge matching: each vertex is merged with the unmatched neighbour
+    it shares the heaviest edge with, unless that gets too heavy to balance.
+    """
+    max_weight = 1.5*sum(vw)/self.coarsest_size
+    cmap = [-1]*len(adj)
+    n_coarse = 0
+    for v in sorted(range(len(adj)), key=lambda v: len(adj[v])):
+      if(cmap[v] != -1): continue
+      best = None
+      for u, w in adj[v].items():
+        if(cmap[u] == -1 and vw[u]+vw[v] <= max_weight):
+          key = (w, -vw[u], -u)
+          if(best is None or key > best[0]): best = (key, u)
+      cmap[v] = n_coarse
+      if(best is not None): cmap[best[1]] = n_coarse
+      n_coarse += 1
+    coarse_vw = [0]*n_coarse
+    coarse_adj = [dict() for i in range(n_coarse)]
+    for v in range(len(adj)):
+      coarse_vw[cmap[v]] += vw[v]
+      for u, w in adj[v].items():
+        if(cmap[u] != cmap[v]):
+          coarse_adj[cmap[v]][cmap[u]] = coarse_adj[cmap[v]].get(cmap[u], 0)+w
+    return cmap, coarse_adj, coarse_vw
+
+  def _initial_bisection(self, adj, vw):
+    """
+    Best refined split grown from a few seeds: side 0 grows from the seed by
+    the boundary vertex with most edges into it until it has half the weight.
+    """
+    n = len(adj)
+    target = sum(vw)/2.
+    best = None
+    for seed in sorted(set([k*n//self.n_seeds for k in range(self.n_seeds)])):
+      part = [1]*n
+      part[seed] = 0
+      weight = vw[seed]
+      while(weight < target):
+        candidates = [v for v in range(n) if part[v] == 1 and
+          any([part[u] == 0 for u in adj[v]])]
+        if(len(candidates) == 0):
+          candidates = [v for v in range(n) if part[v] == 1]
+        if(len(candidates) == 0): break
+        v = max(candidates, key=lambda v: (self._gain(adj, part, v), -v))
+        if(weight+vw[v]-target > target-weight): break
+        part[v] = 0
+        weight += vw[v]
+      part = self._refine(adj, vw, part)
+      key = (self.cut(adj, part),
+        abs(sum([w for w, p in zip(vw, part) if p == 0])-target))
+      if(best is None or key < best[0]): best = (key, part)
+    return best[1]
+
+  def _gain(self, adj, part, v):
+    """
+    Decrease of the cut if v changes side.
+    """
+    result = 0
+    for u, w in adj[v].items():
+      if(part[u] == part[v]): result -= w
+      else:                   result += w
+    return result
+
+  def cut(self, adj, part):
+    return sum([w for v in range(len(adj)) for u, w in adj[v].items()
+      if part[u] != part[v]])//2
+
+  def _refine(self, adj, vw, part):
+    """
+    Greedy boundary refinement: move vertices that reduce the cut, or keep it
+    and improve the balance, as long as the halves stay balanced.
+    """
+    part = list(part)
+    total = sum(vw)
+    slack = max(self.imbalance*total, max(vw))
+    weight = [0, 0]
+    for v, p in zip(vw, part):
+      weight[p] += v
+    for i_pass in range(self.n_refinement_passes):
+      boundary = [v for v in range(len(adj))
+        if any([part[u] != part[v] for u in adj[v]])]
+      boundary.sort(key=lambda v: (-self._gain(adj, part, v), v))
+      moved = False
+      for v in boundary:
+        side = part[v]
+        if(weight[side]-vw[v] <= 0): continue
+        before = abs(weight[0]-total/2.)
+        after = abs(weight[0]-total/2.+(vw[v] if side == 1 else -vw[v]))
+        if(after > slack and after >= before): continue
+        gain = self._gain(adj, part, v)
+        if(gain > 0 or (gain == 0 and after < before)):
+          part[v] = 1-side
+          weight[side] -= vw[v]
+          weight[1-side] += vw[v]
+          moved = True
+      if(not moved): break
+    return part
 
 class Program(ProgramTemplate):
 
@@ -162,8 +499,10 @@ class Program(ProgramTemplate):
     fq = fragments(
       pdb_hierarchy=ph,
       crystal_symmetry=cs,
+      clustering_method=self.params.cluster.clustering_method,
       maxnum_residues_in_cluster=self.params.cluster.maxnum_residues_in_cluster,
       bcc_threshold = self.params.cluster.bcc_threshold,
+      maxnum_atoms_in_fragment=self.params.cluster.maxnum_atoms_in_fragment,
       clusters_only = True)
     #print("Residue indices for each cluster:\n", fq.clusters, file=log)
     print('# clusters: ',len(fq.clusters), file=log)
@@ -0,0 +1,263 @@
+"""
+Local inference server for quantum.engine_name=server.
+
+Loads an ML model (aimnet2 or torchani) once and answers the requests of any
+number of qrefine processes. Requests that arrive within a short window are
+evaluated together in one forward/backward pass (micro-batching).
+
+Endpoints:
+  POST /calc        one molecule, JSON (species, coordinates)
+  POST /calc_batch  several molecules, npz arrays (see plugin/ase/server_qr.py)
+  GET  /metrics     batch latency and throughput statistics, JSON
+
+Energies are returned in eV and forces in eV/A.
+"""
+# LIBTBX_SET_DISPATCHER_NAME qr.server
+from __future__ import division
+from __future__ import print_function
+import sys
+import json
+import time
+import argparse
+import threading
+import numpy as np
+import ase.units as ase_units
+from ase import Atoms
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from qrefine.plugin.ase import server_qr
+
+# eV to the run_qr units of the engines
+unit_convert = ase_units.kcal/ase_units.mol
+
+class micro_batcher(object):
+  """
+  Collect molecules from concurrent requests and evaluate them in batches:
+  a batch is closed window seconds after its first molecule arrived or when
+  it holds max_batch molecules.
+  """
+
+  def __init__(self, engine, window=0.005, max_batch=256, max_samples=1000):
+    self.engine = engine
+    self.window = window
+    self.max_batch = max_batch
+    self.max_samples = max_samples
+    self.queue = []
+    self.condition = threading.Condition()
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.batches = 0
+    self.molecules = 0
+    self.atoms = 0
+    self.busy = 0.
+    self.latencies = []
+    self.sizes = []
+    self.stopped = False
+    self.thread = threading.Thread(target=self.loop)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, atoms_list, charges):
+    """
+    Futures of the (energy, forces) of each molecule, in eV and eV/A.
+    """
+    futures = [Future() for atoms in atoms_list]
+    with self.condition:
+      for item in zip(atoms_list, charges, futures):
+        self.queue.append(item + (time.time(),))
+      self.condition.notify()
+    return futures
+
+  def next_batch(self):
+    with self.condition:
+      while(not self.queue and not self.stopped):
+        self.condition.wait()
+      if(self.stopped): return []
+      deadline = self.queue[0][3]+self.window
+      while(len(self.queue) < self.max_batch and not self.stopped):
+        wait = deadline-time.time()
+        if(wait <= 0): break
+        self.condition.wait(wait)
+      batch = self.queue[:self.max_batch]
+      self.queue = self.queue[self.max_batch:]
+      return batch
+
+  def loop(self):
+    while(not self.stopped):
+      batch = self.next_batch()
+      if(not batch): continue
+      t0 = time.time()
+      try:
+        results = self.engine.run_qr_batch([item[0] for item in batch],
+          [item[1] for item in batch])
+      except Exception:
+        # one bad molecule fails the whole batch: evaluate the molecules one
+        # at a time, only the requests of those that fail get the error
+        results = []
+        for item in batch:
+          try:
+            results.append(self.engine.run_qr_batch([item[0]], [item[1]])[0])
+          except Exception as e:
+            results.append(e)
+      t1 = time.time()
+      for item, result in zip(batch, results):
+        if(isinstance(result, Exception)):
+          item[2].set_exception(result)
+        else:
+          energy, forces = result
+          item[2].set_result((energy/unit_convert, forces/unit_convert))
+      with self.lock:
+        self.batches += 1
+        self.molecules += len(batch)
+        self.atoms += sum([len(item[0]) for item in batch])
+        self.busy += t1-t0
+        self.latencies.append(t1-t0)
+        self.sizes.append(len(batch))
+        del self.latencies[:-self.max_samples]
+        del self.sizes[:-self.max_samples]
+
+  def metrics(self):
+    with self.lock:
+      latencies = np.array(self.latencies)
+      elapsed = time.time()-self.started
+      result = dict(
+        batches               = self.batches,
+        molecules             = self.molecules,
+        atoms                 = self.atoms,
+        queued                = len(self.queue),
+        uptime                = elapsed,
+        busy                  = self.busy,
+        molecules_per_second  = self.molecules/elapsed if elapsed else 0.,
+        molecules_per_batch   = float(np.mean(self.sizes)) if self.sizes else 0.,
+        batch_latency_mean    = float(latencies.mean()) if self.batches else 0.,
+        batch_latency_p50     = float(np.percentile(latencies, 50))
+                                  if self.batches else 0.,
+        batch_latency_p95     = float(np.percentile(latencies, 95))
+                                  if self.batches else 0.,
+        batch_latency_max     = float(latencies.max()) if self.batches else 0.)
+    return result
+
+  def stop(self):
+    with self.condition:
+      self.stopped = True
+      self.condition.notify_all()
+    self.thread.join()
+
+class request_handler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, *args):
+    pass
+
+  def reply(self, body, content_type, status=200):
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if(self.path == "/metrics"):
+      self.reply(json.dumps(self.server.batcher.metrics()).encode(),
+        "application/json")
+    else:
+      self.reply(b"not found", "text/plain", status=404)
+
+  def do_POST(self):
+    data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    try:
+      if(self.path == "/calc"):
+        request = json.loads(data.decode())
+        atoms = Atoms(numbers=request["species"],
+          positions=request["coordinates"])
+        energy, forces = self.server.batcher.submit(
+          [atoms], [request.get("charge", 0)])[0].result()
+        self.reply(json.dumps({"energy": energy,
+          "forces": forces.tolist()}).encode(), "application/json")
+      elif(self.path == "/calc_batch"):
+        request = server_qr.decode_arrays(data)
+        atoms_list = []
+        for numbers, positions in zip(
+            np.split(request["species"], np.cumsum(request["sizes"])[:-1]),
+            np.split(request["coordinates"].astype(np.float64),
+              np.cumsum(request["sizes"])[:-1])):
+          atoms_list.append(Atoms(numbers=numbers, positions=positions))
+        results = [future.result() for future in self.server.batcher.submit(
+          atoms_list, request["charges"].tolist())]
+        dtype = request["coordinates"].dtype
+        self.reply(server_qr.encode_arrays(
+          energy = np.array([result[0] for result in results]),
+          forces = np.concatenate(
+            [result[1] for result in results]).astype(dtype)),
+          server_qr.RestAPICalculator.content_type)
+      else:
+        self.reply(b"not found", "text/plain", status=404)
+    except Exception as e:
+      self.reply(str(e).encode(), "text/plain", status=500)
+
+class inference_server(object):
+  """
+  HTTP server in a background thread, answering requests of concurrent
+  clients through one micro_batcher.
+  """
+
+  def __init__(self, engine, host="127.0.0.1", port=8000, window=0.005,
+               max_batch=256):
+    self.batcher = micro_batcher(engine=engine, window=window,
+      max_batch=max_batch)
+    self.server = ThreadingHTTPServer((host, port), request_handler)
+    self.server.daemon_threads = True
+    self.server.batcher = self.batcher
+    self.url = "http://%s:%d" % self.server.server_address[:2]
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def shutdown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.batcher.stop()
+
+def create_engine(engine_name, model=None):
+  """The ML engine; its model is loaded once, here."""
+  if(engine_name == "torchani"):
+    from qrefine.plugin.ase.torchani_qr import TorchAni
+    return TorchAni()
+  elif(engine_name == "aimnet2"):
+    from qrefine.plugin.ase.aimnet2_qr import AIMNet2Calculator
+    return AIMNet2Calculator(model or "aimnet2-qr")
+  raise ValueError("unknown engine %s" % engine_name)
+
+def run(args, log=sys.stdout):
+  parser = argparse.ArgumentParser(
+    description="Micro-batching ML server for quantum.engine_name=server")
+  parser.add_argument("--engine", choices=["aimnet2", "torchani"],
+                      default="aimnet2", help="ML engine")
+  parser.add_argument("--model", default=None,
+                      help="AIMNet2 model name or file (default aimnet2-qr)")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8000)
+  parser.add_argument("--window", type=float, default=5.,
+                      help="ms to wait for more requests to join a batch")
+  parser.add_argument("--max-batch", type=int, default=256,
+                      help="maximum number of molecules per batch")
+  params = parser.parse_args(args)
+  t0 = time.time()
+  engine = create_engine(params.engine, params.model)
+  print("%s model loaded in %.1fs" % (params.engine, time.time()-t0), file=log)
+  server = inference_server(engine=engine, host=params.host, port=params.port,
+    window=params.window/1000., max_batch=params.max_batch)
+  print("serving on %s (quantum.server_url=%s), metrics at %s/metrics" % (
+    server.url, server.url, server.url), file=log)
+  try:
+    server.server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.shutdown()
+
+if(__name__ == "__main__"):
+  run(sys.argv[1:])
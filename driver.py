@@ -179,7 +179,7 @@ class clustering_update(object):
     print(rmsd_diff, self.rmsd_tolerance)
     if(rmsd_diff > self.rmsd_tolerance):
       print(" rmsd_diff: ", rmsd_diff, "--> need to redo clustering", file=self.log)
-      calculator.restraints_manager.fragment_manager.set_up_cluster_qm()
+      calculator.restraints_manager.fragment_manager.re_cluster()
       self.pre_sites_cart = sites_cart
 
 class minimizer_ase(object):
@@ -3,15 +3,20 @@ from __future__ import absolute_import
 import os
 import copy
 import itertools
+import collections
+import numpy as np
 import libtbx.load_env
 from libtbx.utils import Sorry
 from scitbx.array_family import flex
 from .utils import fragment_utils
+from .utils.contact_index import contact_index
 from libtbx import group_args
 from qrefine.super_cell import expand
 #import qrefine.completion as model_completion
 from . import completion
+from .capping import capping_template
 from .charges import charges_class
+from mmtbx.ligands.electrons import atom_property
 from mmtbx.pair_interaction import pair_interaction
 from functools import cmp_to_key
 
@@ -40,6 +45,121 @@ def check_selection_integrity(atoms, indices, verbose=False):
 def check_hierarchy(hierarchy, verbose=False):
   check_atoms_integrity(hierarchy.atoms(), verbose=verbose)
 
+class fragment_plan(object):
+  """
+  Flat (CSR) index arrays for all fragments. Atoms of fragment i are
+  fragment_indices[fragment_offsets[i]:fragment_offsets[i+1]], 0-based
+  super-sphere indices in ascending order, so master atoms come first; the
+  same holds for cluster atoms. Gradient scales are stored per master atom of
+  a fragment, in the order of the QM gradients; multiplicities count the
+  identical fragments merged into each one (see deduplicate_fragments).
+  """
+
+  def __init__(self, cluster_atoms, fragment_super_atoms, fragment_scales,
+               system_size, super_size, fragment_multiplicities=None):
+    self.system_size = system_size
+    self.super_size = super_size
+    self.n_fragments = len(fragment_super_atoms)
+    if(fragment_multiplicities is None):
+      fragment_multiplicities = [1]*self.n_fragments
+    self.multiplicities = flex.double(fragment_multiplicities)
+    cluster_indices = []
+    fragment_indices = []
+    master_sizes = []
+    scales = []
+    cluster_in_fragment = []
+    for cluster, fragment, scale in zip(cluster_atoms, fragment_super_atoms,
+                                        fragment_scales):
+      fragment = np.array(fragment, dtype=np.int64)-1
+      master = fragment[fragment < system_size]
+      assert len(scale) == master.size
+      order = np.argsort(master)
+      master = master[order]
+      cluster = np.sort(np.array(cluster, dtype=np.int64)-1)
+      assert np.isin(cluster, master).all()
+      position = np.searchsorted(master, cluster)
+      cluster_indices.append(cluster)
+      fragment_indices.append(np.sort(fragment))
+      master_sizes.append(master.size)
+      scales.append(np.array(scale, dtype=np.float64)[order])
+      cluster_in_fragment.append(position)
+    def csr(arrays):
+      offsets = np.cumsum([0]+[a.size for a in arrays])
+      if(len(arrays)>0): values = np.concatenate(arrays)
+      else:              values = np.zeros(0)
+      return flex.size_t(offsets.tolist()), values
+    self.cluster_offsets, values = csr(cluster_indices)
+    self.cluster_indices = flex.size_t(values.tolist())
+    self.cluster_in_fragment = flex.size_t(
+      csr(cluster_in_fragment)[1].tolist())
+    self.fragment_offsets, values = csr(fragment_indices)
+    self.fragment_indices = flex.size_t(values.tolist())
+    self.master_sizes = flex.size_t(master_sizes)
+    self.master_offsets, values = csr(scales)
+    self.scale_values = flex.double(values.tolist())
+
+  def cluster(self, i):
+    return self.cluster_indices[
+      self.cluster_offsets[i]:self.cluster_offsets[i+1]]
+
+  def fragment(self, i):
+    return self.fragment_indices[
+      self.fragment_offsets[i]:self.fragment_offsets[i+1]]
+
+  def fragment_master(self, i):
+    return self.fragment_indices[
+      self.fragment_offsets[i]:self.fragment_offsets[i]+self.master_sizes[i]]
+
+  def scales(self, i):
+    return self.scale_values[self.master_offsets[i]:self.master_offsets[i+1]]
+
+  def cluster_selection(self, i):
+    return flex.bool(self.system_size, self.cluster(i))
+
+  def fragment_selection(self, i):
+    return flex.bool(self.system_size, self.fragment_master(i))
+
+  def fragment_super_selection(self, i):
+    return flex.bool(self.super_size, self.fragment(i))
+
+  def add_gradients(self, gradients, i, fragment_gradients):
+    """
+    Add the gradients of the cluster atoms of fragment i to gradients of the
+    entire system; fragment_gradients are ordered as fragment master atoms,
+    buffer atoms do not contribute.
+    """
+    gradients.add_selected(self.cluster(i), fragment_gradients.select(
+      self.cluster_in_fragment[
+        self.cluster_offsets[i]:self.cluster_offsets[i+1]]))
+    return gradients
+
+def deduplicate_fragments(cluster_atoms, fragment_super_atoms, fragment_scales,
+                          system_size):
+  """
+  Merge fragments with the same cluster and fragment atoms (1-based
+  serials), as produced for different altloc hierarchies. The gradient
+  scales of a merged fragment are the per-atom sums of the scales of its
+  copies. Returns the distinct cluster atoms, fragment atoms and scales and
+  the number of copies of each fragment.
+  """
+  index = {}
+  result = [[], [], [], []]
+  for cluster, fragment, scales in zip(cluster_atoms, fragment_super_atoms,
+                                       fragment_scales):
+    key = (frozenset(cluster), frozenset(fragment))
+    if(key not in index):
+      index[key] = len(result[0])
+      for values, value in zip(result, [cluster, fragment, list(scales), 1]):
+        values.append(value)
+      continue
+    i = index[key]
+    master = [j for j in result[1][i] if j <= system_size]
+    position = dict([(atom, k) for k, atom in enumerate(master)])
+    for atom, scale in zip([j for j in fragment if j <= system_size], scales):
+      result[2][i][position[atom]] += scale
+    result[3][i] += 1
+  return result
+
 class fragments(object):
 
   def __init__(self,
@@ -49,6 +169,7 @@ class fragments(object):
       altloc_method              = None,
       maxnum_residues_in_cluster = 20,
       bcc_threshold              = 9,
+      maxnum_atoms_in_fragment   = 500,
       charge_embedding           = False,
       two_buffers                = False,
       pdb_hierarchy              = None,
@@ -60,9 +181,15 @@ class fragments(object):
       save_clusters              = False,
       select_within_radius       = 10.0,
       clusters_only              = False,
-      bond_with_altloc_flag      = True):
+      bond_with_altloc_flag      = True,
+      incremental_re_clustering  = False,
+      fast_capping               = False,
+      whole_system_charges       = False):
     #
+    self.fast_capping = fast_capping
+    self.whole_system_charges = whole_system_charges
     self.bond_with_altloc_flag = bond_with_altloc_flag
+    self.incremental_re_clustering = incremental_re_clustering
     self.select_within_radius = select_within_radius
     self.charge_embedding = charge_embedding
     self.two_buffers = two_buffers
@@ -77,6 +204,7 @@ class fragments(object):
     self.debug = debug
     self.maxnum_residues_in_cluster =  maxnum_residues_in_cluster
     self.bcc_threshold = bcc_threshold
+    self.maxnum_atoms_in_fragment = maxnum_atoms_in_fragment
     self.save_clusters = save_clusters
     self.expansion = None
     self.expansion_file = None
@@ -84,6 +212,12 @@ class fragments(object):
     self.clusters = None
     self.clusters_only = clusters_only
     self.charge_service = None
+    self.super_interaction_list = None
+    self.molecules_in_fragments = None
+    self.fragment_plan = None
+    self.fragment_multiplicities = None
+    self.bonded_to_altloc = None
+    self.super_formal_charges = None
     #
     if(os.path.exists(self.working_folder) is not True):
       if(make_working_folder):
@@ -111,34 +245,203 @@ class fragments(object):
     self.pdb_hierarchy_super = self.expansion.ph_super_sphere
 
   def set_up_cluster_qm(self):
+    # formal charges are for the coordinates the fragments are built from
+    self.super_formal_charges = None
     self.get_clusters()
     if not self.clusters_only:
       self.get_fragments()
       self.get_fragment_hierarchies_and_charges()
+      if(self.incremental_re_clustering):
+        self.super_interaction_list = self.get_super_interactions()
+
+  def re_cluster(self):
+    """
+    Re-compute clusters and fragments for the current coordinates. In
+    incremental mode only clusters containing residues whose contacts changed
+    are re-clustered and get new buffers; capped hierarchies, charges and
+    selections of all other fragments are kept. Falls back to the full
+    set-up if there is nothing to compare with or altlocs are present.
+    """
+    if(not self.incremental_re_clustering or self.clusters_only or
+       self.super_interaction_list is None or
+       self.pdb_hierarchy_super.altloc_indices().size()>1):
+      self.set_up_cluster_qm()
+      return
+    n_residues = len(list(self.pdb_hierarchy.residue_groups()))
+    super_interaction_list = self.get_super_interactions()
+    changed_residues = set()
+    for pair in super_interaction_list.symmetric_difference(
+                                                  self.super_interaction_list):
+      for residue in pair:
+        if(residue <= n_residues): changed_residues.add(residue)
+    self.super_interaction_list = super_interaction_list
+    self.interaction_list = pair_interaction.run(
+      copy.deepcopy(self.pdb_hierarchy))
+    self.interaction_list += self.backbone_connections
+    affected = []
+    for i, cluster in enumerate(self.clusters):
+      if(changed_residues.intersection(cluster) or (self.two_buffers and
+         changed_residues.intersection(self.molecules_in_fragments[i]))):
+        affected.append(i)
+    print("incremental re-clustering: %d residues changed contacts, %d of %d"
+      " clusters rebuilt"%(len(changed_residues), len(affected),
+      len(self.clusters)))
+    if(len(affected)==0): return
+    self.super_formal_charges = None
+    ## re-cluster the residues of the affected clusters only
+    residues = sorted(set(itertools.chain.from_iterable(
+      [self.clusters[i] for i in affected])))
+    new_clusters = self._cluster_residues(residues)
+    ## buffers, capped hierarchies and charges for the new clusters only
+    self.pdb_hierarchy_super.atoms_reset_serial()
+    cluster_atoms, fragment_super_atoms, molecules_in_fragments = \
+      self._get_fragment_atoms(self.pdb_hierarchy_super, new_clusters)
+    fragment_scales = [[1.0]*sum(j <= self.system_size for j in atoms)
+      for atoms in fragment_super_atoms]
+    plan = self._get_fragment_plan(
+      cluster_atoms, fragment_super_atoms, fragment_scales)
+    new = dict([(name, []) for name in self._per_fragment_attributes])
+    for i in range(len(new_clusters)):
+      new["clusters"].append(new_clusters[i])
+      new["cluster_atoms"].append(cluster_atoms[i])
+      new["fragment_super_atoms"].append(fragment_super_atoms[i])
+      new["fragment_scales"].append(fragment_scales[i])
+      new["molecules_in_fragments"].append(molecules_in_fragments[i])
+      f = self._set_up_fragment(plan, i)
+      for name in self._per_fragment_attributes:
+        if(name in f): new[name].append(f[name])
+    ## keep everything else, preserve largest-cluster-first order
+    keep = [i for i in range(len(self.clusters)) if i not in affected]
+    for name in self._per_fragment_attributes:
+      old = getattr(self, name)
+      setattr(self, name, [old[i] for i in keep] + new[name])
+    order = sorted(range(len(self.clusters)),
+      key=lambda i: len(self.clusters[i]), reverse=True)
+    for name in self._per_fragment_attributes:
+      old = getattr(self, name)
+      setattr(self, name, [old[i] for i in order])
+    self.fragment_plan = self._get_fragment_plan(
+      self.cluster_atoms, self.fragment_super_atoms, self.fragment_scales)
+
+  _per_fragment_attributes = [
+    "clusters",
+    "cluster_atoms",
+    "fragment_super_atoms",
+    "fragment_scales",
+    "molecules_in_fragments",
+    "fragment_selections",
+    "fragment_super_selections",
+    "fragment_charges",
+    "cluster_selections",
+    "buffer_selections",
+    "fragment_capped_initial",
+    "fragment_capping"]
+
+  def get_super_interactions(self):
+    """
+    Residue pairs of the super-sphere interaction graph with at least one
+    residue in the master copy (residue indices of the master come first).
+    """
+    n_residues = len(list(self.pdb_hierarchy.residue_groups()))
+    result = set()
+    for pair in pair_interaction.run(copy.deepcopy(self.pdb_hierarchy_super)):
+      if(min(pair) <= n_residues):
+        result.add(tuple(sorted(pair)))
+    return result
+
+  def _clustering(self, interaction_list, residues):
+    """
+    Clustering for the given residues (1-based), interaction_list refers to
+    positions in residues.
+    """
+    from . import clustering
+    if(self.clustering_method == "bisection"):
+      residue_atoms = [rg.atoms_size()
+        for rg in self.pdb_hierarchy.residue_groups()]
+      return clustering.multilevel_bisection_clustering(
+        interaction_list,
+        residue_atoms = [residue_atoms[r-1] for r in residues],
+        maxnum_atoms_in_fragment = self.maxnum_atoms_in_fragment)
+    return clustering.betweenness_centrality_clustering(
+      interaction_list,
+      size = len(residues),
+      maxnum_residues_in_cluster = self.maxnum_residues_in_cluster,
+      bcc_threshold = self.bcc_threshold)
+
+  def _cluster_residues(self, residues):
+    """
+    Cluster a subset of residues using the interactions among them only.
+    """
+    index = dict([(residue, i+1) for i, residue in enumerate(residues)])
+    interaction_list = []
+    for pair in self.interaction_list:
+      if(pair[0] in index and pair[1] in index):
+        interaction_list.append([index[pair[0]], index[pair[1]]])
+    clusters = self._clustering(interaction_list, residues).get_clusters()
+    return [sorted([residues[i-1] for i in cluster]) for cluster in clusters]
 
   def get_clusters(self):
     n_residues=len(list(self.pdb_hierarchy.residue_groups()))
     self.interaction_list = pair_interaction.run(copy.deepcopy(self.pdb_hierarchy))  ##deepcopy
     self.interaction_list += self.backbone_connections # XXX WHY IS THIS?
     ## isolate altloc molecules
-    from . import clustering
-    clusters = clustering.betweenness_centrality_clustering(
-      self.interaction_list,
-      size = n_residues,
-      maxnum_residues_in_cluster = self.maxnum_residues_in_cluster,
-      bcc_threshold = self.bcc_threshold).get_clusters()
+    clusters = self._clustering(
+      self.interaction_list, list(range(1, n_residues+1))).get_clusters()
     self.clusters=sorted(clusters,
       key=cmp_to_key(lambda x, y: 1 if len(x) < len(y) else -1 if len(x) > len(y) else 0))
 
-  def get_fragments(self):
+  def _get_fragment_atoms(self, ph, clusters, use_contact_index=True):
+    """
+    Cluster and fragment (cluster + buffer) atoms for each cluster in ph,
+    as 1-based serials of pdb_hierarchy_super. With use_contact_index the
+    neighbour search is done once for ph instead of on a deep copy of ph
+    per cluster.
+    """
+    if(use_contact_index):
+      interactions = contact_index(ph).pair_interaction
+    else:
+      interactions = lambda core: pair_interaction.run(copy.deepcopy(ph), core)
 
+    serials = np.array([int(number) for number in ph.atoms().extract_serial()])
     def selected_atom_indices_in_entire_ph(selected_atom_indices_in_sub_ph, sub_ph):
-      selected_atom_indices_in_entire_ph = []
-      for index, number in enumerate(sub_ph.atoms().extract_serial()):
-        if(index+1 in selected_atom_indices_in_sub_ph):
-          selected_atom_indices_in_entire_ph.append(int(number))
-      return selected_atom_indices_in_entire_ph
+      indices = np.unique(np.array(selected_atom_indices_in_sub_ph, dtype=int))
+      return serials[indices-1].tolist()
+
+    cluster_atoms_in_ph = []
+    fragment_super_atoms_in_ph = []
+    molecules_in_fragments = []
+    for i in range(len(clusters)):
+      # print 'processing cluster', i
+      atoms_in_one_cluster, atoms_in_one_fragment, molecules_in_one_fragment = \
+        interactions(clusters[i])
+      # print("clusters[i]",clusters[i])
+      # print("molecules_in_one_fragment:", molecules_in_one_fragment)
+      # print("atoms_in_one_fragment",atoms_in_one_fragment)
+
+      atoms_in_one_cluster = selected_atom_indices_in_entire_ph(
+                                                  atoms_in_one_cluster, ph)
+      cluster_atoms_in_ph.append(atoms_in_one_cluster)
+
+      atoms_in_one_fragment = selected_atom_indices_in_entire_ph(
+                                                   atoms_in_one_fragment, ph)
+      fragment_super_atoms_in_ph.append(atoms_in_one_fragment)
+      molecules_in_fragments.append(molecules_in_one_fragment)
+      atoms = self.pdb_hierarchy_super.atoms()
+      check_selection_integrity(atoms, atoms_in_one_cluster)
+    # print "cluster->fragments done"
+    if(self.two_buffers):## define a second buffer layer
+      # print "adding second layer"
+      fragment_super_atoms_in_ph = []
+      for molecules in molecules_in_fragments:
+        junk1,atoms_in_one_fragment,junk2 = interactions(molecules)
+        atoms_in_one_fragment = selected_atom_indices_in_entire_ph(
+                                                   atoms_in_one_fragment, ph)
+        fragment_super_atoms_in_ph.append(atoms_in_one_fragment)
+    return cluster_atoms_in_ph, fragment_super_atoms_in_ph, \
+      molecules_in_fragments
 
+  def get_fragments(self):
+    self.bonded_to_altloc = None
     self.pdb_hierarchy_super.atoms_reset_serial()
     phs = [self.pdb_hierarchy_super]
     altloc_size = self.pdb_hierarchy_super.altloc_indices().size()
@@ -160,37 +463,10 @@ class fragments(object):
     ##loop over each cluster in every pdb_hierarchy to define buffer region
     ##fragment consists of cluster and buffer
     ##all pdb_hierarchies have the same clusters at molecular level
-    for ph in phs:
-      cluster_atoms_in_ph = []
-      fragment_super_atoms_in_ph = []
-      molecules_in_fragments = []
-      for i in range(len(clusters)):
-        # print 'processing cluster', i
-        atoms_in_one_cluster, atoms_in_one_fragment, molecules_in_one_fragment = \
-          pair_interaction.run(copy.deepcopy(ph), clusters[i])  ##deepcopy
-        # print("clusters[i]",clusters[i])
-        # print("molecules_in_one_fragment:", molecules_in_one_fragment)
-        # print("atoms_in_one_fragment",atoms_in_one_fragment)
-
-        atoms_in_one_cluster = selected_atom_indices_in_entire_ph(
-                                                    atoms_in_one_cluster, ph)
-        cluster_atoms_in_ph.append(atoms_in_one_cluster)
-
-        atoms_in_one_fragment = selected_atom_indices_in_entire_ph(
-                                                     atoms_in_one_fragment, ph)
-        fragment_super_atoms_in_ph.append(atoms_in_one_fragment)
-        molecules_in_fragments.append(molecules_in_one_fragment)
-        atoms = self.pdb_hierarchy_super.atoms()
-        check_selection_integrity(atoms, atoms_in_one_cluster)
-      # print "cluster->fragments done"
-      if(self.two_buffers):## define a second buffer layer
-        # print "adding second layer"
-        fragment_super_atoms_in_ph = []
-        for molecules in molecules_in_fragments:
-          junk1,atoms_in_one_fragment,junk2 = pair_interaction.run(copy.deepcopy(ph),molecules)
-          atoms_in_one_fragment = selected_atom_indices_in_entire_ph(
-                                                     atoms_in_one_fragment, ph)
-          fragment_super_atoms_in_ph.append(atoms_in_one_fragment)
+    for i_ph, ph in enumerate(phs):
+      cluster_atoms_in_ph, fragment_super_atoms_in_ph, molecules_in_fragments =\
+        self._get_fragment_atoms(ph, clusters)
+      if(i_ph==0): self.molecules_in_fragments = molecules_in_fragments
       cluster_atoms_in_phs.append(cluster_atoms_in_ph)
       fragment_super_atoms_in_phs.append(fragment_super_atoms_in_ph)
     #
@@ -263,7 +539,7 @@ class fragments(object):
     for i_cluster, overlap_cluster in overlap_clusters.items():
       overlap_atoms = overlap_atoms+list(itertools.chain.from_iterable(
         overlap_cluster +[self.cluster_atoms[i_cluster]]))#[atom_index, atom_index]
-    frequency_overlap_atoms =  {x:overlap_atoms.count(x) for x in overlap_atoms}#{atom_index,frequency}
+    frequency_overlap_atoms = collections.Counter(overlap_atoms)#{atom_index,frequency}
     for i_cluster, clusters in overlap_clusters.items():
       ## reset the fragment scale for the ith fragment in ph[0]
       for index, atom in enumerate([i for i in self.fragment_super_atoms[i_cluster]
@@ -285,20 +561,35 @@ class fragments(object):
          self.cluster_atoms.append(clusters[index])
          self.fragment_super_atoms.append(fragment_super)
          self.fragment_scales.append(scale_list)
+    ## each distinct fragment is computed once
+    self.cluster_atoms, self.fragment_super_atoms, self.fragment_scales, \
+      self.fragment_multiplicities = deduplicate_fragments(
+        cluster_atoms        = self.cluster_atoms,
+        fragment_super_atoms = self.fragment_super_atoms,
+        fragment_scales      = self.fragment_scales,
+        system_size          = self.system_size)
+    n_merged = sum(self.fragment_multiplicities)-len(self.cluster_atoms)
+    if(n_merged>0):
+      print("%d duplicate fragment(s) merged, %d distinct fragments"%(
+        n_merged, len(self.cluster_atoms)))
+
+  def get_bonded_to_altloc_mask(self, bond_distance=1.7):
+    """
+    Atoms of pdb_hierarchy closer than bond_distance to an altloc atom
+    (altloc atoms included), found with a neighbour grid.
+    """
+    altloc_indices = [i for i, atom in enumerate(self.pdb_hierarchy.atoms())
+                        if atom.pdb_label_columns()[4]!=" "]
+    return contact_index(self.pdb_hierarchy, cell_size=bond_distance).\
+      atoms_within(altloc_indices, bond_distance)
 
   def bond_with_altloc(self, atom_index, bond_with_altloc_flag):
     if(not bond_with_altloc_flag): return False
-    ph_atoms = list(self.pdb_hierarchy.atoms())
-    ph_atom = ph_atoms[atom_index-1]
-    bond = False
-    for altloc_atom in self.altloc_atoms:
-      distance = ph_atom.distance(altloc_atom)
-      if(distance<1.7):
-        bond =True
-        break
-      ##TODO
-      ##check bond, better from bond topology
-    return bond
+    ##TODO
+    ##check bond, better from bond topology
+    if(self.bonded_to_altloc is None):
+      self.bonded_to_altloc = self.get_bonded_to_altloc_mask()
+    return bool(self.bonded_to_altloc[atom_index-1])
 
   def atoms_overlap(self, cluster_atoms_in_phs, i_cluster, j_ph):
     overlap_atoms_in_one_cluster = set(cluster_atoms_in_phs[0][i_cluster]) & \
@@ -313,54 +604,120 @@ class fragments(object):
                           for i in fragment_super_atoms_in_phs[j_ph][i_cluster])
     self.fragment_scales.append(scale_list)
 
-  def get_fragment_hierarchies_and_charges(self):
+  def _get_fragment_plan(self, cluster_atoms, fragment_super_atoms,
+                         fragment_scales, fragment_multiplicities=None):
+    return fragment_plan(
+      cluster_atoms           = cluster_atoms,
+      fragment_super_atoms    = fragment_super_atoms,
+      fragment_scales         = fragment_scales,
+      system_size             = self.system_size,
+      super_size              = self.pdb_hierarchy_super.atoms_size(),
+      fragment_multiplicities = fragment_multiplicities)
+
+  def _set_up_fragment(self, plan, i):
+    """
+    Selections, initial capped hierarchy and charge of fragment i of plan.
+    """
+    fragment_selection = plan.fragment_selection(i)
+    ## QM part is fragment_super
+    fragment_super_selection = plan.fragment_super_selection(i)
+    fragment_super_hierarchy = self.pdb_hierarchy_super.select(
+      fragment_super_selection)
+    charge_hierarchy = completion.run(pdb_hierarchy=fragment_super_hierarchy,
+                    crystal_symmetry=self.expansion.cs_box,
+                    model_completion=False,
+                    original_pdb_filename=self.expansion_file)
+    cluster_selection = plan.cluster_selection(i)
+    s = fragment_selection==cluster_selection
+    buffer_selection = fragment_selection.deep_copy().set_selected(s, False)
+    check_hierarchy(fragment_super_hierarchy)
+    capping = None
+    if(self.fast_capping or self.whole_system_charges):
+      capping = capping_template(
+        capped_hierarchy = charge_hierarchy,
+        fragment_indices = plan.fragment(i),
+        super_sites_cart = self.pdb_hierarchy_super.atoms().extract_xyz())
+      if(not capping.valid): capping = None
+    self.charge_service = None
+    if(self.whole_system_charges and capping is not None):
+      if(self.super_formal_charges is None):
+        self.super_formal_charges = self.get_super_formal_charges()
+      if(self.super_formal_charges is not False):
+        self.charge_service = self.fragment_charge_from_formal_charges(
+          plan.fragment(i), capping)
+    if(self.charge_service is None):
+      self.charge_service = charges_class(
+        pdb_hierarchy=charge_hierarchy,
+        crystal_symmetry=self.expansion.cs_box).get_total_charge()
+    if(not self.fast_capping): capping = None
+    return dict(
+      fragment_selections       = fragment_selection,
+      fragment_super_selections = fragment_super_selection,
+      fragment_charges          = self.charge_service,
+      cluster_selections        = cluster_selection,
+      buffer_selections         = buffer_selection,
+      fragment_capped_initial   = charge_hierarchy,
+      fragment_capping          = capping)
+
+  def get_super_formal_charges(self):
+    """
+    Formal charge of each atom of pdb_hierarchy_super, from a single
+    formal-charge pass over the capped super-sphere. False if that fails.
+    """
+    try:
+      capped_super = completion.run(pdb_hierarchy=self.pdb_hierarchy_super,
+                      crystal_symmetry=self.expansion.cs_box,
+                      model_completion=False,
+                      original_pdb_filename=self.expansion_file)
+      atom_valences = charges_class(
+        pdb_hierarchy=capped_super,
+        crystal_symmetry=self.expansion.cs_box).get_total_charge(
+          list_charges=True)
+    except Sorry as e:
+      print("whole-system formal charges failed, using per-fragment charges:",
+        str(e))
+      return False
+    xyz = self.pdb_hierarchy_super.atoms().extract_xyz().as_numpy_array()
+    elements = self.pdb_hierarchy_super.atoms().extract_element()
+    result = np.zeros(xyz.shape[0], dtype=np.int64)
+    for atom, electrons in atom_valences.get_charged_atoms():
+      d = np.sqrt(((xyz-np.array(atom.xyz))**2).sum(axis=1))
+      i = int(np.argmin(d))
+      if(d[i] > 0.01 or elements[i].strip() != atom.element.strip()):
+        continue # capping atom
+      result[i] = -electrons
+    return result
 
-    def pdb_hierarchy_select(atoms_size, selection):
-      selection_array = flex.bool(atoms_size, False)
-      for item in selection:
-        if(item<=atoms_size):
-          selection_array[item-1] = True
-      return selection_array
+  def fragment_charge_from_formal_charges(self, fragment_indices, capping):
+    """
+    Charge of a fragment as the sum of the whole-system formal charges of its
+    atoms. A link hydrogen that replaces a bond to a metal neutralizes the
+    charge its parent atom carries in the whole system.
+    """
+    fragment = np.array(list(fragment_indices), dtype=np.int64)
+    charge = int(self.super_formal_charges[fragment].sum())
+    elements = self.pdb_hierarchy_super.atoms().extract_element()
+    properties = atom_property()
+    for parent, partner in zip(capping.link_parent, capping.link_partner):
+      if(properties.is_metal(elements[int(partner)].strip())):
+        charge -= int(self.super_formal_charges[fragment[parent]])
+    return charge
 
+  def get_fragment_hierarchies_and_charges(self):
     self.fragment_selections = []
     self.fragment_super_selections = []
     self.fragment_charges = []
     self.cluster_selections = []
     self.buffer_selections = []
-    self.cluster_selections = []
     self.fragment_capped_initial = []
-    for i in range(len(self.fragment_super_atoms)):
-      fragment_selection = pdb_hierarchy_select(
-          self.pdb_hierarchy.atoms_size(),
-          self.fragment_super_atoms[i])
-      ## QM part is fragment_super
-      fragment_super_selection = pdb_hierarchy_select(
-        self.pdb_hierarchy_super.atoms_size(),
-        self.fragment_super_atoms[i])
-      fragment_super_hierarchy = self.pdb_hierarchy_super.select(
-        fragment_super_selection)
-      charge_hierarchy = completion.run(pdb_hierarchy=fragment_super_hierarchy,
-                      crystal_symmetry=self.expansion.cs_box,
-                      model_completion=False,
-                      original_pdb_filename=self.expansion_file)
-      self.fragment_capped_initial.append(charge_hierarchy)
-      raw_records = charge_hierarchy.as_pdb_string(
-        crystal_symmetry=self.expansion.cs_box)
-
-      self.charge_service = charges_class(
-        pdb_hierarchy=charge_hierarchy,
-        crystal_symmetry=self.expansion.cs_box).get_total_charge()
-      self.fragment_super_selections.append(fragment_super_selection)
-      #
-      self.fragment_selections.append(fragment_selection)
-      self.fragment_charges.append(self.charge_service)
-      cluster_selection = pdb_hierarchy_select(
-        self.pdb_hierarchy.atoms_size(), self.cluster_atoms[i])
-      self.cluster_selections.append(cluster_selection)
-      s = fragment_selection==cluster_selection
-      buffer_selection = fragment_selection.deep_copy().set_selected(s, False)
-      self.buffer_selections.append(buffer_selection)
-      check_hierarchy(fragment_super_hierarchy)
+    self.fragment_capping = []
+    self.fragment_plan = self._get_fragment_plan(
+      self.cluster_atoms, self.fragment_super_atoms, self.fragment_scales,
+      self.fragment_multiplicities)
+    for i in range(self.fragment_plan.n_fragments):
+      f = self._set_up_fragment(self.fragment_plan, i)
+      for name, value in f.items():
+        getattr(self, name).append(value)
 
   def get_fragment_extracts(self):
     return group_args(
@@ -369,6 +726,7 @@ class fragments(object):
       fragment_selections       = self.fragment_selections,
       fragment_super_selections = self.fragment_super_selections,
       fragment_capped_initial   = self.fragment_capped_initial,
+      fragment_capping          = self.fragment_capping,
       working_folder            = self.working_folder,
       fragment_super_atoms      = self.fragment_super_atoms,
       cluster_atoms             = self.cluster_atoms,
@@ -380,6 +738,7 @@ class fragments(object):
       expansion_cs              = self.expansion.cs_box,
       buffer_selections         = self.buffer_selections,
       fragment_scales           = self.fragment_scales,
+      fragment_plan             = self.fragment_plan,
       debug                     = self.debug,
       charge_service            = self.charge_service,
       charge_cutoff             = self.charge_cutoff,
@@ -403,15 +762,47 @@ def get_qm_file_name_and_pdb_hierarchy(fragment_extracts, index):
       file_name=qm_pdb_file,
       crystal_symmetry=fragment_extracts.expansion_cs)
   # re-capping because geometry of the fragment has changed.
-  ph = completion.run(pdb_hierarchy=fragment_hierarchy,
-                      crystal_symmetry=fragment_extracts.expansion_cs,
-                      model_completion=False,
-                      original_pdb_filename=fragment_extracts.expansion_file)
+  capping = fragment_extracts.fragment_capping[index]
+  if(capping is not None):
+    ph = capping.capped_hierarchy(
+      capped_initial   = fragment_extracts.fragment_capped_initial[index],
+      super_sites_cart = fragment_extracts.pdb_hierarchy_super.atoms().\
+        extract_xyz())
+  else:
+    ph = completion.run(pdb_hierarchy=fragment_hierarchy,
+                        crystal_symmetry=fragment_extracts.expansion_cs,
+                        model_completion=False,
+                        original_pdb_filename=fragment_extracts.expansion_file)
   # we now want this file by default
   ph.write_pdb_file(file_name=complete_qm_pdb_file,
                     crystal_symmetry=fragment_extracts.expansion_cs)
   return os.path.abspath(complete_qm_pdb_file), ph
 
+def get_fragment_symbols_and_positions(fragment_extracts, index):
+  """
+  Element symbols and coordinates (numpy array) of capped fragment index for
+  the current super-sphere coordinates, without writing files.
+  """
+  ph = fragment_extracts.fragment_capped_initial[index]
+  capping = fragment_extracts.fragment_capping[index]
+  if(capping is not None):
+    sites_cart = capping.sites_cart(
+      fragment_extracts.pdb_hierarchy_super.atoms().extract_xyz())
+  else:
+    ph = completion.run(pdb_hierarchy=fragment_extracts.pdb_hierarchy_super.\
+                          select(fragment_extracts.fragment_super_selections[index]),
+                        crystal_symmetry=fragment_extracts.expansion_cs,
+                        model_completion=False,
+                        original_pdb_filename=fragment_extracts.expansion_file)
+    sites_cart = ph.atoms().extract_xyz()
+  symbols = []
+  for element in ph.atoms().extract_element():
+    element = element.strip()
+    if(len(element) == 2):
+      element = element[0] + element[1].lower()
+    symbols.append(element)
+  return symbols, sites_cart.as_numpy_array()
+
 def charge(fragment_extracts, index):
   return fragment_extracts.fragment_charges[index]
 
@@ -6,14 +6,21 @@ import warnings
 warnings.filterwarnings('ignore', module='aimnet2calc')
 
 import numpy as np
+import torch
 import ase.units as ase_units
 from aimnet2calc import AIMNet2ASE
-
+from . import models
 
 
 class AIMNet2Calculator(AIMNet2ASE):
     """ Modification of the AIMNet2ASE class to work with Q|R.
     """
+    def __init__(self, base_calc='aimnet2', **kwargs):
+        # one model per name and process, shared by all calculators
+        if isinstance(base_calc, str):
+            base_calc = models.aimnet2(base_calc)
+        super(AIMNet2Calculator, self).__init__(base_calc, **kwargs)
+
     def run_qr(self, atoms, coordinates, charge, pointcharges, define_str=None):
         """
         This method is called every time an energy and forces are needed.
@@ -38,3 +45,36 @@ class AIMNet2Calculator(AIMNet2ASE):
             # print(("AIMNet2: ",self.method))
             print(('Energy:',self.energy_free))
             print(('Force:', self.forces))
+
+    def run_qr_batch(self, atoms_list, charges):
+        """
+        Energies and forces of several molecules in one forward/backward pass.
+        The molecules are flattened into one set of atoms with molecule
+        indices, as the AIMNet2 calculator takes batches of molecules of
+        different size.
+        Args:
+        atoms_list (list of ase.atoms.Atoms) the molecules.
+        charges (list of int) the charge of each molecule.
+        Returns:
+        list of (energy_free, forces) per molecule, in the units of run_qr.
+        """
+        sizes = [len(atoms) for atoms in atoms_list]
+        device = self.base_calc.device
+        results = self.base_calc({
+            'coord': torch.tensor(np.concatenate(
+                [atoms.get_positions() for atoms in atoms_list]),
+                dtype=torch.float32, device=device),
+            'numbers': torch.tensor(np.concatenate(
+                [atoms.get_atomic_numbers() for atoms in atoms_list]),
+                dtype=torch.int64, device=device),
+            'mol_idx': torch.tensor(np.repeat(np.arange(len(sizes)), sizes),
+                dtype=torch.int64, device=device),
+            'charge': torch.tensor(charges, dtype=torch.float32, device=device),
+            'mult': torch.ones(len(sizes), dtype=torch.float32, device=device),
+        }, forces=True)
+        energies = results['energy'].detach().cpu().numpy()
+        forces = results['forces'].detach().cpu().numpy().astype(np.float64)
+        unit_convert = ase_units.kcal / ase_units.mol
+        return [(float(energy) * unit_convert, f * unit_convert)
+                for energy, f in zip(energies,
+                                     np.split(forces, np.cumsum(sizes)[:-1]))]
@@ -8,16 +8,13 @@ import os
 import numpy as np
 import ase.units as ase_units
 from ase.calculators.calculator import Calculator, all_changes
-import torch
-import torch.nn.functional as F
-import numba
-from numba import cuda
 import libtbx.load_env
 from libtbx import easy_run
 from scitbx.array_family import flex
 from libtbx import easy_mp
 import traceback
 from libtbx.utils import Sorry
+from . import models
 
 def find_model(name, path):
     for root, dirs, files in os.walk(path):
@@ -25,15 +22,20 @@ def find_model(name, path):
             return os.path.join(root, name)
 
 
-qrefine = libtbx.env.find_in_repositories("qrefine")
 model="aimnet2_qr_b97m_cpcm_230419_0.jpt"
-MODEL_FILE=find_model(model,qrefine)
-DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-MODEL = torch.jit.load(MODEL_FILE).to(DEVICE)
 
+# imported by the first calculator, see _import()
+torch = F = numba = cuda = None
 
-### dense neighbor matrix kernels
-@numba.njit(cache=True, parallel=True)
+def get_model():
+    """The model, looked up and loaded by the first calculator."""
+    def load():
+        qrefine = libtbx.env.find_in_repositories("qrefine")
+        return torch.jit.load(find_model(model, qrefine)).to(models.device())
+    return models.get(('aimnet2-old', model), load)
+
+
+### dense neighbor matrix kernels, compiled with numba by _import()
 def _cpu_dense_nb_mat_sft(conn_matrix):
     N, S = conn_matrix.shape[:2]
     # figure out max number of neighbors
@@ -58,7 +60,6 @@ def _cpu_dense_nb_mat_sft(conn_matrix):
     return mat_idxj, mat_pad, mat_S_idx
 
 
-@numba.njit(cache=True, parallel=True)
 def _cpu_dense_nb_mat(conn_matrix):
     N = conn_matrix.shape[0]
     # figure out max number of neighbors
@@ -79,7 +80,6 @@ def _cpu_dense_nb_mat(conn_matrix):
     return mat_idxj, mat_pad
 
 
-@cuda.jit(cache=True)
 def _cuda_dense_nb_mat_sft(conn_matrix, mat_idxj, mat_pad, mat_S_idx):
     i = cuda.grid(1)
     if i < conn_matrix.shape[0]:
@@ -93,7 +93,6 @@ def _cuda_dense_nb_mat_sft(conn_matrix, mat_idxj, mat_pad, mat_S_idx):
                     k += 1
 
 
-@cuda.jit(cache=True)
 def _cuda_dense_nb_mat(conn_matrix, mat_idxj, mat_pad):
     i = cuda.grid(1)
     if i < conn_matrix.shape[0]:
@@ -105,6 +104,27 @@ def _cuda_dense_nb_mat(conn_matrix, mat_idxj, mat_pad):
                 k += 1
 
 
+def _import():
+    """
+    Import torch and numba and set up the neighbour list kernels above. Done
+    by the first calculator, so that importing this module does not.
+    """
+    global torch, F, numba, cuda
+    global _cpu_dense_nb_mat_sft, _cpu_dense_nb_mat
+    global _cuda_dense_nb_mat_sft, _cuda_dense_nb_mat
+    if numba is not None:
+        return
+    import torch
+    import torch.nn.functional as F
+    import numba
+    from numba import cuda
+    cpu_jit = numba.njit(cache=True, parallel=True)
+    _cpu_dense_nb_mat_sft = cpu_jit(_cpu_dense_nb_mat_sft)
+    _cpu_dense_nb_mat = cpu_jit(_cpu_dense_nb_mat)
+    _cuda_dense_nb_mat_sft = cuda.jit(cache=True)(_cuda_dense_nb_mat_sft)
+    _cuda_dense_nb_mat = cuda.jit(cache=True)(_cuda_dense_nb_mat)
+
+
 class AIMNet2CalculatorOLD(Calculator):
     """ ASE calculator for AIMNet2 model
     Arguments:
@@ -119,8 +139,9 @@ class AIMNet2CalculatorOLD(Calculator):
 
     def __init__(self, cutoff=None, use_coulomb=False, use_pbc=False, coulomb_cutoff=15.0):
         super().__init__()
-        self.device = DEVICE  
-        self.model = MODEL
+        _import()
+        self.device = models.device()
+        self.model = get_model()
         if cutoff is None:
             cutoff = max(v.item() for k, v in self.model.state_dict().items() if k.endswith('aev.rc_s'))
         self.cutoff = float(cutoff)
@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 from ase.calculators import calculator
+from ase.calculators.calculator import Calculator
 from ase import units
 
 # from torchani
@@ -82,7 +83,9 @@ class ANI_interface(object):
         tensors_out.append(E)
 
         if flag > 0:
-            F = - torch.autograd.grad(E, R, retain_graph=flag == 2)[0]
+            # molecules of a batch are independent: the gradients of the sum
+            # are the gradients of each energy
+            F = - torch.autograd.grad(E.sum(), R, retain_graph=flag == 2)[0]
             tensors_out.append(F)
 
         if flag == 2:
@@ -119,8 +122,6 @@ class ANIRPCCalculator(Calculator):
         Z = self.atoms.get_atomic_numbers()[None, ...].astype(np.uint8)
         pbc = self.atoms.get_pbc().astype(np.bool_)
         cell = self.atoms.get_cell(complete=True).astype(np.float32)
-        pbc = False
-        print(pbc,cell)
 
         results = self.interface.run(calc_type, R, Z, pbc, cell)
         self.results['energy'] = self.results['free_energy'] = results[0][0] * units.Hartree
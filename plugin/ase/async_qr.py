@@ -0,0 +1,129 @@
+"""
+Running the programs of the file based QM engines (MOPAC, ORCA, xtb,
+Gaussian, Turbomole) without changing the working directory of the process.
+
+An engine describes a calculation as a generator, qr_job(atoms, **kwargs):
+it writes the input files, yields (command, directory) for each program to
+run, receives the error output of the program and reads the results.
+
+  run(job)                    runs the programs one after the other (run_qr)
+  submit(engine, atoms, ...)  awaitable run_qr of a job copy of the engine,
+                              the programs run as asyncio subprocesses
+  gather(submissions, n)      runs awaitables with at most n in flight
+
+For example, all fragments of a step from one process:
+
+  submissions = []
+  for atoms, label in fragments:
+    engine.set_label(label)
+    submissions.append(engine.submit_qr(atoms, charge=0, pointcharges=None,
+      coordinates=label+".xyz", define_str=""))
+  for job in async_qr.gather(submissions, max_in_flight=8):
+    print(job.energy_free, job.forces)
+"""
+from __future__ import print_function
+import os
+import copy
+import asyncio
+import subprocess
+
+
+def check(command, directory, returncode, stdout, stderr):
+    if returncode != 0:
+        print('shell output: ', stdout, stderr)
+        raise RuntimeError('%s exited with error code %i in %s' % (
+            command, returncode, directory or os.getcwd()))
+    return stderr
+
+
+def run_command(command, directory=None):
+    """
+    Runs command in directory and waits for it; returns its error output.
+    Raises RuntimeError if it failed.
+    """
+    proc = subprocess.Popen(command, shell=True, cwd=directory,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    stdout, stderr = proc.communicate()
+    return check(command, directory, proc.returncode, stdout, stderr)
+
+
+async def run_command_async(command, directory=None):
+    """run_command as a coroutine: other jobs go on while command runs."""
+    proc = await asyncio.create_subprocess_shell(command, cwd=directory,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    return check(command, directory, proc.returncode,
+        stdout.decode(errors='replace'), stderr.decode(errors='replace'))
+
+
+def run(job):
+    """Runs the generator of qr_job() to the end."""
+    output = None
+    while True:
+        try:
+            command, directory = job.send(output)
+        except StopIteration:
+            return
+        output = run_command(command, directory)
+
+
+async def run_async(job, engine):
+    output = None
+    while True:
+        try:
+            command, directory = job.send(output)
+        except StopIteration:
+            return engine
+        output = await run_command_async(command, directory)
+
+
+# atoms and results of the previous run, not carried over to a job copy
+results = ['atoms', 'energy_zero', 'energy_free', 'forces', 'stress',
+           'results', 'e_au', 'e_total']
+
+
+def job_copy(engine):
+    """
+    Copy of the engine for one job: its own label and parameters (dicts and
+    lists are copied), without the atoms and results of earlier runs.
+    """
+    job = copy.copy(engine)
+    for name, value in vars(engine).items():
+        if name in results:
+            setattr(job, name, type(value)() if isinstance(value, dict)
+                    else None)
+        elif isinstance(value, (dict, list)):
+            setattr(job, name, copy.deepcopy(value))
+    return job
+
+
+def submit(engine, atoms, **kwargs):
+    """
+    run_qr(atoms, **kwargs) of a job copy of the engine, as an awaitable. The
+    copy is taken now: the engine can be given the label of the next job
+    right away. The result is the copy, with energy_free and forces.
+    """
+    engine = job_copy(engine)
+    return run_async(engine.qr_job(atoms, **kwargs), engine)
+
+
+def gather(submissions, max_in_flight=None):
+    """
+    Results of the awaitables of submit(), in order, with at most
+    max_in_flight of them running at the same time. A failed job gives its
+    exception instead of a result.
+    """
+    submissions = list(submissions)
+
+    async def limited(semaphore, submission):
+        async with semaphore:
+            return await submission
+
+    async def main():
+        semaphore = asyncio.Semaphore(max_in_flight or max(1, len(submissions)))
+        return await asyncio.gather(
+            *[limited(semaphore, submission) for submission in submissions],
+            return_exceptions=True)
+
+    return asyncio.run(main())
@@ -21,6 +21,8 @@ from __future__ import print_function
 import os
 
 from ase.calculators.calculator import FileIOCalculator, Parameters, ReadError
+from . import warm_start
+from . import async_qr
 
 """
 Gaussian has two generic classes of keywords:  link0 and route.
@@ -162,10 +164,15 @@ class Gaussian(FileIOCalculator):
         self.addsec = addsec
         self.forces = None
         self.energy_free = None
+        # keep a checkpoint file and read the guess from it (guess=read)
+        self.warm_start = False
 
-        if command: self.command = command
-
-    def get_command(self): return self.command
+    def get_command(self):
+        # ASE >= 3.23 keeps the command in a profile
+        profile = getattr(self, 'profile', None)
+        if profile is not None:
+            return profile.command
+        return self.command
 
     def set(self, **kwargs):
         changed_parameters = FileIOCalculator.set(self, **kwargs)
@@ -323,14 +330,46 @@ class Gaussian(FileIOCalculator):
     def get_version(self):
         return self.read_output(self.label + '.log', 'version')
 
+    def set_restart(self, atoms):
+        """Checkpoint file per label, guess=read if it is for the same atoms"""
+        if not self.warm_start:
+            return
+        self.parameters['chk'] = os.path.basename(self.label) + '.chk'
+        if warm_start.restart_available(self.label, atoms,
+            self.parameters['charge'], [self.label + '.chk']):
+            self.parameters['guess'] = 'read'
+        else:
+            self.parameters.pop('guess', None)
+
     def run_qr(self, atoms_new, **kwargs):
+        async_qr.run(self.qr_job(atoms_new, **kwargs))
+
+    def submit_qr(self, atoms_new, **kwargs):
+        """Awaitable run_qr, see async_qr.submit()"""
+        return async_qr.submit(self, atoms_new, **kwargs)
+
+    def qr_job(self, atoms_new, **kwargs):
+        """
+        run_qr in steps, see async_qr: calculate() with the Gaussian command
+        run in the directory of the label.
+        """
         #print "atoms new",len(atoms_new)
         self.atoms=atoms_new
         self.set(**kwargs)
-        self.calculate(atoms=atoms_new)
+        self.set_restart(atoms_new)
+        command = self.get_command()
+        if command is None:
+            raise RuntimeError('Gaussian command not specified')
+        self.atoms = atoms_new.copy()
+        self.write_input(self.atoms)
+        yield command.replace('PREFIX', self.prefix), self.directory
+        self.read_results()
         #print "forces are ",self.results['forces']
         self.forces=self.results['forces']
         self.energy_free = self.results['energy']
+        if self.warm_start:
+            warm_start.restart_written(self.label, atoms_new,
+              self.parameters['charge'])
 
     # Q|R requirements
     def set_charge(self, charge):
@@ -348,6 +387,9 @@ class Gaussian(FileIOCalculator):
     def set_nproc(self, nproc):
       self.parameters['nprocshared'] = nproc
 
+    def set_warm_start(self, warm_start):
+      self.warm_start = warm_start
+
 if __name__ == '__main__':
   import sys
   label = sys.argv[1]
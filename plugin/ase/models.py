@@ -0,0 +1,60 @@
+"""
+Weights of the ML engines (TorchANI, AIMNet2), loaded on first use and kept
+for the lifetime of the process.
+
+All calculators of a process share one copy of a model. Engines are created
+in the main process, so the weights are loaded there once and forked fragment
+workers share them copy-on-write instead of loading them again. Importing a
+plugin does not import torch or load weights.
+"""
+from __future__ import print_function
+import os
+import time
+
+_models = {}
+load_times = {}
+
+
+def get(key, loader):
+    """Model key, from loader() the first time it is asked for."""
+    if key not in _models:
+        t0 = time.time()
+        _models[key] = loader()
+        load_times[key] = time.time() - t0
+    return _models[key]
+
+
+def loaded():
+    return list(_models.keys())
+
+
+def clear():
+    _models.clear()
+    load_times.clear()
+
+
+def device():
+    import torch
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def torchani(file_name):
+    """TorchScript ANI model, parameters frozen."""
+    def load():
+        import torch
+        if not os.path.isfile(file_name):
+            raise IOError('TorchANI model file not found: %s' % file_name)
+        model = torch.jit.load(file_name, map_location=device())
+        for p in model.parameters():
+            p.requires_grad_(False)
+        return model
+    return get(('torchani', file_name), load)
+
+
+def aimnet2(name):
+    """aimnet2calc base calculator of the AIMNet2 model name."""
+    def load():
+        from aimnet2calc import AIMNet2Calculator
+        return AIMNet2Calculator(name)
+    return get(('aimnet2', name), load)
+
@@ -0,0 +1,102 @@
+"""
+In-process MOPAC through the API of the MOPAC shared library (libmopac, as
+packaged by mopactools: pip install mopactools).
+
+Same run_qr contract as mopac_qr.Mopac, without input files, a subprocess
+per calculation or parsing of text output. With warm_start the ground state
+of the previous calculation with the same label (fragment) is the initial
+guess while its atoms and charge are unchanged.
+"""
+from __future__ import print_function
+import collections
+import numpy as np
+
+from ase.units import kcal, mol
+from mopactools import api
+
+
+class MopacAPI(object):
+    name = 'MOPAC-API'
+
+    def __init__(self,
+                 label='ase',
+                 method='PM7',
+                 charge=0,
+                 epsilon=78.4,
+                 max_states=100):
+        self.label = label
+        self.method = method
+        self.charge = charge
+        # COSMO water, as EPS=78.4 of mopac_qr
+        self.epsilon = epsilon
+        # ground states kept for warm starts, least recently used dropped
+        self.warm_start = False
+        self.max_states = max_states
+        self.states = collections.OrderedDict()
+        # initialize the results
+        self.atoms = None
+        self.energy_zero = None
+        self.energy_free = None
+        self.forces = None
+
+    def get_system(self, atoms):
+        model = self.method.strip().upper()
+        if model not in api.MopacSystem.model_dict:
+            raise RuntimeError('MOPAC API: unknown model %s, use one of %s' % (
+                self.method, ' '.join(api.MopacSystem.model_dict)))
+        system = api.MopacSystem()
+        system.natom = len(atoms)
+        system.natom_move = len(atoms)
+        system.charge = int(self.charge)
+        system.model = model
+        system.epsilon = self.epsilon
+        system.atom = np.array(atoms.get_atomic_numbers(), dtype=np.int32)
+        system.coord = np.array(atoms.get_positions(), dtype=np.float64).ravel()
+        if atoms.pbc.any():
+            # no implicit solvent for periodic systems
+            system.epsilon = 1.0
+            system.nlattice = 3
+            system.lattice = np.array(atoms.get_cell(), dtype=np.float64).ravel()
+        return system
+
+    def get_state(self, system):
+        """Ground state of the previous calculation of this label, if any."""
+        signature = (system.charge, tuple(system.atom))
+        if self.warm_start:
+            previous = self.states.get(self.label)
+            if previous is not None and previous[0] == signature:
+                return signature, previous[1]
+        return signature, api.MopacState()
+
+    def run_qr(self, atoms_new, charge=None, **kwargs):
+        if charge is not None:
+            self.charge = charge
+        self.atoms = atoms_new.copy()
+        system = self.get_system(self.atoms)
+        signature, state = self.get_state(system)
+        properties = api.from_data(system, state)
+        if properties.error_msg:
+            raise RuntimeError('MOPAC API: ' + ' '.join(properties.error_msg))
+        if self.warm_start:
+            # most recently used last
+            self.states[self.label] = (signature, state)
+            self.states.move_to_end(self.label)
+            while len(self.states) > self.max_states:
+                self.states.popitem(last=False)
+        # heat of formation (kcal/mol) and its gradients, as read by mopac_qr
+        self.energy_zero = properties.heat * (kcal / mol)
+        self.energy_free = self.energy_zero
+        self.forces = -properties.coord_deriv.reshape(-1, 3) * (kcal / mol)
+
+    # Q|R requirements
+    def set_charge(self, charge):
+      self.charge = charge
+
+    def set_method(self, method):
+      self.method = method
+
+    def set_label(self, label):
+      self.label = label
+
+    def set_warm_start(self, warm_start):
+      self.warm_start = warm_start
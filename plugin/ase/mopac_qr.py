@@ -16,6 +16,8 @@ import platform
 
 from ase.units import kcal, mol
 from ase.calculators.general import Calculator
+from . import warm_start
+from . import async_qr
 
 str_keys = ['functional', 'job_type']
 int_keys = ['restart', 'spin', 'charge']
@@ -71,6 +73,9 @@ class Mopac(Calculator):
         self.calc_dir = None
         # initialize the results
         self.occupations = None
+        # reuse the density of the previous run (OLDENS)
+        self.warm_start = False
+        self.oldens = False
 
         # command
         self.command = self.get_command()
@@ -113,6 +118,12 @@ class Mopac(Calculator):
         if self.float_params['RELSCF'] != None:
             mopac_input += 'RELSCF=' + str(self.float_params['RELSCF']) + ' '
 
+        # write the density for the next run, start from the previous one
+        if self.warm_start:
+            mopac_input += 'DENOUT '
+        if self.oldens:
+            mopac_input += 'OLDENS '
+
         #write charge/
         # charge = sum(atoms.get_initial_charges())
         #if charge != 0:
@@ -176,57 +187,28 @@ class Mopac(Calculator):
       self.command = command
 
 
-    def run_command(self,command):
-        """
-        execute <command> in a subprocess and check error code
-        """
-        from subprocess import Popen, PIPE, STDOUT
-        if command == '':
-            raise RuntimeError('no command for run_command :(')
-        # print 'Running: ', command #debug
-        proc = Popen([command], shell=True, stderr=PIPE, stdout=PIPE)
-        proc.wait()
-        exitcode = proc.returncode
-        if exitcode != 0:
-            # print exitcode,'label:', self.calc_dir
-            error='%s exited with error code %i in %s' % (
-                           command,exitcode,self.calc_dir)
-            stdout,stderr = proc.communicate()
-            print('shell output: ',stdout,stderr)
-            raise RuntimeError(error)
-        return 0
-
     def run(self):
-        import subprocess, shlex
-        from threading import Timer
-
-        # def run_timeout(cmd, timeout_sec):
-        #   proc = subprocess.Popen(shlex.split(cmd),
-        #   # proc = subprocess.Popen(cmd, 
-        #                           stdout=subprocess.PIPE,
-        #                           shell=True,
-        #                           stderr=subprocess.PIPE)
-        #   kill_proc = lambda p: p.kill()
-        #   timer = Timer(timeout_sec, kill_proc, [proc])
-        #   try:
-        #     timer.start()
-        #     stdout,stderr = proc.communicate()
-        #     print(stdout,stderr)
-        #   finally:
-        #     timer.cancel()
-
         """
         Writes input in label.mop
         Runs MOPAC
         Reads Version, Energy and Forces
         """
+        async_qr.run(self.job())
+
+    def job(self):
+        """
+        run() in steps, see async_qr: yields the MOPAC command.
+        """
         # set the input file name
         finput = self.label + '.mop'
         foutput = self.label + '.out'
+        charge = self.int_params['charge']
+        self.oldens = self.warm_start and warm_start.restart_available(
+            self.label, self.atoms, charge, [self.label + '.den'])
         self.write_input(finput, self.atoms)
 
          # directory
-        self.calc_dir = os.getcwd()
+        self.calc_dir = os.path.dirname(os.path.abspath(finput))
 
         command = self.command
         if command is None:
@@ -241,20 +223,18 @@ class Mopac(Calculator):
         #        raise RuntimeError('MOPAC_DIR is not specified')
         #    command_exc= "LD_PRELOAD=%s/libiomp5.so %s  %s" % (mdir,command,finput)
         #if "Darwin" in WhatOS:
-        command_exc= "  ".join([command , finput])
-
-        # run_timeout(command_exc ,72000)# 20hours
-        self.run_command(command_exc)
-#        exitcode = os.system('%s %s' % (command, finput)+ '  > /dev/null 2>&1    ')
+        command_exc= "  ".join([command , os.path.basename(finput)])
 
-#        if exitcode != 0:
-#            raise RuntimeError('MOPAC exited with error code')
+        # run in calc_dir: MOPAC writes its other files there
+        yield command_exc, self.calc_dir
 
         self.version = self.read_version(foutput)
         energy = self.read_energy(foutput)
         self.energy_zero = energy
         self.energy_free = energy
         self.forces = self.read_forces(foutput)
+        if self.warm_start:
+            warm_start.restart_written(self.label, self.atoms, charge)
 
     def read_version(self, fname):
         """
@@ -365,6 +345,13 @@ class Mopac(Calculator):
             self.run()
 
     def run_qr(self, atoms_new, **kwargs):
+        async_qr.run(self.qr_job(atoms_new, **kwargs))
+
+    def submit_qr(self, atoms_new, **kwargs):
+        """Awaitable run_qr, see async_qr.submit()"""
+        return async_qr.submit(self, atoms_new, **kwargs)
+
+    def qr_job(self, atoms_new, **kwargs):
         for key in kwargs:
           if key in self.bool_params:
               self.bool_params[key] = kwargs[key]
@@ -375,7 +362,7 @@ class Mopac(Calculator):
           elif key in self.float_params:
               self.float_params[key] = kwargs[key]
         self.atoms = atoms_new.copy()
-        self.run()
+        return self.job()
 
     # Q|R requirements
     def set_charge(self, charge):
@@ -389,3 +376,6 @@ class Mopac(Calculator):
 
     def set_nproc(self, nproc):
       self.int_params['nproc'] = int(nproc)
+
+    def set_warm_start(self, warm_start):
+      self.warm_start = warm_start
@@ -11,7 +11,10 @@ from ase.io import write
 from ase.units import kcal, mol
 from ase.units import Hartree, Bohr
 from ase.calculators.general import Calculator
+from . import warm_start
+from . import async_qr
 import copy
+import shutil
 
 key_parameters = {'seed': 1351351,
                   'multibasis': '''Se lanl2dz_ecp
@@ -69,6 +72,9 @@ class Orca(Calculator):
         self.energy_free = None
         self.forces = None
         self.stress = None
+        # start from the orbitals of the previous run (MORead)
+        self.warm_start = False
+        self.moread = False
 
         self.command = self.get_command()
 
@@ -85,6 +91,10 @@ class Orca(Calculator):
             finput = open(fname, "w")
             #XY
             finput.write("! " + self.key_parameters['method'] + " " + self.key_parameters['basis']+ " EnGrad" + "\n" )
+            if self.moread:
+                finput.write("! MORead\n")
+                finput.write('%%moinp "%s"\n' % os.path.basename(
+                    self.label + '.guess.gbw'))
             if 'memory' in self.key_parameters:
               finput.write('%%MaxCore %s\n' % self.key_parameters['memory'])
             finput.write(" \n")
@@ -124,9 +134,22 @@ class Orca(Calculator):
                charge,
                pointcharges,
         ):
-        import subprocess
+        async_qr.run(self.qr_job(atoms, define_str, coordinates, charge,
+                                 pointcharges))
+
+    def submit_qr(self, atoms, **kwargs):
+        """Awaitable run_qr, see async_qr.submit()"""
+        return async_qr.submit(self, atoms, **kwargs)
+
+    def qr_job(self,
+               atoms,
+               define_str,
+               coordinates,
+               charge,
+               pointcharges,
+        ):
         """
-        Writes input in label.mop
+        Writes input in label.inp
         Runs ORCA
         Reads Version, Energy and Forces
         """
@@ -136,6 +159,11 @@ class Orca(Calculator):
         self.key_parameters['charge'] = charge
         finput = self.label + '.inp'
         foutput = self.label + '.out'
+        # ORCA does not read the orbitals from the .gbw it writes to
+        self.moread = self.warm_start and warm_start.restart_available(
+            self.label, self.atoms, charge, [self.label + '.gbw'])
+        if self.moread:
+            shutil.copyfile(self.label + '.gbw', self.label + '.guess.gbw')
         self.write_input(finput, self.atoms)
 
         working_dir = os.path.dirname(finput)
@@ -143,20 +171,21 @@ class Orca(Calculator):
         command = self.command
         if command is None:
             raise RuntimeError('Orca command not specified')
-        print ('%s %s' % (command, finput) + '  >     '+ foutput + '  2>&1')
+        # run in the directory of the label: ORCA writes its other files there
+        directory = os.path.dirname(os.path.abspath(finput))
+        command_exc = '%s %s' % (command, os.path.basename(finput)) + \
+            '  >     ' + os.path.basename(foutput) + '  2>&1'
+        print (command_exc)
 
-        # dry_run
-        if 0: assert 0
-
-        exitcode = os.system('%s %s' % (command, finput) + '  >     ' + foutput + '  2>&1')
-        if exitcode != 0:
-            raise RuntimeError('Orca exited with error code')
+        yield command_exc, directory
 
         energy = self.read_energy(foutput)
         self.energy_zero = energy
         self.energy_free = energy
 
         self.forces = self.read_forces(foutput,atoms)
+        if self.warm_start:
+            warm_start.restart_written(self.label, self.atoms, charge)
 
     def read_energy(self, fname):
         """
@@ -262,3 +291,6 @@ class Orca(Calculator):
     def set_memory(self, memory):
       self.key_parameters['memory'] = memory
 
+    def set_warm_start(self, warm_start):
+      self.warm_start = warm_start
+
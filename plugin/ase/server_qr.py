@@ -1,50 +1,166 @@
+import io
+import os
 import numpy as np
 import ase
 import time
 from ase import units
 from ase.calculators.calculator import Calculator, all_changes
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 
+def encode_arrays(**arrays):
+    """numpy arrays as one binary payload (npz, no pickles)."""
+    f = io.BytesIO()
+    np.savez(f, **arrays)
+    return f.getvalue()
+
+
+def decode_arrays(data):
+    with np.load(io.BytesIO(data), allow_pickle=False) as f:
+        return dict((k, f[k]) for k in f.files)
+
+
+def batch_arrays(atoms_list, charges, dtype=np.float64):
+    """
+    Request arrays of a batch of molecules: atoms of all molecules one after
+    the other, with the number of atoms of each molecule.
+    """
+    return dict(
+        species=np.concatenate(
+            [atoms.get_atomic_numbers() for atoms in atoms_list]).astype(np.int32),
+        coordinates=np.concatenate(
+            [atoms.get_positions() for atoms in atoms_list]).astype(dtype),
+        sizes=np.array([len(atoms) for atoms in atoms_list], dtype=np.int32),
+        charges=np.array(charges, dtype=np.int32))
+
+
 class RestAPICalculator(Calculator):
     """ASE calculator for a RestAPI server.
     Arguments:
     url: <hostname:port> of the server
+    payload: json (one /calc request per molecule), binary (batches of
+      molecules per /calc_batch request as npz arrays) or float32 (binary in
+      single precision)
+    batch_size: molecules per /calc_batch request, all if None
+    max_in_flight: requests sent at the same time
     Server API requirement:
     /calc: accepts atomic numbers and atomic coordinate lists as json and return energy and forces (POST)
+    /calc_batch (optional): accepts npz arrays species, coordinates, sizes and
+      charges of a batch of molecules, returns npz arrays energy (per molecule)
+      and forces (POST). Without it the calculator falls back to /calc.
     The user is responsible to load the ML model at the server before running QR!
+    qr.server (command_line/server.py) is such a server for aimnet2 and torchani.
+    One HTTP session (keep-alive connections) is kept per process.
     ToDo:
-     - charges
      - pointcharges
      - energy-only (current server does not support it)
     """
 
     implemented_properties = ["energy", "forces"]
+    content_type = "application/x-npz"
 
-    def __init__(self, url=None):
+    def __init__(self, url=None, payload="binary", batch_size=None,
+                 max_in_flight=4):
         super().__init__()
         self.url = url
+        if payload not in ["json", "binary", "float32"]:
+            raise ValueError("unknown payload %s" % payload)
+        self.payload = payload
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.session = None
+        self.session_pid = None
+
+    def get_session(self):
+        # connections of a parent process are not shared with forked workers
+        if self.session is None or self.session_pid != os.getpid():
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=max(1, self.max_in_flight))
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+            self.session_pid = os.getpid()
+        return self.session
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["session"] = None
+        return state
+
+    def check(self, response):
+        if response.status_code != int(200):
+            raise Exception(f"Server-side error in calculation: \n {response.status_code}: {response.text}\n")
+        return response
 
     def calculate(self, atoms=None, properties=["energy"], system_changes=all_changes):
         # do_forces = "forces" in properties
-        atoms_json = {
-            "species": atoms.get_atomic_numbers().tolist(),
-            "coordinates": atoms.get_positions().tolist(),
-        }
-        # print(atoms_json)
-        try:
-            response = requests.post(url=f"{self.url}/calc", json=atoms_json)
-            if response.status_code != int(200):
-                raise Exception(f"Server-side error in calculation: \n {response.status_code}: {response.text}\n")
-        except requests.exceptions.HTTPError as error:
-            print(error)
-        self.results["energy"] = np.array(response.json()["energy"])
-        # if do_forces:
-        self.results["forces"] = np.array(response.json()["forces"])
+        self.results["energy"], self.results["forces"] = self.calculate_json(
+            [atoms])[0]
+
+    def calculate_json(self, atoms_list, charges=None):
+        """Energies and forces of molecules, one /calc request each."""
+        results = []
+        for atoms in atoms_list:
+            atoms_json = {
+                "species": atoms.get_atomic_numbers().tolist(),
+                "coordinates": atoms.get_positions().tolist(),
+            }
+            response = self.check(self.get_session().post(
+                url=f"{self.url}/calc", json=atoms_json))
+            results.append((np.array(response.json()["energy"]),
+                            np.array(response.json()["forces"])))
+        return results
+
+    def calculate_batch(self, atoms_list, charges):
+        """Energies and forces of a batch of molecules in one request."""
+        dtype = np.float32 if self.payload == "float32" else np.float64
+        response = self.get_session().post(
+            url=f"{self.url}/calc_batch",
+            data=encode_arrays(**batch_arrays(atoms_list, charges, dtype)),
+            headers={"Content-Type": self.content_type})
+        if response.status_code == 404:
+            # server with /calc only
+            print("RestAPI: no /calc_batch at %s, using /calc" % self.url)
+            self.payload = "json"
+            return self.calculate_json(atoms_list)
+        results = decode_arrays(self.check(response).content)
+        sizes = [len(atoms) for atoms in atoms_list]
+        return list(zip(results["energy"],
+                        np.split(results["forces"], np.cumsum(sizes)[:-1])))
 
     def run_qr(self, atoms,coordinates=None,charge=None,pointcharges=None,define_str=None):
         self.atoms = atoms
         unit_convert = ase.units.kcal / ase.units.mol
-        self.calculate(atoms, properties=["energy", "forces"])
+        if self.payload == "json":
+            self.calculate(atoms, properties=["energy", "forces"])
+        else:
+            self.results["energy"], self.results["forces"] = self.calculate_batch(
+                [atoms], [0 if charge is None else charge])[0]
         self.energy_free = self.results["energy"] * unit_convert
         self.forces = self.results["forces"].astype(np.float64) * unit_convert
+
+    def run_qr_batch(self, atoms_list, charges):
+        """
+        Energies and forces of several molecules: requests of batch_size
+        molecules (of one molecule with payload json), up to max_in_flight of
+        them at the same time.
+        Returns:
+        list of (energy_free, forces) per molecule, in the units of run_qr.
+        """
+        if self.payload == "json":
+            size, function = 1, self.calculate_json
+        else:
+            size, function = self.batch_size or len(atoms_list), self.calculate_batch
+        jobs = [(atoms_list[i:i+size], charges[i:i+size])
+                for i in range(0, len(atoms_list), size)]
+        if len(jobs) == 1 or self.max_in_flight < 2:
+            results = [function(*job) for job in jobs]
+        else:
+            self.get_session()
+            with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+                results = list(pool.map(lambda job: function(*job), jobs))
+        unit_convert = ase.units.kcal / ase.units.mol
+        return [(float(np.asarray(energy).ravel()[0]) * unit_convert,
+                 np.asarray(forces, dtype=np.float64) * unit_convert)
+                for batch in results for energy, forces in batch]
@@ -20,14 +20,9 @@ import os
 import numpy as np
 import ase.units as ase_units
 from ase.calculators.general import Calculator
-from .ani.ani_interface import ANIRPCCalculator
-import torch
+from . import models
 
 ANImodel_file = os.path.join(os.path.dirname(__file__), "ani/aniqr-210405.pt")
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
-model = torch.jit.load(ANImodel_file, map_location=device)
-for p in model.parameters():
-    p.requires_grad_(False)
 
 class TorchAni(Calculator):
   """
@@ -54,7 +49,9 @@ class TorchAni(Calculator):
     self.method = method
     self.energy_free = None
     self.forces = []
-    self.calc = ANIRPCCalculator(model)
+    # torch and the model are loaded by the first TorchAni of the process
+    from .ani.ani_interface import ANIRPCCalculator
+    self.calc = ANIRPCCalculator(models.torchani(ANImodel_file))
 
   def check_trained_atoms(self):
       """
@@ -89,6 +86,32 @@ class TorchAni(Calculator):
         print(('Energy:',self.energy_free))
         print(('Force:', self.forces))
 
+  def run_qr_batch(self, atoms_list, charges):
+    """
+    Energies and forces of several molecules in one forward/backward pass.
+    Molecules are padded to the same number of atoms with species -1, the
+    TorchANI convention for missing atoms.
+    Args:
+      atoms_list (list of ase.atoms.Atoms) the molecules.
+      charges (list of int) not used, the ANI models are for neutral molecules.
+    Returns:
+      list of (energy_free, forces) per molecule, in the units of run_qr.
+    """
+    sizes = [len(atoms) for atoms in atoms_list]
+    R = np.zeros((len(atoms_list), max(sizes), 3), dtype=np.float32)
+    Z = np.full((len(atoms_list), max(sizes)), -1, dtype=np.int64)
+    for i, atoms in enumerate(atoms_list):
+      self.atoms = atoms
+      self.check_trained_atoms()
+      R[i, :sizes[i]] = atoms.get_positions()
+      Z[i, :sizes[i]] = atoms.get_atomic_numbers()
+    E, F = self.calc.interface.calculate(1, R, Z, np.zeros(3, dtype=bool),
+      np.zeros((3, 3), dtype=np.float32))
+    unit_convert = ase_units.Hartree*ase_units.kcal/ase_units.mol
+    return [(float(E[i])*unit_convert,
+             F[i, :sizes[i]].astype(np.float64)*unit_convert)
+            for i in range(len(atoms_list))]
+
   def get_command(self):
     """
     This command is not used for running the ASE calcualtor.
@@ -17,7 +17,10 @@ from ase.units import Hartree, Bohr
 from ase.io import read, write
 from ase.calculators.general import Calculator
 from subprocess import Popen, PIPE, STDOUT
+from . import warm_start
+from . import async_qr
 import copy
+import shutil
 
 key_parameters = {'maxit': 200}
 #                   'basis': None,
@@ -64,6 +67,10 @@ class Turbomole(Calculator):
         # POST-HF method
         self.post_HF = post_HF
         self.pointcharges = pointcharges
+        # keep the define setup and the mos of the previous run
+        self.warm_start = False
+        # the files of a run are in calc_dir
+        self.calc_dir = os.curdir
 
     def initialize(self, atoms):
         self.numbers = atoms.get_atomic_numbers().copy()
@@ -87,7 +94,8 @@ class Turbomole(Calculator):
               f.writelines( contents )
               f.close()
             # the sub process gets started here
-            proc = Popen([command], shell=True, stderr=PIPE)
+            proc = Popen([command], shell=True, stderr=PIPE,
+              universal_newlines=True)
             error = proc.communicate()[1]
             # check the error output
             if 'abnormally' in error:
@@ -138,6 +146,34 @@ class Turbomole(Calculator):
         return self.stress
 
     def set_atoms(self, atoms):
+        async_qr.run(self.define_job(atoms))
+
+    def path(self, file_name):
+        return os.path.join(self.calc_dir, file_name)
+
+    def define_job(self, atoms):
+        """
+        set_atoms in steps, see async_qr: yields the define command if the
+        setup of the previous run can not be kept.
+        """
+        # same atoms: new coordinates, define setup and mos are kept
+        if self.warm_start and warm_start.restart_available(
+            self.path('control'), atoms, self.key_parameters['charge'],
+            [self.path('control.define')]):
+            for f in ['coord',
+              'energy',
+              'gradient',
+              'forceapprox',
+              'statistics',
+              'dscf_problem']:
+                    if os.path.exists(self.path(f)):
+                            os.remove(self.path(f))
+            write(self.path('coord'), atoms)
+            shutil.copyfile(self.path('control.define'), self.path('control'))
+            Calculator.set_atoms(self, atoms)
+            self.update_energy = True
+            self.update_forces = True
+            return
         # Delete old  coord control, ... files, if exist
         for f in ['coord',
           'basis',
@@ -150,15 +186,15 @@ class Turbomole(Calculator):
           'statistics',
           'dscf_problem',
           'control']:
-                if os.path.exists(f):
-                        os.remove(f)
+                if os.path.exists(self.path(f)):
+                        os.remove(self.path(f))
         # performs an update of the atoms
-        write('coord', atoms)
+        write(self.path('coord'), atoms)
 
         if not self.key_parameters["basis"] == 'cefine':
             string='\n\na coord\n*\nno\nb all '+self.key_parameters['basis']+'\n*\neht\n\n'+str(self.key_parameters['charge'])+'\n\nscf\niter\n'+str(self.key_parameters['maxit'])+'\n\ncc\nmemory\n1000\n*\ndft\non\nfunc\n'+self.key_parameters['method']+'\n*\nri\non\nm\n3000\n*\n*' 
             self.define_str = string
-            with open('def.inp', 'w') as f:
+            with open(self.path('def.inp'), 'w') as f:
                 f.write(self.define_str)
             command = 'define < def.inp > define.out'
         else:
@@ -166,10 +202,11 @@ class Turbomole(Calculator):
             command = self.define_str+' > cefine.out'
             
         # run define
-        proc = Popen([command], shell=True, stderr=PIPE)
-        error = proc.communicate()[1]
+        error = yield command, self.calc_dir
         if 'abnormally' in error:
             raise OSError(error)
+        if self.warm_start:
+            shutil.copyfile(self.path('control'), self.path('control.define'))
         Calculator.set_atoms(self, atoms)
         # energy and forces must be re-calculated
         self.update_energy = True  
@@ -178,7 +215,7 @@ class Turbomole(Calculator):
 
     def read_energy(self):
         """Read Energy from Turbomole energy file."""
-        text = open('energy', 'r').read().lower()
+        text = open(self.path('energy'), 'r').read().lower()
         lines = iter(text.split('\n'))
 
         # Energy:
@@ -199,7 +236,7 @@ class Turbomole(Calculator):
 
     def read_forces(self):
         """Read Forces from Turbomole gradient file."""
-        file = open('gradient', 'r')
+        file = open(self.path('gradient'), 'r')
         lines = file.readlines()
         file.close()
 
@@ -240,7 +277,7 @@ class Turbomole(Calculator):
         return False
 
     def set_modules(self):
-        with open('control', 'r') as out:
+        with open(self.path('control'), 'r') as out:
             for line in out:
                 if '$rij' in line:
                     self.calculate_energy='ridft'
@@ -278,6 +315,9 @@ class Turbomole(Calculator):
     def set_label(self, label):
       self.label = label
 
+    def set_warm_start(self, warm_start):
+      self.warm_start = warm_start
+
     def set(self, **kwargs):
         for key, value in kwargs.items():
            if key in key_parameters:
@@ -289,48 +329,55 @@ class Turbomole(Calculator):
                coordinates,
                charge,
                pointcharges):
-        import subprocess
+        async_qr.run(self.qr_job(atoms, define_str, coordinates, charge,
+                                 pointcharges))
+
+    def submit_qr(self, atoms, **kwargs):
+        """Awaitable run_qr, see async_qr.submit()"""
+        return async_qr.submit(self, atoms, **kwargs)
+
+    def qr_job(self,
+               atoms,
+               define_str,
+               coordinates,
+               charge,
+               pointcharges):
+        """
+        run_qr in steps, see async_qr: define, energy and gradient in the
+        directory label. Errors are raised, not sys.exit, so that a failed
+        fragment does not end a process that runs others.
+        """
         self.atoms = atoms
         self.key_parameters['charge'] = charge
         
         self.coordinates = coordinates
-        working_dir = os.getcwd()
         if self.pointcharges is not None:
           self.pointcharges = os.path.abspath(self.pointcharges)
         if not  os.path.isdir(self.label):
           os.mkdir(self.label)
-        turbomole_dir = self.label
-        os.chdir(turbomole_dir)
-        self.set_atoms(self.atoms)
+        self.calc_dir = os.path.abspath(self.label)
         try:
+            yield from self.define_job(self.atoms)
             if self.pointcharges is not None:
               f = open(self.pointcharges, "r")
               point_charges = f.readlines()
               f.close()
-              f = open("control", "r")
+              f = open(self.path("control"), "r")
               contents = f.readlines()
               f.close()
               contents = contents[:-1] + ['$point_charges\n'] + point_charges +[contents[-1]]
-              f = open("control", "w")
+              f = open(self.path("control"), "w")
               f.writelines( contents )
               f.close()
 
             self.set_modules() # ridft or dscf  
             command = self.calculate_energy + ' > ASE.TM.energy.out'
             print(command) #debug
-            proc = subprocess.Popen([command], shell=True, stderr=PIPE)
-            error = proc.communicate()[1]
-            proc.wait()
-            exitcode = proc.returncode
-        
-            
-            if exitcode != 0:
-                print(str(exitcode))
-                raise RuntimeError('Turbomole exited with error code')
+            error = yield command, self.calc_dir
             if 'abnormally' in error:
                 raise OSError(error)
             # check for convergence of dscf cycle
-            if os.path.isfile('dscf_problem'):
+            if os.path.isfile(self.path('dscf_problem')):
                 print('Turbomole scf energy calculation did not converge')
                 raise RuntimeError(
                 'Please run Turbomole define and come thereafter back')
@@ -340,18 +387,14 @@ class Turbomole(Calculator):
 
             # calculate forces
             command = self.calculate_forces + ' > ASE.TM.forces.out'
-            proc = subprocess.Popen([command], shell=True, stderr=PIPE)
-            error = proc.communicate()[1]
-            proc.wait()
-            exitcode = proc.returncode
-            if exitcode != 0:
-                print(str(exitcode))
-                raise RuntimeError('Turbomole exited with error code')
+            error = yield command, self.calc_dir
             if 'abnormally' in error:
                 raise OSError(error)
             # read forces
             self.read_forces()
+            if self.warm_start:
+                warm_start.restart_written(self.path('control'), self.atoms,
+                                           charge)
         except OSError as e:
             print('Execution failed:', e, file=sys.stderr)
-            sys.exit(1)
-        os.chdir(working_dir)
+            raise RuntimeError('Turbomole failed in %s' % self.calc_dir)
@@ -0,0 +1,38 @@
+"""
+SCF warm start for file based QM engines.
+
+The working directory of a fragment stays the same between optimizer steps,
+so the converged density or wavefunction of the previous step can serve as
+the initial guess of the next one. <label>.atoms records the elements and the
+charge the restart files were written for, the restart files are only used
+while these are unchanged.
+"""
+from __future__ import print_function
+import os
+
+
+def signature(atoms, charge):
+    return " ".join([str(charge)] + atoms.get_chemical_symbols())
+
+
+def restart_available(label, atoms, charge, restart_files):
+    """
+    True if all restart_files exist and belong to the same atoms and charge.
+    The record is removed, so that an interrupted or failed run does not
+    leave a restart behind; restart_written() restores it.
+    """
+    file_name = label + '.atoms'
+    if not os.path.isfile(file_name):
+        return False
+    with open(file_name) as f:
+        result = f.read() == signature(atoms, charge)
+    os.remove(file_name)
+    for restart_file in restart_files:
+        if not os.path.isfile(restart_file):
+            return False
+    return result
+
+
+def restart_written(label, atoms, charge):
+    with open(label + '.atoms', 'w') as f:
+        f.write(signature(atoms, charge))
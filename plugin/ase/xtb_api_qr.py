@@ -0,0 +1,157 @@
+"""
+In-process GFN-xTB through the xtb Python API (pip install xtb).
+
+Same run_qr contract and units as xtb_qr.GFNxTB, without files, a subprocess
+or parsing of Turbomole-format output. One xtb calculator is kept per label
+(fragment) while its atoms and charge are unchanged: positions are updated in
+place and, with warm_start, the previous wavefunction is the initial guess.
+Point charges are handed to xtb through the API.
+"""
+from __future__ import print_function
+import collections
+import numpy as np
+
+from ase.units import kcal, mol
+from ase.units import Hartree, Bohr
+from xtb.interface import Calculator, Param
+from xtb.libxtb import VERBOSITY_MUTED
+from xtb.utils import get_solvent
+
+parameters = {'0': Param.GFN0xTB, '1': Param.GFN1xTB, '2': Param.GFN2xTB}
+
+
+def parse_method(method):
+    """
+    xtb command line options of quantum.method (--gfn, --etemp, --acc, --gbsa,
+    --iterations) as API settings, None if some option has no API equivalent.
+    """
+    result = {'param': Param.GFN2xTB}
+    words = method.split()
+    while words:
+        word = words.pop(0)
+        if word.lstrip('-').startswith('gfn') and word.lstrip('-')[3:]:
+            word, value = '--gfn', word.lstrip('-')[3:]
+        elif word in ['--gfn', '--etemp', '--acc', '--gbsa', '-g',
+                      '--iterations'] and words:
+            value = words.pop(0)
+        else:
+            return None
+        if word == '--gfn':
+            if value not in parameters:
+                return None
+            result['param'] = parameters[value]
+        elif word == '--etemp':
+            result['etemp'] = float(value)
+        elif word == '--acc':
+            result['acc'] = float(value)
+        elif word == '--iterations':
+            result['iterations'] = int(value)
+        else:
+            result['solvent'] = get_solvent(value)
+            if result['solvent'] is None:
+                return None
+    return result
+
+
+def read_pointcharges(file_name):
+    """Charges and positions (Angstrom) of a qxyz point charge file."""
+    lines = open(file_name).read().splitlines()[2:]
+    qxyz = np.array([[float(x) for x in line.split()[:4]]
+                     for line in lines if line.strip()])
+    return qxyz[:, 0], qxyz[:, 1:]
+
+
+class GFNxTBAPI(object):
+    name = 'gfn-xtb-api'
+    in_process = True
+
+    def __init__(self,
+                 label='ase_plugin',
+                 charge=0,
+                 method='-gfn2',
+                 pointcharge_number=7,
+                 max_calculators=100):
+        self.label = label
+        self.charge = charge
+        self.method = method
+        # the API has no ideal point charges, they are damped like this element
+        self.pointcharge_number = pointcharge_number
+        self.warm_start = False
+        # calculators and results per label, least recently used dropped
+        self.max_calculators = max_calculators
+        self.calculators = collections.OrderedDict()
+        # initialize the results
+        self.atoms = None
+        self.energy_zero = None
+        self.energy_free = None
+        self.forces = None
+
+    @staticmethod
+    def supports(method):
+        return parse_method(method) is not None
+
+    def get_calculator(self, atoms):
+        """Calculator and results of this label, a new one for new atoms."""
+        signature = (self.method, int(self.charge),
+                     tuple(atoms.get_atomic_numbers()))
+        previous = self.calculators.pop(self.label, None)
+        if previous is not None and previous[0] == signature:
+            return previous
+        settings = parse_method(self.method)
+        if settings is None:
+            raise RuntimeError('xtb API: method %s is not supported' % self.method)
+        calculator = Calculator(settings['param'], atoms.get_atomic_numbers(),
+                                atoms.get_positions() / Bohr,
+                                charge=int(self.charge))
+        calculator.set_verbosity(VERBOSITY_MUTED)
+        if 'etemp' in settings:
+            calculator.set_electronic_temperature(settings['etemp'])
+        if 'acc' in settings:
+            calculator.set_accuracy(settings['acc'])
+        if 'iterations' in settings:
+            calculator.set_max_iterations(settings['iterations'])
+        if settings.get('solvent') is not None:
+            calculator.set_solvent(settings['solvent'])
+        return signature, calculator, None
+
+    def run_qr(self,
+               atoms,
+               coordinates=None,
+               charge=None,
+               pointcharges=None,
+               **kwargs):
+        if charge is not None:
+            self.charge = charge
+        self.atoms = atoms
+        signature, calculator, results = self.get_calculator(atoms)
+        calculator.update(atoms.get_positions() / Bohr)
+        if pointcharges is not None:
+            charges, positions = read_pointcharges(pointcharges)
+            calculator.set_external_charges(
+                np.full(len(charges), self.pointcharge_number), charges,
+                positions / Bohr)
+        else:
+            calculator.release_external_charges()
+        if not self.warm_start:
+            results = None
+        results = calculator.singlepoint(results)
+        self.calculators[self.label] = (signature, calculator, results)
+        while len(self.calculators) > self.max_calculators:
+            self.calculators.popitem(last=False)
+        # units of xtb_qr.GFNxTB
+        self.energy_free = results.get_energy() * Hartree / (kcal / mol)
+        self.energy_zero = self.energy_free
+        self.forces = -results.get_gradient() * (Hartree / Bohr) / (kcal / mol)
+
+    # Q|R requirements
+    def set_charge(self, charge):
+      self.charge = charge
+
+    def set_method(self, method):
+      self.method = method
+
+    def set_label(self, label):
+      self.label = label
+
+    def set_warm_start(self, warm_start):
+      self.warm_start = warm_start
@@ -10,6 +10,8 @@ from ase.io import write
 from ase.units import kcal, mol
 from ase.units import Hartree, Bohr
 from ase.calculators.calculator import Calculator
+from . import warm_start
+from . import async_qr
 import copy
 
 key_parameters = {
@@ -52,32 +54,15 @@ class GFNxTB(Calculator):
         self.stress = None
         self.command = self.get_command()
         self.calc_dir = None
+        # keep xtbrestart, xtb starts from the previous wavefunction
+        self.warm_start = False
 
 
-    def run_command(self,command):
-        """
-        execute <command> in a subprocess and check error code
-        """
-        from subprocess import Popen, PIPE, STDOUT
-        if command == '':
-            raise RuntimeError('no command for run_command :(')
-        print('Running: ', command) #debug
-        proc = Popen([command], shell=True, stderr=PIPE)
-        proc.wait()
-        exitcode = proc.returncode
-        if exitcode != 0:
-            print(proc.communicate())
-            # print exitcode,'label:', self.calc_dir
-            error='%s exited with error code %i in %s' % (
-                           command,exitcode,self.calc_dir)
-            raise RuntimeError(error)
-        return 0
-
     def write_input(self,atoms):
         
         atoms = copy.deepcopy(self.atoms)
-        write(self.coordinates, atoms)
-        fname=self.coordinates #+'/xtb_tmp.xyz'
+        fname=self.path(self.coordinates) #+'/xtb_tmp.xyz'
+        write(fname, atoms)
         finput = open(fname, "w")        
         symbols = atoms.get_chemical_symbols()
         coordinates = atoms.get_positions()
@@ -110,27 +95,36 @@ class GFNxTB(Calculator):
                coordinates,
                charge,
                pointcharges,**kwargs):
-        import subprocess
+        async_qr.run(self.qr_job(atoms, coordinates, charge, pointcharges))
+
+    def submit_qr(self, atoms, **kwargs):
+        """Awaitable run_qr, see async_qr.submit()"""
+        return async_qr.submit(self, atoms, **kwargs)
+
+    def path(self, file_name):
+        return os.path.join(self.calc_dir, file_name)
+
+    def qr_job(self,
+               atoms,
+               coordinates,
+               charge,
+               pointcharges,**kwargs):
         """
-        Handels GFN-xTB calculations
+        Handels GFN-xTB calculations, in the directory label
         """
         # set the input file name
         self.atoms = atoms
         # method=self.key_parameters['method']
         self.coordinates = coordinates
         self.key_parameters['charge'] = charge
-        foutput = self.label + '.out'
 
         # directory
-        working_dir = os.getcwd()
         if not  os.path.isdir(self.label):
           os.mkdir(self.label)
-        self.calc_dir = os.path.join(working_dir,self.label)
-        os.chdir(self.calc_dir)
+        self.calc_dir = os.path.abspath(self.label)
         self.coordinates = 'xtb_tmp.xyz'
 
         # debug statements
-        # print 'current work dir ',os.getcwd()
         # print('coords:',coordinates)
         self.write_input(self.atoms)
         
@@ -164,18 +158,25 @@ class GFNxTB(Calculator):
         # self.write_charge(self.key_parameters["charge"])
 
         #clean up
-        for f in ['energy','gradient','xtbrestart']:
-            if os.path.exists(f):
-                os.remove(f)
-
-        self.run_command(command)
+        clean_up = ['energy','gradient']
+        if not (self.warm_start and warm_start.restart_available(
+            self.path('xtbrestart'), self.atoms, charge,
+            [self.path('xtbrestart')])):
+            clean_up.append('xtbrestart')
+        for f in clean_up:
+            if os.path.exists(self.path(f)):
+                os.remove(self.path(f))
+
+        yield command, self.calc_dir
         self.read_energy_output()
         self.read_forces()
+        if self.warm_start:
+            warm_start.restart_written(self.path('xtbrestart'), self.atoms,
+                                       charge)
         self.energy_zero= self.energy_free
-        os.chdir(working_dir)
 
     def check_scf_conv(self):
-        text = open('energy', 'r').read().lower()
+        text = open(self.path('energy'), 'r').read().lower()
         lines = iter(text.split('\n'))
         scf_conv=False
         for line in lines:
@@ -185,7 +186,7 @@ class GFNxTB(Calculator):
 
     def read_energy(self):
         """Read Energy from Turbomole energy file."""
-        text = open('energy', 'r').read().lower()
+        text = open(self.path('energy'), 'r').read().lower()
         lines = iter(text.split('\n'))
 
         # Energy:
@@ -203,7 +204,7 @@ class GFNxTB(Calculator):
 
     def read_energy_output(self):
         """Read Energy from xtb output file."""
-        text = open('xtb.out', 'r').read()
+        text = open(self.path('xtb.out'), 'r').read()
         lines = iter(text.split('\n'))
 
         # Energy:
@@ -219,12 +220,10 @@ class GFNxTB(Calculator):
 
     def read_forces(self):
         """xTB uses turbomole format gradients. We read forces and energy from it"""
-        file = open('gradient', 'r')
+        file = open(self.path('gradient'), 'r')
         lines = file.readlines()
         file.close()
 
-        forces = np.array([[0, 0, 0]])
-
         nline = len(lines)
         iline = -1
 
@@ -240,24 +239,22 @@ class GFNxTB(Calculator):
         # $end line
         nline -= 1
         # read gradients
-        for i in range(iline, nline):
-            line = lines[i].replace('D', 'E')
-            tmp = np.array([[float(f) for f in line.split()[0:3]]])
-            forces = np.concatenate((forces, tmp))
+        forces = np.array([[float(f) for f in lines[i].replace('D', 'E').split()[0:3]]
+                           for i in range(iline, nline)]).reshape(-1, 3)
         # Note the '-' sign for turbomole, to get forces
-        self.forces = (-np.delete(forces, np.s_[0:1], axis=0)) * (Hartree / Bohr)/(kcal / mol)
+        self.forces = -forces * (Hartree / Bohr)/(kcal / mol)
 
     def set_pointcharges(self):
         f = open(self.pointcharges, "r")
         pchrg = f.readlines()
         f.close()
-        f = open("pcharge","w")
+        f = open(self.path("pcharge"),"w")
         f.writelines(pchrg[0])
         f.writelines(pchrg[2:])
         f.close()
     
     def write_charge(self,charge):
-        f = open('.CHRG', "w")
+        f = open(self.path('.CHRG'), "w")
         f.write('%i' % charge)
         f.close()
 
@@ -277,3 +274,6 @@ class GFNxTB(Calculator):
 
     def set_nproc(self, nproc):
       self.key_parameters['nproc'] = int(nproc)
+
+    def set_warm_start(self, warm_start):
+      self.warm_start = warm_start
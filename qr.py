@@ -56,9 +56,15 @@ cluster{
   select_within_radius = 10
     .type = int
     .help = supersphere expansion radius
-  clustering_method = gnc  *bcc
+  clustering_method = gnc  *bcc bisection
     .type = choice(multi=False)
-    .help = type of clustering algorithm
+    .help = type of clustering algorithm. bisection: multilevel recursive \
+            bisection of the residue interaction graph weighted by atom \
+            count, bounded by maxnum_atoms_in_fragment
+  maxnum_atoms_in_fragment = 500
+    .type = int
+    .help = per-fragment QM cost budget for clustering_method=bisection: \
+            maximum number of atoms in a cluster and its buffer
   altloc_method = average *subtract
     .type = choice(multi=False)
     .help = two strategies on how to join energies from multiple energy and \
@@ -74,6 +80,39 @@ cluster{
     .type = float
     .help = Re-calculate clusters once the model shifted by more than \
             re_calculate_rmsd_tolerance from initial
+  incremental_re_clustering = False
+    .type = bool
+    .help = When re-calculating clusters, rebuild only clusters (and their \
+            buffers) containing residues whose contacts changed and keep all \
+            other fragments. Not available with altlocs.
+  fast_capping = False
+    .type = bool
+    .help = Re-cap fragments at every step by placing the link hydrogens \
+            recorded at set-up along the cut bonds instead of re-running \
+            model completion.
+  whole_system_charges = False
+    .type = bool
+    .help = Derive fragment charges from formal charges computed once for \
+            the capped super-sphere instead of a charge calculation for \
+            every fragment.
+  fragment_cache_size = 0
+    .type = int
+    .help = Number of fragment energies and gradients kept to be reused when \
+            a fragment is evaluated again at the same coordinates (0: off). \
+            Not used with charge_embedding.
+  fragment_cache_tolerance = 1.e-5
+    .type = float
+    .help = Coordinates are compared after rounding to this (Angstrom) for \
+            the fragment cache.
+  gradient_reuse_shift = None
+    .type = float
+    .help = Multiple-time-step restraints: keep the last energy and gradients \
+            of a fragment while none of its atoms moved more than this \
+            (Angstrom) since it was computed. None: always recompute.
+  gradient_reuse_max_steps = 5
+    .type = int
+    .help = Recompute a fragment after its gradients were reused this many \
+            steps in a row.
 }
 
 restraints = cctbx *qm
@@ -82,8 +121,13 @@ restraints = cctbx *qm
 expansion = False
   .type = bool
   .help = Expand input model into super-sphere
+periodic = False
+  .type = bool
+  .help = Evaluate ML restraints (torchani, aimnet2) of the whole unit cell \
+          under periodic boundary conditions instead of the super-sphere of \
+          expansion, without clustering.
 quantum {
-  engine_name = *mopac aimnet2 aimnet2-old torchani terachem turbomole pyscf orca gaussian xtb server
+  engine_name = *mopac mopac-api aimnet2 aimnet2-old torchani terachem turbomole pyscf orca gaussian xtb server
     .type = choice(multi=False)
     .help = choose the QM program
   basis = Auto
@@ -103,13 +147,37 @@ quantum {
     .help = number of parallel processes for the QM program
   server_url =  http://127.0.0.1:8000
     .type = str
-    .help = address (http://address:port) of the server API if engine_name=server
+    .help = address (http://address:port) of the server API if \
+            engine_name=server, e.g. of qr.server --engine aimnet2
+  server_payload = json *binary float32
+    .type = choice(multi=False)
+    .help = json: one request per fragment with coordinates as JSON lists. \
+            binary: the fragments of a step in one request as binary arrays \
+            (falls back to json if the server has no /calc_batch). float32: \
+            binary in single precision.
+  server_batch_size = None
+    .type = int
+    .help = fragments per request with server_payload=binary or float32, all \
+            fragments of a step if None. Up to 4 requests are in flight at \
+            the same time.
   qm_addon = gcp dftd3 gcp-d3
     .type = choice(multi=False)
     .help = allows additional calculations of the gCP and/or DFT-D3 corrections using their stand-alone programs
   qm_addon_method = None
     .type = str
     .help = specifies flags for the qm_addon. See manual for details.
+  warm_start = False
+    .type = bool
+    .help = start the SCF of a fragment from the density or wavefunction of \
+            the previous step if its atoms are unchanged (mopac, mopac-api, orca, \
+            xtb, turbomole, gaussian)
+  fallback_engine_name = mopac mopac-api aimnet2 aimnet2-old torchani terachem turbomole pyscf orca gaussian xtb server
+    .type = choice(multi=False)
+    .help = QM engine (e.g. mopac or xtb) used for a fragment that still \
+            fails after parallel.fragment_retries, by default refinement stops.
+  fallback_method = None
+    .type = str
+    .help = Method for fallback_engine_name, defaults to that engine's default.
 }
 
 refine {
@@ -227,17 +295,39 @@ refine {
 }
 
 parallel {
-  method = *multiprocessing slurm pbs sge lsf threading
+  method = *multiprocessing slurm pbs sge lsf threading asyncio
     .type = choice(multi=False)
     .help = type of parallel mode and efficient method of processes on the \
             current computer. The others are queueing protocols with the \
-            expection of threading which is not a safe choice.
+            expection of threading which is not a safe choice. asyncio: \
+            one process keeps nproc programs of file based QM engines \
+            (mopac, orca, xtb, gaussian, turbomole) running.
   nproc = 1
     .type = int
     .help = Number of processes to use
   qsub_command = None
     .type = str
     .help = Specific command to use on the queue system
+  persistent_pool = False
+    .type = bool
+    .help = With method=multiprocessing and nproc>1 keep one pool of worker \
+            processes for the whole refinement. Workers keep their QM engine \
+            and fragment data between steps and only receive new coordinates. \
+            Only the pool hands fragments to idle workers one at a time, \
+            longest first by their measured cost (load balancing).
+  fragment_retries = 0
+    .type = int
+    .help = Number of times a failed fragment calculation is repeated, \
+            fragments that finished are kept.
+  retry_backoff = 1.0
+    .type = float
+    .help = Seconds to wait before the first retry of failed fragments, \
+            doubled for every further retry.
+  batch_fragments = False
+    .type = bool
+    .help = Evaluate all fragments of a step in one call of engines that take \
+            batches of molecules (aimnet2, torchani): one forward/backward \
+            pass in the main process instead of one per fragment.
 }
 
 output_file_name_prefix = None
@@ -293,6 +383,10 @@ qr.refine model.pdb model.mtz [<param_name>=<param_value>] ...
     #
     assert [self.params.expansion,
             self.params.cluster.clustering].count(True) != 2
+    if(self.params.periodic and (self.params.expansion or
+       self.params.cluster.clustering or self.params.restraints != "qm")):
+      raise Sorry("periodic=True needs restraints=qm, expansion=False and "
+        "cluster.clustering=False.")
     #
     if self.params.refine.minimizer == "lbfgsb":
       if self.params.refine.gradient_only:
@@ -326,7 +420,8 @@ and quantum.engine_name=aimnet2:
       self.params.cluster.select_within_radius=7
       self.params.refine.max_iterations_weight=100
       if self.fmodel is not None:
-        self.params.expansion=True
+        # the whole cell replaces the super-sphere if asked for
+        self.params.expansion=not self.params.periodic
         self.params.refine.minimizer="lbfgs"
         self.params.refine.gradient_only=True
 
@@ -355,6 +450,7 @@ and quantum.engine_name=aimnet2:
       print("  refine.number_of_weight_search_cycles   ", self.params.refine.number_of_weight_search_cycles, file=self.logger)
       print("  refine.number_of_refine_cycles          ", self.params.refine.number_of_refine_cycles, file=self.logger)
       print("  expansion                               ", self.params.expansion, file=self.logger)
+      print("  periodic                                ", self.params.periodic, file=self.logger)
       print("  use_reduce                              ", self.params.use_reduce, file=self.logger)
       print("  cluster.select_within_radius            ", self.params.cluster.select_within_radius, file=self.logger)
       print("  refine.max_iterations_weight            ", self.params.refine.max_iterations_weight, file=self.logger)
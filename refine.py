@@ -23,6 +23,7 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import os
+import copy
 import sys
 import time
 import pickle
@@ -85,6 +86,7 @@ def create_fragment_manager(
     clustering_method          = params.cluster.clustering_method,
     altloc_method              = params.cluster.altloc_method,
     maxnum_residues_in_cluster = params.cluster.maxnum_residues_in_cluster,
+    maxnum_atoms_in_fragment   = params.cluster.maxnum_atoms_in_fragment,
     charge_embedding           = params.cluster.charge_embedding,
     two_buffers                = params.cluster.two_buffers,
     pdb_hierarchy              = model.get_hierarchy(),
@@ -94,7 +96,10 @@ def create_fragment_manager(
     charge_cutoff              = params.cluster.charge_cutoff,
     save_clusters              = params.cluster.save_clusters,
     select_within_radius       = params.cluster.select_within_radius,
-    bond_with_altloc_flag      = params.cluster.bond_with_altloc)
+    bond_with_altloc_flag      = params.cluster.bond_with_altloc,
+    incremental_re_clustering  = params.cluster.incremental_re_clustering,
+    fast_capping               = params.cluster.fast_capping,
+    whole_system_charges       = params.cluster.whole_system_charges)
 
 class hd_mapper(object):
   """
@@ -169,6 +174,15 @@ def create_restraints_manager(params, model, altlocs_present):
       params = params,
       method = params.cluster.altloc_method)
 
+  # No altlocs of any kind, whole unit cell with periodic boundary conditions.
+  #
+  if(params.periodic):
+    print("Restraints are from restraints.from_periodic")
+    return restraints.from_periodic(
+      restraints_manager = restraints_source.restraints_manager,
+      pdb_hierarchy      = model.get_hierarchy(),
+      crystal_symmetry   = model.crystal_symmetry())
+  #
   # No altlocs of any kind with expansion.
   #
   if(params.expansion):
@@ -208,13 +222,46 @@ def create_restraints_manager(params, model, altlocs_present):
     if(params.cluster.clustering):
       fragment_manager = create_fragment_manager(params = params, model = model)
       return cluster_restraints.from_cluster(
-        restraints_manager = restraints_source.restraints_manager,
-        fragment_manager   = fragment_manager,
-        parallel_params    = params.parallel)
+        restraints_manager          = restraints_source.restraints_manager,
+        fragment_manager            = fragment_manager,
+        parallel_params             = params.parallel,
+        fallback_restraints_manager = create_fallback_restraints_manager(
+          params = params, model = model),
+        fragment_cache              = create_fragment_cache(params = params),
+        stale_gradients             = create_stale_gradients(params = params))
     else:
       # restraints=cctbx clustering=false expansion=false
       return restraints_source.restraints_manager
 
+def create_fragment_cache(params):
+  if(not params.cluster.fragment_cache_size): return None
+  return cluster_restraints.fragment_cache(
+    size      = params.cluster.fragment_cache_size,
+    tolerance = params.cluster.fragment_cache_tolerance)
+
+def create_stale_gradients(params):
+  if(params.cluster.gradient_reuse_shift is None): return None
+  return cluster_restraints.stale_gradients(
+    shift_tolerance = params.cluster.gradient_reuse_shift,
+    max_steps       = params.cluster.gradient_reuse_max_steps)
+
+def create_fallback_restraints_manager(params, model):
+  """
+  QM restraints with the fallback engine for fragments that keep failing.
+  """
+  if(params.restraints != "qm" or
+     params.quantum.fallback_engine_name is None):
+    return None
+  fallback_params = copy.deepcopy(params)
+  fallback_params.quantum.engine_name = params.quantum.fallback_engine_name
+  fallback_params.quantum.method = Auto
+  fallback_params.quantum.basis = Auto
+  if(params.quantum.fallback_method is not None):
+    fallback_params.quantum.method = params.quantum.fallback_method
+  set_qm_defaults(fallback_params, null_out())
+  return restraints.restraints(
+    params = fallback_params, model = model).restraints_manager
+
 def create_calculator(params, restraints_manager, model, fmodel=None, hdm=None,
                       exclude_selection=None):
   if(params.refine.refine_sites):
@@ -239,7 +286,7 @@ def create_calculator(params, restraints_manager, model, fmodel=None, hdm=None,
 
 def set_qm_defaults(params, log):
   outl = ''
-  if params.quantum.engine_name=='mopac':
+  if params.quantum.engine_name in ['mopac', 'mopac-api']:
     if params.quantum.method==Auto:
       params.quantum.method='PM7'
       outl += '  Setting QM method to PM7 (mopac)\n'
@@ -274,7 +321,7 @@ def set_qm_defaults(params, log):
     print(' Setting QM defaults', file=log)
     print(outl, file=log)
 
-  if params.quantum.engine_name=='mopac':
+  if params.quantum.engine_name in ['mopac', 'mopac-api']:
     if params.quantum.basis:
       print('  Because engine is %s basis set %s ignored' % (
         params.quantum.engine_name,
@@ -442,3 +489,5 @@ def run(model, fmodel, map_data, params, rst_file, prefix, log):
       input_file_name_prefix  = prefix,
       output_file_name_prefix = params.output_file_name_prefix,
       output_folder_name      = params.output_folder_name)
+    if(isinstance(restraints_manager, cluster_restraints.from_cluster)):
+      restraints_manager.close()
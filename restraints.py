@@ -2,6 +2,7 @@ from __future__ import division
 from __future__ import absolute_import
 
 import os
+import numpy as np
 import ase.units as ase_units
 import mmtbx.restraints
 from libtbx.utils import Sorry
@@ -89,6 +90,11 @@ class restraints(object):
           restraints_manager = model.get_restraints_manager())
       else:
         assert self.source_of_restraints_qm()
+        if(self.params.cluster.clustering and
+           self.params.cluster.charge_embedding and
+           self.params.quantum.engine_name in no_point_charge_engines):
+          raise Sorry("cluster.charge_embedding is not available with "
+            "quantum.engine_name=%s." % self.params.quantum.engine_name)
         self.restraints_manager = from_qm(
           cif_objects      = self.cif_objects,
           method           = self.params.quantum.method,
@@ -101,6 +107,9 @@ class restraints(object):
           memory           = self.params.quantum.memory,
           nproc            = self.params.quantum.nproc,
           url              = self.params.quantum.server_url,
+          server_payload   = self.params.quantum.server_payload,
+          server_batch_size = self.params.quantum.server_batch_size,
+          warm_start       = self.params.quantum.warm_start,
           crystal_symmetry = crystal_symmetry,
           clustering       = self.params.cluster.clustering)
     return self.restraints_manager
@@ -235,6 +244,74 @@ class from_expansion(object):
       self.expansion.ph_super_sphere.atoms().extract_xyz())
     self.pdb_hierarchy_super_completed.atoms().set_xyz(xyz)
 
+# engines evaluated on the whole unit cell by from_periodic
+periodic_engines = ["torchani", "aimnet2"]
+
+class from_periodic(object):
+  """
+  ML restraints of the model in its crystal environment without the
+  super-sphere: the unit cell, the model and its copies by all symmetry
+  operators (P1 expansion), is evaluated under periodic boundary conditions.
+  Neighbours across the cell faces come from the periodic neighbour lists of
+  the engine. The energy is that of the cell per model copy, the gradients
+  are those of the model atoms (first copy).
+  """
+  def __init__(self, restraints_manager, pdb_hierarchy, crystal_symmetry):
+    if(restraints_manager.qm_engine_name not in periodic_engines):
+      raise Sorry("periodic=True needs one of the engines: %s" %
+        " ".join(periodic_engines))
+    self.restraints_manager = restraints_manager
+    self.qm_engine = restraints_manager.qm_engine
+    self.size = pdb_hierarchy.atoms().size()
+    unit_cell = crystal_symmetry.unit_cell()
+    orth = np.array(unit_cell.orthogonalization_matrix()).reshape(3, 3)
+    frac = np.array(unit_cell.fractionalization_matrix()).reshape(3, 3)
+    # symmetry operators in Cartesian space, identity first
+    self.operators = []
+    for op in crystal_symmetry.space_group().all_ops():
+      r = np.array(op.r().as_double()).reshape(3, 3)
+      t = np.array(op.t().as_double())
+      self.operators.append((orth.dot(r).dot(frac), orth.dot(t)))
+    assert crystal_symmetry.space_group().all_ops()[0].is_unit_mx()
+    symbols = []
+    for element in pdb_hierarchy.atoms().extract_element():
+      element = element.strip()
+      if(len(element) == 2):
+        element = element[0] + element[1].lower()
+      symbols.append("H" if element=="D" else element)
+    # lattice vectors are the columns of the orthogonalization matrix
+    self.atoms = Atoms(symbols=symbols*len(self.operators), cell=orth.T,
+      pbc=True)
+    self.charge = restraints_manager.charge*len(self.operators)
+
+  def __call__(self, selection_and_sites_cart):
+    return self.target_and_gradients(
+      sites_cart = selection_and_sites_cart[1],
+      selection  = selection_and_sites_cart[0],
+      index      = selection_and_sites_cart[2])
+
+  def target_and_gradients(self, sites_cart, selection=None, index=None):
+    xyz = sites_cart.as_numpy_array()
+    self.atoms.set_positions(np.concatenate(
+      [xyz.dot(r.T)+t for r, t in self.operators]))
+    self.qm_engine.set_label(os.path.join(
+      self.restraints_manager.working_folder, "cell"))
+    self.qm_engine.run_qr(self.atoms,
+                          charge       = self.charge,
+                          pointcharges = None,
+                          coordinates  = None)
+    unit_convert = ase_units.mol/ase_units.kcal # ~ 23.06
+    energy = self.qm_engine.energy_free*unit_convert/len(self.operators)
+    gradients = flex.vec3_double(
+      (-1.0) * self.qm_engine.forces[:self.size]*unit_convert)
+    return energy, gradients
+
+  def energies_sites(self, sites_cart, compute_gradients=True):
+    tg = self.target_and_gradients(sites_cart=sites_cart)
+    return group_args(
+      target    = tg[0],
+      gradients = tg[1])
+
 #-------------------------------------------------------------------------------
 
 def get_cctbx_gradients(ph, cs, rm_only=False):
@@ -424,13 +501,20 @@ class from_cctbx(object):
       es = grm.select(super_selection).energies_sites(
         sites_cart=sites_cart.select(super_selection), compute_gradients=True)
       es.gradients = es.gradients[:selection.count(True)]
-      es.gradients = es.gradients * flex.double(
-            self.fragment_extracts.fragment_scales[index])
+      es.gradients = es.gradients * \
+        self.fragment_extracts.fragment_plan.scales(index)
     else:
       es = self.geometry_restraints_manager.energies_sites(
         sites_cart=sites_cart, compute_gradients=True)
     return es.target, es.gradients
 
+# engines that run inside the Python process and need no files
+in_process_engines = ["aimnet2", "aimnet2-old", "torchani", "pyscf", "server",
+                      "mopac-api"]
+# engines that cannot take point charges for charge embedding
+no_point_charge_engines = ["aimnet2", "aimnet2-old", "torchani", "pyscf",
+                           "server", "mopac-api"]
+
 class from_qm(object):
   def __init__(self,
       fragment_extracts          = None,
@@ -448,16 +532,22 @@ class from_qm(object):
       basis                      = "sto-3g",
       memory                     = None,
       nproc                      = 1,
-      url                        = None
+      url                        = None,
+      server_payload             = "binary",
+      server_batch_size          = None,
+      warm_start                 = False
   ):
     self.fragment_extracts  = fragment_extracts
     self.method = method
     self.basis = basis
     self.memory = memory
     self.nproc = nproc
+    self.warm_start = warm_start
     self.qm_addon = qm_addon
     self.qm_addon_method = qm_addon_method
     self.url = url
+    self.server_payload = server_payload
+    self.server_batch_size = server_batch_size
 
     self.crystal_symmetry = crystal_symmetry
     self.pdb_hierarchy = pdb_hierarchy
@@ -489,6 +579,9 @@ class from_qm(object):
                             scf="diis+a")
     elif(self.qm_engine_name == "mopac"):
       calculator = Mopac()
+    elif(self.qm_engine_name == "mopac-api"):
+      from .plugin.ase.mopac_api_qr import MopacAPI
+      calculator = MopacAPI()
     elif(self.qm_engine_name == "pyscf"):
       calculator = Pyscf()
     elif(self.qm_engine_name == "orca"):
@@ -506,9 +599,18 @@ class from_qm(object):
       model = 'aimnet2-qr' if self.method == 'rhf' else self.method  # replace class default method
       calculator = AIMNet2Calculator(model)
     elif(self.qm_engine_name == "xtb"):
-      calculator = GFNxTB()
+      calculator = None
+      try:
+        from .plugin.ase.xtb_api_qr import GFNxTBAPI
+        if(GFNxTBAPI.supports(self.method)): calculator = GFNxTBAPI()
+      except ImportError:
+        pass
+      # xtb executable if the xtb Python API is missing or the method is not
+      # supported by it
+      if(calculator is None): calculator = GFNxTB()
     elif(self.qm_engine_name == "server"):
-      calculator = RestAPICalculator(url=self.url)
+      calculator = RestAPICalculator(url=self.url,
+        payload=self.server_payload, batch_size=self.server_batch_size)
     else:
       raise Sorry("qm_calculator needs to be specified.")
     #
@@ -519,6 +621,7 @@ class from_qm(object):
                  'method',
                  'memory',
                  'nproc',
+                 'warm_start',
                  ]:
       value = getattr(self, attr, None)
       func = getattr(calculator, 'set_%s' % attr, None)
@@ -546,7 +649,72 @@ class from_qm(object):
       target    = tg[0],
       gradients = tg[1])
 
+  def in_memory(self):
+    """
+    Fragments are handed to in-process engines as arrays, without writing
+    files, unless clusters are saved or debugging is on. Point charges for
+    charge embedding are passed as a file, so they need the file path.
+    """
+    fe = self.fragment_extracts
+    in_process = (self.qm_engine_name in in_process_engines or
+      getattr(self.qm_engine, "in_process", False))
+    return (self.clustering and fe is not None and in_process and
+            not fe.charge_embedding and
+            self.qm_addon is None and
+            not (fe.save_clusters or fe.debug))
+
   def target_and_gradients(self,sites_cart, selection=None, index=None):
+    if(self.in_memory()):
+      return self.target_and_gradients_in_memory(
+        selection=selection, index=index)
+    job = self.fragment_job(sites_cart=sites_cart, selection=selection,
+      index=index)
+    cwd = os.getcwd()
+
+    #FOR DEBUGGING distance check
+    # print ''
+    # print '*distance check before QM calc*'
+    # thr=0.6
+    # for i in range(0,len(atoms)-1):
+    #   for j in range(i,len(atoms)):
+    #       if i==j: continue
+    #       x=atoms[i].position[0]-atoms[j].position[0]
+    #       y=atoms[i].position[1]-atoms[j].position[1]
+    #       z=atoms[i].position[2]-atoms[j].position[2]
+    #       dist=math.sqrt(x*x+y*y+z*z)
+    #       if(dist<=thr):
+    #         print 'WARNING: atoms ', i,j,' are closer than', thr,' A -> ',dist
+    self.qm_engine.run_qr(job.atoms,
+                          charge       = job.qm_charge,
+                          pointcharges = job.charge_file,
+                          coordinates  = job.qm_pdb_file[:-4]+".xyz",
+                          define_str   = job.define_str, # for Turbomole
+      )
+    os.chdir(cwd)
+    return self.job_target_and_gradients(job=job, qm_engine=self.qm_engine)
+
+  def submit(self, sites_cart, selection=None, index=None):
+    """
+    target_and_gradients as an awaitable, for engines that run an external
+    program (submit_qr): one process can keep many fragments running.
+    """
+    job = self.fragment_job(sites_cart=sites_cart, selection=selection,
+      index=index)
+    submission = self.qm_engine.submit_qr(job.atoms,
+      charge       = job.qm_charge,
+      pointcharges = job.charge_file,
+      coordinates  = job.qm_pdb_file[:-4]+".xyz",
+      define_str   = job.define_str)
+    async def result():
+      qm_engine = await submission
+      return self.job_target_and_gradients(job=job, qm_engine=qm_engine)
+    return result()
+
+  def fragment_job(self, sites_cart, selection, index):
+    """
+    Write the input of the QM engine for a fragment (the whole model if not
+    clustering) and set the engine label.
+    """
     if(self.clustering):
       from .fragment import get_qm_file_name_and_pdb_hierarchy
       from .fragment import charge
@@ -560,7 +728,7 @@ class from_qm(object):
                                       index=index)
       charge_file =  write_mm_charge_file(fragment_extracts=self.fragment_extracts,
                                       index=index)
-      gradients_scale = self.fragment_extracts.fragment_scales[index]
+      gradients_scale = self.fragment_extracts.fragment_plan.scales(index)
     else:
       self.pdb_hierarchy.atoms().set_xyz(sites_cart)
       self.pdb_hierarchy.write_pdb_file(file_name=self.file_name)
@@ -569,52 +737,98 @@ class from_qm(object):
       qm_charge = self.charge
       charge_file = None
       selection =flex.bool(self.system_size, True)
-      gradients_scale = [1.0]*self.system_size
-    define_str=''
+      gradients_scale = flex.double(self.system_size, 1.0)
     atoms = ase_atoms_from_pdb_hierarchy(ph, self.crystal_symmetry, self.qm_engine_name)
-    unit_convert = ase_units.mol/ase_units.kcal # ~ 23.06
     self.qm_engine.set_label(qm_pdb_file[:-4])
-    cwd = os.getcwd()
-
-    #FOR DEBUGGING distance check
-    # print ''
-    # print '*distance check before QM calc*'
-    # thr=0.6
-    # for i in range(0,len(atoms)-1):
-    #   for j in range(i,len(atoms)):
-    #       if i==j: continue
-    #       x=atoms[i].position[0]-atoms[j].position[0]
-    #       y=atoms[i].position[1]-atoms[j].position[1]
-    #       z=atoms[i].position[2]-atoms[j].position[2]
-    #       dist=math.sqrt(x*x+y*y+z*z)
-    #       if(dist<=thr):
-    #         print 'WARNING: atoms ', i,j,' are closer than', thr,' A -> ',dist
-    self.qm_engine.run_qr(atoms,
-                          charge       = qm_charge,
-                          pointcharges = charge_file,
-                          coordinates  = qm_pdb_file[:-4]+".xyz",
-                          define_str   = define_str, # for Turbomole
-      )
-    os.chdir(cwd)
+    return group_args(
+      atoms           = atoms,
+      qm_charge       = qm_charge,
+      charge_file     = charge_file,
+      qm_pdb_file     = qm_pdb_file,
+      define_str      = '',
+      selection       = selection,
+      gradients_scale = gradients_scale)
+
+  def job_target_and_gradients(self, job, qm_engine):
+    unit_convert = ase_units.mol/ase_units.kcal # ~ 23.06
     if self.qm_addon is not None:
-      tool_e,tool_g= qr_tools.qm_toolbox(atoms,
-                              charge=qm_charge,
-                              pointcharges=charge_file,
-                              label=qm_pdb_file[:-4],
+      tool_e,tool_g= qr_tools.qm_toolbox(job.atoms,
+                              charge=job.qm_charge,
+                              pointcharges=job.charge_file,
+                              label=job.qm_pdb_file[:-4],
                               addon=self.qm_addon,addon_method=self.qm_addon_method)
-      energy = (self.qm_engine.energy_free+tool_e)*unit_convert
-      ase_gradients = (tool_g-self.qm_engine.forces)*unit_convert
+      energy = (qm_engine.energy_free+tool_e)*unit_convert
+      ase_gradients = (tool_g-qm_engine.forces)*unit_convert
     else:
-      energy = self.qm_engine.energy_free*unit_convert
-      ase_gradients = (-1.0) * self.qm_engine.forces*unit_convert
+      energy = qm_engine.energy_free*unit_convert
+      ase_gradients = (-1.0) * qm_engine.forces*unit_convert
     # remove capping and neigbouring buffer
-    gradients = ase_gradients[:selection.count(True)]
+    gradients = ase_gradients[:job.selection.count(True)]
     gradients =  flex.vec3_double(gradients)
     ## TODO
     ## unchange the altloc gradient, averagely scale the non-altloc gradient
-    gradients = gradients*flex.double(gradients_scale)
+    gradients = gradients*job.gradients_scale
     return energy, gradients
 
+  def batched(self):
+    """
+    All fragments of a step are handed to the engine in one call if it can
+    evaluate a batch of molecules at once (one forward/backward pass of the
+    ML potentials).
+    """
+    return self.in_memory() and hasattr(self.qm_engine, "run_qr_batch")
+
+  def fragment_atoms(self, index):
+    from .fragment import get_fragment_symbols_and_positions
+    from .fragment import charge
+    symbols, positions = get_fragment_symbols_and_positions(
+      fragment_extracts=self.fragment_extracts, index=index)
+    atoms = ase_atoms(symbols, positions, self.crystal_symmetry,
+      self.qm_engine_name)
+    return atoms, charge(fragment_extracts=self.fragment_extracts, index=index)
+
+  def fragment_target_and_gradients(self, energy_free, forces, selection,
+                                    index):
+    unit_convert = ase_units.mol/ase_units.kcal # ~ 23.06
+    energy = energy_free*unit_convert
+    ase_gradients = (-1.0) * forces*unit_convert
+    # remove capping and neigbouring buffer
+    gradients = flex.vec3_double(ase_gradients[:selection.count(True)])
+    gradients = gradients*self.fragment_extracts.fragment_plan.scales(index)
+    return energy, gradients
+
+  def target_and_gradients_in_memory(self, selection, index):
+    atoms, qm_charge = self.fragment_atoms(index)
+    self.qm_engine.set_label(os.path.join(
+      self.fragment_extracts.working_folder, str(index), str(index)))
+    self.qm_engine.run_qr(atoms,
+                          charge       = qm_charge,
+                          pointcharges = None,
+                          coordinates  = None)
+    return self.fragment_target_and_gradients(
+      energy_free = self.qm_engine.energy_free,
+      forces      = self.qm_engine.forces,
+      selection   = selection,
+      index       = index)
+
+  def target_and_gradients_batch(self, selections, indices):
+    """
+    Energies and gradients of fragments indices from one engine call.
+    """
+    atoms_list, charges = [], []
+    for index in indices:
+      atoms, qm_charge = self.fragment_atoms(index)
+      atoms_list.append(atoms)
+      charges.append(qm_charge)
+    results = self.qm_engine.run_qr_batch(atoms_list, charges)
+    return [self.fragment_target_and_gradients(
+              energy_free = energy_free,
+              forces      = forces,
+              selection   = selection,
+              index       = index)
+            for (energy_free, forces), selection, index in zip(
+              results, selections, indices)]
+
 from ase import Atoms
 def ase_atoms_from_pdb_hierarchy(ph, crystal_symmetry, qm_engine_name):
 
@@ -631,12 +845,12 @@ def ase_atoms_from_pdb_hierarchy(ph, crystal_symmetry, qm_engine_name):
           positions.append(list(atom.xyz))
     return symbols, positions
   symbols, positions = read_pdb_hierarchy(ph)
-  if(qm_engine_name == "torchani"):
-    unit_cell = crystal_symmetry.unit_cell().parameters()
-    return Atoms(symbols=symbols, positions=positions, pbc=True, cell=unit_cell)
-  else:
-    #
-    # XXX Ugly work-around to by-pass inability of ASE to handle D atoms.
-    #
-    symbols = ["H" if symbol=="D" else symbol for symbol in symbols]
-    return Atoms(symbols=symbols, positions=positions)
+  return ase_atoms(symbols, positions, crystal_symmetry, qm_engine_name)
+
+def ase_atoms(symbols, positions, crystal_symmetry, qm_engine_name):
+  # fragments and super-spheres are not periodic, see from_periodic
+  #
+  # XXX Ugly work-around to by-pass inability of ASE to handle D atoms.
+  #
+  symbols = ["H" if symbol=="D" else symbol for symbol in symbols]
+  return Atoms(symbols=symbols, positions=positions)
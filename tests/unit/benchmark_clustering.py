@@ -0,0 +1,39 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+import time
+from qrefine.clustering import betweenness_centrality_clustering
+from qrefine.tests.unit.interaction_graphs import synthetic_interactions
+
+def run(sizes=(500, 1000, 2000), max_uncached=1000):
+  """
+  Time betweenness centrality clustering of synthetic protein-like graphs
+  with cached edge centralities and, up to max_uncached residues, with the
+  centralities of the whole graph recomputed for each removed edge. Not part
+  of the unit tests (minutes for the largest graph), see tst_56.
+
+    qrefine.python benchmark_clustering.py [n_residues ...]
+  """
+  for n_residues in sizes:
+    interaction_list = synthetic_interactions(n_residues, seed=n_residues)
+    result = []
+    for cached_centrality in [True, False]:
+      if(n_residues > max_uncached and not cached_centrality): continue
+      t0 = time.time()
+      clusters = betweenness_centrality_clustering(
+        interaction_list,
+        size                       = n_residues,
+        maxnum_residues_in_cluster = 15,
+        bcc_threshold              = 9,
+        cached_centrality          = cached_centrality).get_clusters()
+      print("residues: %d edges: %d cached centrality=%s time: %.2f"%(
+        n_residues, len(interaction_list), cached_centrality, time.time()-t0))
+      result.append(clusters)
+    if(len(result) == 2):
+      assert result[0] == result[1]
+
+if(__name__ == "__main__"):
+  if(len(sys.argv) > 1): run(sizes=[int(n) for n in sys.argv[1:]])
+  else:                  run()
@@ -0,0 +1,27 @@
+from __future__ import division
+from __future__ import absolute_import
+import numpy as np
+
+def synthetic_interactions(n_residues, seed=0):
+  """
+  Residue interaction graph of a random chain confined to a sphere of
+  protein density (~130 A**3 per residue, 3.8 A steps like C-alpha atoms):
+  consecutive residues plus residue pairs closer than 5 A.
+  """
+  rng = np.random.RandomState(seed)
+  radius = (3*130.*n_residues/(4*np.pi))**(1./3)
+  xyz = np.zeros((n_residues, 3))
+  n = 1
+  while n < n_residues:
+    step = rng.normal(size=3)
+    p = xyz[n-1]+3.8*step/np.sqrt((step*step).sum())
+    if(np.sqrt((p*p).sum()) < radius and
+       np.sqrt(((xyz[max(0,n-50):n]-p)**2).sum(axis=1)).min() > 3.0):
+      xyz[n] = p
+      n += 1
+  result = []
+  for i in range(n_residues):
+    d = np.sqrt(((xyz[i+1:]-xyz[i])**2).sum(axis=1))
+    for j in np.flatnonzero(d < 5.0):
+      result.append([i+1, i+j+2])
+  return result
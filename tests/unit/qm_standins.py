@@ -0,0 +1,95 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import sys
+from ase import Atoms
+
+# Stand-in executables: minimal output in the format the plugins read, one
+# restart file, and a line in runs.log telling whether a restart was used.
+standin = '''
+import os, re, sys
+name = sys.argv[1]
+def log(used_restart):
+  with open(%(log)s, "a") as f:
+    f.write("%%s %%s\\n" %% (name, used_restart))
+def n_atoms(lines):
+  return len([l for l in lines if len(l.split()) == 4])
+if(name == "mopac"):
+  label = sys.argv[2][:-4]
+  lines = open(sys.argv[2]).read().splitlines()
+  log("OLDENS" in lines[0] and os.path.isfile(label+".den"))
+  with open(label+".out", "w") as f:
+    f.write(" FINAL HEAT OF FORMATION =  -10.0 KCAL/MOL\\n GRADIENT\\n")
+    for i in range(3*len([l for l in lines[3:] if l.strip()])):
+      f.write(" "*49+"%%13.6f\\n" %% 1.0)
+  open(label+".den", "w").write("density")
+elif(name == "orca"):
+  label = sys.argv[2][:-4]
+  text = open(sys.argv[2]).read()
+  moinp = re.findall('%%moinp "(.*)"', text)
+  log("MORead" in text and os.path.isfile(moinp[0]))
+  print("FINAL SINGLE POINT ENERGY  -1.0\\nCARTESIAN GRADIENT\\n---\\n")
+  for i in range(n_atoms(text.split("* xyz")[1].splitlines())):
+    print("%%d C : 0.1 0.1 0.1" %% i)
+  open(label+".gbw", "w").write("orbitals")
+elif(name == "xtb"):
+  log(os.path.isfile("xtbrestart"))
+  n = int(open(sys.argv[2]).readline())
+  print("| TOTAL ENERGY  -1.0 Eh |")
+  with open("gradient", "w") as f:
+    f.write("$grad\\n  cycle =      1\\n")
+    f.write("0 0 0 C\\n"*n+"0.1 0.1 0.1\\n"*n+"$end\\n")
+  open("xtbrestart", "w").write("wavefunction")
+elif(name == "define"):
+  log(True)
+  open("control", "w").write("$rij\\n$scfmo file=mos\\n$end\\n")
+  open("mos", "w").write("eht")
+elif(name == "ridft"):
+  open("energy", "w").write("$energy\\n     1   -1.0   0 0\\n$end\\n")
+  open("mos", "w").write("converged")
+elif(name == "rdgrad"):
+  n = len(open("coord").read().splitlines())-2
+  with open("gradient", "w") as f:
+    f.write("$grad\\n  cycle =      1\\n")
+    f.write("0 0 0 c\\n"*n+"0.1 0.1 0.1\\n"*n+"$end\\n")
+'''
+
+def write_standins():
+  log = os.path.abspath("runs.log")
+  with open("standin.py", "w") as f:
+    f.write(standin % {"log": repr(log)})
+  os.mkdir("bin")
+  for name in ["mopac", "orca", "xtb", "define", "ridft", "rdgrad"]:
+    file_name = os.path.abspath(os.path.join("bin", name))
+    with open(file_name, "w") as f:
+      f.write('#!/bin/sh\nexec %s %s %s "$@"\n' % (
+        sys.executable, os.path.abspath("standin.py"), name))
+    os.chmod(file_name, 0o755)
+  os.environ["PATH"] = os.path.abspath("bin")+os.pathsep+os.environ["PATH"]
+  os.environ["ORCA_COMMAND"] = os.path.abspath(os.path.join("bin", "orca"))
+
+def restarts(name):
+  """
+  Restart used in each run of the stand-in name.
+  """
+  result = []
+  for line in open("runs.log").read().splitlines():
+    if(line.split()[0] == name):
+      result.append(line.split()[1] == "True")
+  return result
+
+def molecules():
+  """
+  Fragment, fragment with moved atoms, other atoms in the same directory.
+  """
+  ch4 = Atoms('CHHHH', [[0.03192167, 0.00638559, 0.01301679],
+                        [-0.83140486, 0.39370209, -0.26395324],
+                        [-0.66518241, -0.84461308, 0.20759389],
+                        [0.45554739, 0.54289633, 0.81170881],
+                        [0.66091919, -0.16799635, -0.91037834]])
+  moved = ch4.copy()
+  moved.positions += 0.01
+  nh3 = Atoms('NHHH', ch4.positions[:4])
+  return [ch4, moved, nh3, nh3]
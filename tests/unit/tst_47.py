@@ -0,0 +1,86 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from scitbx.array_family import flex
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests_data = os.path.join(qrefine,"tests","unit","data_files")
+
+def check_fragments(fq):
+  n_residues = len(list(fq.pdb_hierarchy.residue_groups()))
+  residues = []
+  for cluster in fq.clusters:
+    residues.extend(cluster)
+  assert sorted(residues) == list(range(1, n_residues+1))
+  cluster_atoms = []
+  for i, cluster in enumerate(fq.clusters):
+    cluster_atoms.extend(fq.cluster_atoms[i])
+    assert fq.cluster_selections[i].count(True) == len(fq.cluster_atoms[i])
+    assert set(fq.cluster_atoms[i]).issubset(set(fq.fragment_super_atoms[i]))
+  assert sorted(cluster_atoms) == list(range(1, fq.system_size+1))
+  sizes = [len(c) for c in fq.clusters]
+  assert sizes == sorted(sizes, reverse=True)
+
+def run(prefix):
+  """
+  Exercise incremental re-clustering.
+  """
+  pdb_inp = iotbx.pdb.input(
+    file_name=os.path.join(qr_unit_tests_data,"2lvr.pdb"))
+  ph = pdb_inp.construct_hierarchy()
+  fq = fragments(
+    pdb_hierarchy              = ph,
+    crystal_symmetry           = pdb_inp.crystal_symmetry(),
+    maxnum_residues_in_cluster = 8,
+    incremental_re_clustering  = True)
+  check_fragments(fq)
+  clusters = [list(c) for c in fq.clusters]
+  fragment_super_atoms = [list(f) for f in fq.fragment_super_atoms]
+  molecules_in_fragments = [list(m) for m in fq.molecules_in_fragments]
+  capped = list(fq.fragment_capped_initial)
+  super_interaction_list = set(fq.super_interaction_list)
+  # Nothing moved: nothing is rebuilt
+  fq.re_cluster()
+  assert fq.clusters == clusters
+  assert fq.fragment_super_atoms == fragment_super_atoms
+  for c1, c2 in zip(capped, fq.fragment_capped_initial):
+    assert c1 is c2
+  # Move the last residue: only clusters touching changed contacts are rebuilt
+  sites_cart = ph.atoms().extract_xyz()
+  last = list(ph.residue_groups())[-1]
+  for atom in last.atoms():
+    sites_cart[atom.i_seq] = (flex.vec3_double([atom.xyz]) +
+      flex.vec3_double([(1.5, 0, 0)]))[0]
+  fq.update_xyz(sites_cart)
+  fq.re_cluster()
+  check_fragments(fq)
+  n_residues = len(list(ph.residue_groups()))
+  changed_residues = set([residue for pair in
+    fq.super_interaction_list.symmetric_difference(super_interaction_list)
+    for residue in pair if residue <= n_residues])
+  assert n_residues in changed_residues
+  # clusters without changed residues keep their fragments, as they were
+  n_kept = 0
+  for i, cluster in enumerate(clusters):
+    if(changed_residues.intersection(cluster) or (fq.two_buffers and
+       changed_residues.intersection(molecules_in_fragments[i]))):
+      continue
+    j = [list(c) for c in fq.clusters].index(cluster)
+    assert fq.fragment_capped_initial[j] is capped[i]
+    assert fq.fragment_super_atoms[j] == fragment_super_atoms[i]
+    n_kept += 1
+  print("fragments kept: %d of %d"%(n_kept, len(fq.clusters)))
+  assert 0 < n_kept < len(fq.clusters)
+  # rebuilt fragments are new
+  assert len([c for c in fq.fragment_capped_initial
+              if [x for x in capped if x is c]]) == n_kept
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
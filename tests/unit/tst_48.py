@@ -0,0 +1,48 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import time
+import iotbx.pdb
+import libtbx.load_env
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests_data = os.path.join(qrefine,"tests","unit","data_files")
+
+def run(prefix):
+  """
+  Contact index gives the same fragments as per-cluster
+  pair_interaction.run(copy.deepcopy(ph), cluster), benchmark both.
+  """
+  pdb_inp = iotbx.pdb.input(
+    file_name=os.path.join(qr_unit_tests_data,"2lvr.pdb"))
+  ph = pdb_inp.construct_hierarchy()
+  for two_buffers in [False, True]:
+    fq = fragments(
+      pdb_hierarchy              = ph,
+      crystal_symmetry           = pdb_inp.crystal_symmetry(),
+      maxnum_residues_in_cluster = 8,
+      two_buffers                = two_buffers,
+      clusters_only              = True)
+    fq.pdb_hierarchy_super.atoms_reset_serial()
+    result = []
+    for use_contact_index in [False, True]:
+      t0 = time.time()
+      cluster_atoms, fragment_atoms, molecules = fq._get_fragment_atoms(
+        ph                = fq.pdb_hierarchy_super,
+        clusters          = fq.clusters,
+        use_contact_index = use_contact_index)
+      print("two_buffers=%s contact index=%s time: %.2f"%(
+        two_buffers, use_contact_index, time.time()-t0))
+      result.append([
+        [sorted(x) for x in cluster_atoms],
+        [sorted(x) for x in fragment_atoms],
+        [sorted(x) for x in molecules]])
+    assert result[0] == result[1]
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,61 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import random
+import iotbx.pdb
+import libtbx.load_env
+from scitbx.array_family import flex
+from libtbx.test_utils import approx_equal
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests_data = os.path.join(qrefine,"tests","unit","data_files")
+
+def selection(size, serials):
+  result = flex.bool(size, False)
+  for i in serials:
+    if(i<=size): result[i-1] = True
+  return result
+
+def run(prefix):
+  """
+  Fragment plan selections, scales and gradient assembly match the nested
+  lists of 1-based serials.
+  """
+  pdb_inp = iotbx.pdb.input(
+    file_name=os.path.join(qr_unit_tests_data,"2lvr.pdb"))
+  ph = pdb_inp.construct_hierarchy()
+  fq = fragments(
+    pdb_hierarchy              = ph,
+    crystal_symmetry           = pdb_inp.crystal_symmetry(),
+    maxnum_residues_in_cluster = 8)
+  plan = fq.fragment_plan
+  system_size = fq.system_size
+  super_size = fq.pdb_hierarchy_super.atoms_size()
+  assert plan.n_fragments == len(fq.clusters)
+  gradients = flex.vec3_double(system_size)
+  gradients_plan = flex.vec3_double(system_size)
+  for i in range(plan.n_fragments):
+    fragment_selection = selection(system_size, fq.fragment_super_atoms[i])
+    cluster_selection = selection(system_size, fq.cluster_atoms[i])
+    assert plan.fragment_selection(i).all_eq(fragment_selection)
+    assert plan.cluster_selection(i).all_eq(cluster_selection)
+    assert plan.fragment_super_selection(i).all_eq(
+      selection(super_size, fq.fragment_super_atoms[i]))
+    assert approx_equal(plan.scales(i), fq.fragment_scales[i])
+    g = flex.vec3_double([(random.random(), random.random(), random.random())
+      for j in range(fragment_selection.count(True))])
+    buffer_selection = fq.buffer_selections[i]
+    gradients_i = flex.vec3_double(system_size)
+    gradients_i = gradients_i.set_selected(fragment_selection, g)
+    gradients_i = gradients_i.set_selected(buffer_selection, [0,0,0])
+    gradients += gradients_i
+    plan.add_gradients(gradients=gradients_plan, i=i, fragment_gradients=g)
+  assert approx_equal(gradients, gradients_plan)
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,43 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests_data = os.path.join(qrefine,"tests","unit","data_files")
+
+def run(prefix):
+  """
+  Bonded-to-altloc mask from the neighbour grid matches the distance check
+  against every altloc atom.
+  """
+  pdb_inp = iotbx.pdb.input(
+    file_name=os.path.join(qr_unit_tests_data,"h_altconf.pdb"))
+  ph = pdb_inp.construct_hierarchy()
+  fq = fragments(
+    pdb_hierarchy    = ph,
+    crystal_symmetry = pdb_inp.crystal_symmetry(),
+    altloc_method    = "average",
+    clusters_only    = True)
+  atoms = list(ph.atoms())
+  altloc_atoms = [a for a in atoms if a.pdb_label_columns()[4]!=" "]
+  assert len(altloc_atoms) > 0
+  mask = fq.get_bonded_to_altloc_mask()
+  for i, atom in enumerate(atoms):
+    expected = False
+    for altloc_atom in altloc_atoms:
+      if(atom.distance(altloc_atom)<1.7):
+        expected = True
+        break
+    assert bool(mask[i]) == expected
+    assert fq.bond_with_altloc(i+1, True) == expected
+    assert fq.bond_with_altloc(i+1, False) == False
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
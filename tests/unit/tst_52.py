@@ -0,0 +1,45 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from qrefine.charges import charges_class
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests_data = os.path.join(qrefine,"tests","unit","data_files")
+
+def run(prefix):
+  """
+  Fragment charges from whole-system formal charges match the charge
+  calculation on each capped fragment, also after re-clustering.
+  """
+  for file_name in ["2lvr.pdb", "p212121.pdb"]:
+    pdb_inp = iotbx.pdb.input(
+      file_name=os.path.join(qr_unit_tests_data, file_name))
+    ph = pdb_inp.construct_hierarchy()
+    fq = fragments(
+      pdb_hierarchy              = ph,
+      crystal_symmetry           = pdb_inp.crystal_symmetry(),
+      maxnum_residues_in_cluster = 4,
+      whole_system_charges       = True)
+    assert fq.super_formal_charges is not None
+    for i, capped in enumerate(fq.fragment_capped_initial):
+      charge = charges_class(
+        pdb_hierarchy    = capped,
+        crystal_symmetry = fq.expansion.cs_box).get_total_charge()
+      assert fq.fragment_charges[i] == charge, [
+        file_name, i, fq.fragment_charges[i], charge]
+  # rebuilt fragments get formal charges of the current coordinates
+  super_formal_charges = fq.super_formal_charges
+  fq.update_xyz(ph.atoms().extract_xyz()+(0.1, 0, 0))
+  fq.re_cluster()
+  assert fq.super_formal_charges is not None
+  assert fq.super_formal_charges is not super_formal_charges
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,74 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import gc
+import weakref
+import mmtbx.command_line
+import libtbx.load_env
+from libtbx.test_utils import approx_equal
+from qrefine.cluster_restraints import from_cluster
+from qrefine.restraints import from_cctbx
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+from qrefine.tests.unit.tst_10 import get_model
+
+master_params_str ="""
+method = *multiprocessing pbs sge lsf threading
+.type = choice(multi=False)
+nproc = 2
+.type = int
+qsub_command = None
+.type = str
+persistent_pool = True
+.type = bool
+"""
+
+def get_parallel_params(persistent_pool):
+  params = mmtbx.command_line.generate_master_phil_with_inputs(
+    phil_string=master_params_str).extract()
+  params.persistent_pool = persistent_pool
+  return params
+
+def run(prefix):
+  """
+  Persistent worker pool gives the same gradients as parallel_map, is kept
+  between steps and shut down by close(), which lets the restraints manager
+  go.
+  """
+  result = []
+  for persistent_pool in [False, True]:
+    rm, cs, h = get_model()
+    fm = fragments(
+      working_folder             = "./ase/",
+      maxnum_residues_in_cluster = 2,
+      pdb_hierarchy              = h.deep_copy(),
+      qm_engine_name             = "mopac",
+      crystal_symmetry           = cs)
+    fc = from_cluster(
+      restraints_manager = from_cctbx(restraints_manager = rm),
+      fragment_manager   = fm,
+      parallel_params    = get_parallel_params(persistent_pool))
+    sites_cart = h.atoms().extract_xyz()
+    gradients = []
+    for shift in [0, 0.01]:
+      energy, g = fc.target_and_gradients(sites_cart=sites_cart+(shift,0,0))
+      gradients.append(g)
+      if(persistent_pool):
+        if(shift==0): pool = fc.worker_pool
+        assert fc.worker_pool is pool
+    fc.close()
+    assert fc.worker_pool is None
+    # nothing keeps a closed restraints manager alive
+    fc_ref = weakref.ref(fc)
+    del fc
+    gc.collect()
+    assert fc_ref() is None
+    result.append(gradients)
+  for g1, g2 in zip(result[0], result[1]):
+    assert approx_equal(g1, g2, eps=1.e-9)
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,33 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from qrefine.cluster_restraints import fragment_scheduler
+from qrefine.tests.unit import run_tests
+
+def run(prefix):
+  """
+  Fragment scheduler: longest-first by estimated cost, then by measured time.
+  """
+  plan = object()
+  s = fragment_scheduler(engine_name="mopac")
+  assert s.exponent == 1
+  s.reset(plan=plan, sizes=[10, 40, 20, 30])
+  assert s.order() == [1, 3, 2, 0]
+  assert fragment_scheduler(engine_name="orca").exponent == 3
+  # measured times replace estimates, unmeasured ones are rescaled
+  s.update(timings=[(0, 5., 1), (1, 1., 2)], wall_time=5.)
+  assert s.order() == [3, 2, 0, 1]
+  costs = s.costs()
+  assert costs[0] == 5. and costs[1] == 1.
+  assert abs(costs[2] - 20*(5./10+1./40)/2) < 1.e-9
+  # same plan keeps measurements, a new plan starts over
+  s.reset(plan=plan, sizes=[10, 40, 20, 30])
+  assert s.order() == [3, 2, 0, 1]
+  s.reset(plan=object(), sizes=[10, 40, 20, 30])
+  assert s.order() == [1, 3, 2, 0]
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,94 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import mmtbx.command_line
+import libtbx.load_env
+from libtbx.utils import Sorry
+from libtbx.test_utils import approx_equal
+from qrefine.cluster_restraints import from_cluster
+from qrefine.restraints import from_cctbx
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+from qrefine.tests.unit.tst_10 import get_model
+
+master_params_str ="""
+method = *multiprocessing pbs sge lsf threading
+.type = choice(multi=False)
+nproc = 1
+.type = int
+qsub_command = None
+.type = str
+fragment_retries = 2
+.type = int
+retry_backoff = 0
+.type = float
+"""
+
+class flaky_cctbx(from_cctbx):
+  """
+  cctbx restraints failing the first n_failures times for one fragment.
+  """
+  def __init__(self, restraints_manager, fail_index, n_failures):
+    from_cctbx.__init__(self, restraints_manager=restraints_manager)
+    self.fail_index = fail_index
+    self.n_failures = n_failures
+    self.calls = []
+
+  def target_and_gradients(self, sites_cart, selection=None, index=None):
+    self.calls.append(index)
+    if(index==self.fail_index and self.n_failures>0):
+      self.n_failures -= 1
+      raise RuntimeError("flaky fragment %d"%index)
+    return from_cctbx.target_and_gradients(self, sites_cart=sites_cart,
+      selection=selection, index=index)
+
+def get_from_cluster(n_failures, fallback=False):
+  rm, cs, h = get_model()
+  fm = fragments(
+    working_folder             = "./ase/",
+    maxnum_residues_in_cluster = 2,
+    pdb_hierarchy              = h.deep_copy(),
+    qm_engine_name             = "mopac",
+    crystal_symmetry           = cs)
+  fallback_restraints_manager = None
+  if(fallback): fallback_restraints_manager = from_cctbx(restraints_manager=rm)
+  return h, from_cluster(
+    restraints_manager          = flaky_cctbx(rm, 1, n_failures),
+    fragment_manager            = fm,
+    parallel_params             = mmtbx.command_line.\
+      generate_master_phil_with_inputs(phil_string=master_params_str).extract(),
+    fallback_restraints_manager = fallback_restraints_manager)
+
+def run(prefix):
+  """
+  Only failed fragments are retried; persistent failures go to the fallback
+  restraints or stop refinement.
+  """
+  h, fc = get_from_cluster(n_failures=0)
+  n_fragments = len(fc.fragment_manager.fragment_selections)
+  _, g_ref = fc.target_and_gradients(sites_cart=h.atoms().extract_xyz())
+  # one failure: only fragment 1 is repeated
+  h, fc = get_from_cluster(n_failures=1)
+  _, g = fc.target_and_gradients(sites_cart=h.atoms().extract_xyz())
+  assert approx_equal(g, g_ref)
+  calls = fc.restraints_manager.calls
+  assert len(calls) == n_fragments+1
+  assert calls.count(1) == 2
+  # failures beyond retries: fallback restraints
+  h, fc = get_from_cluster(n_failures=10, fallback=True)
+  _, g = fc.target_and_gradients(sites_cart=h.atoms().extract_xyz())
+  assert approx_equal(g, g_ref)
+  assert fc.restraints_manager.calls.count(1) == 3
+  # no fallback: stop
+  h, fc = get_from_cluster(n_failures=10)
+  try:
+    fc.target_and_gradients(sites_cart=h.atoms().extract_xyz())
+  except Sorry as e:
+    assert str(e).find("fragment(s): 1")>-1
+  else: raise AssertionError("Sorry expected")
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,33 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from qrefine.clustering import betweenness_centrality_clustering
+from qrefine.tests.unit.interaction_graphs import synthetic_interactions
+from qrefine.tests.unit import run_tests
+
+def run(prefix):
+  """
+  Cached edge centralities give the same clusters as recomputing the
+  centralities of the whole graph for each removed edge. Timings of larger
+  graphs: benchmark_clustering.py.
+  """
+  for n_residues in [60, 100, 150]:
+    for seed in range(3):
+      interaction_list = synthetic_interactions(n_residues, seed=seed)
+      result = []
+      for cached_centrality in [True, False]:
+        result.append(betweenness_centrality_clustering(
+          interaction_list,
+          size                       = n_residues,
+          maxnum_residues_in_cluster = 15,
+          bcc_threshold              = 9,
+          cached_centrality          = cached_centrality).get_clusters())
+      assert sorted(sum(result[0], [])) == list(range(1, n_residues+1))
+      assert len(result[0]) > 1
+      assert result[0] == result[1], [n_residues, seed]
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
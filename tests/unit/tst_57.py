@@ -0,0 +1,85 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import time
+import numpy as np
+import iotbx.pdb
+import libtbx.load_env
+from qrefine.clustering import betweenness_centrality_clustering
+from qrefine.clustering import multilevel_bisection_clustering
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+from qrefine.tests.unit.interaction_graphs import synthetic_interactions
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests_data = os.path.join(qrefine,"tests","unit","data_files")
+
+def cut_edges(interaction_list, clusters):
+  cluster_of = {}
+  for i, cluster in enumerate(clusters):
+    for residue in cluster:
+      cluster_of[residue] = i
+  return len([1 for pair in interaction_list
+    if cluster_of[pair[0]] != cluster_of[pair[1]]])
+
+def run(prefix):
+  """
+  clustering_method=bisection: clusters cover all residues, fragments
+  (cluster + buffer) stay within the atom budget, bisection cuts at bridges.
+  """
+  # two 6-cliques joined by a single interaction
+  interaction_list = [[6, 7]]
+  for first in [1, 7]:
+    for i in range(first, first+6):
+      for j in range(i+1, first+6):
+        interaction_list.append([i, j])
+  c = multilevel_bisection_clustering(
+    interaction_list,
+    residue_atoms            = [10]*12,
+    maxnum_atoms_in_fragment = 80)
+  assert sorted(c.get_clusters()) == [list(range(1, 7)), list(range(7, 13))]
+  # synthetic protein-like graphs
+  for n_residues in [500, 1000]:
+    interaction_list = synthetic_interactions(n_residues, seed=n_residues)
+    residue_atoms = list(
+      np.random.RandomState(0).randint(7, 25, size=n_residues))
+    t0 = time.time()
+    c = multilevel_bisection_clustering(
+      interaction_list,
+      residue_atoms            = residue_atoms,
+      maxnum_atoms_in_fragment = 400)
+    clusters = c.get_clusters()
+    print("residues: %d clusters: %d cut: %d time: %.2f"%(n_residues,
+      len(clusters), cut_edges(interaction_list, clusters), time.time()-t0))
+    assert sorted(sum(clusters, [])) == list(range(1, n_residues+1))
+    for cluster in clusters:
+      if(len(cluster) > 1):
+        assert c.fragment_atoms([r-1 for r in cluster]) <= 400
+    if(n_residues == 500):
+      clusters = betweenness_centrality_clustering(
+        interaction_list,
+        size                       = n_residues,
+        maxnum_residues_in_cluster = 15).get_clusters()
+      print("bcc clusters: %d cut: %d largest fragment: %d"%(len(clusters),
+        cut_edges(interaction_list, clusters),
+        max([c.fragment_atoms([r-1 for r in cluster])
+          for cluster in clusters])))
+  # fragments
+  pdb_inp = iotbx.pdb.input(
+    file_name=os.path.join(qr_unit_tests_data,"2lvr.pdb"))
+  ph = pdb_inp.construct_hierarchy()
+  fq = fragments(
+    pdb_hierarchy            = ph,
+    crystal_symmetry         = pdb_inp.crystal_symmetry(),
+    clustering_method        = "bisection",
+    maxnum_atoms_in_fragment = 300,
+    clusters_only            = True)
+  n_residues = len(list(ph.residue_groups()))
+  assert sorted(sum(fq.clusters, [])) == list(range(1, n_residues+1))
+  assert len(fq.clusters) > 1
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
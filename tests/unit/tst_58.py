@@ -0,0 +1,65 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from qrefine.fragment import fragments, deduplicate_fragments
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests_data = os.path.join(qrefine,"tests","unit","data_files")
+
+def add_altloc_c(file_name):
+  """
+  h_altconf.pdb with a third conformer C, a copy of B shifted by 0.1 A.
+  """
+  lines = []
+  for line in open(file_name).read().splitlines():
+    lines.append(line)
+    if(line.startswith("ATOM") and line[16]=="B"):
+      x = float(line[30:38])+0.1
+      lines.append(line[:16]+"C"+line[17:30]+"%8.3f"%x+line[38:])
+  return "\n".join(lines)
+
+def run(prefix):
+  """
+  Identical fragments from different altloc hierarchies are computed once,
+  with summed gradient scales.
+  """
+  # merged scales follow the atoms, not their order
+  cluster_atoms = [[1, 2], [3], [2, 1]]
+  fragment_super_atoms = [[1, 2, 3, 7], [3, 4], [2, 7, 1, 3]]
+  fragment_scales = [[1.0, 1.0, 1.0], [1.0, 1.0], [-1.0, 0.5, -1.0]]
+  c, f, s, m = deduplicate_fragments(
+    cluster_atoms        = cluster_atoms,
+    fragment_super_atoms = fragment_super_atoms,
+    fragment_scales      = fragment_scales,
+    system_size          = 6)
+  assert c == [[1, 2], [3]]
+  assert f == [[1, 2, 3, 7], [3, 4]]
+  assert s == [[1.5, 0.0, 0.0], [1.0, 1.0]]
+  assert m == [2, 1]
+  # three conformers: overlaps of A with B and with C are the same fragment
+  pdb_inp = iotbx.pdb.input(source_info=None, lines=add_altloc_c(
+    os.path.join(qr_unit_tests_data,"h_altconf.pdb")))
+  ph = pdb_inp.construct_hierarchy()
+  fq = fragments(
+    pdb_hierarchy    = ph,
+    crystal_symmetry = pdb_inp.crystal_symmetry(),
+    altloc_method    = "subtract",
+    clusters_only    = True)
+  fq.get_fragments()
+  keys = set([(frozenset(c), frozenset(f))
+    for c, f in zip(fq.cluster_atoms, fq.fragment_super_atoms)])
+  assert len(keys) == len(fq.cluster_atoms)
+  assert len(fq.fragment_multiplicities) == len(fq.cluster_atoms)
+  assert sum(fq.fragment_multiplicities) > len(fq.cluster_atoms)
+  plan = fq._get_fragment_plan(fq.cluster_atoms, fq.fragment_super_atoms,
+    fq.fragment_scales, fq.fragment_multiplicities)
+  assert list(plan.multiplicities) == fq.fragment_multiplicities
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
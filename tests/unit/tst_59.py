@@ -0,0 +1,73 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import libtbx.load_env
+from libtbx.test_utils import approx_equal
+from qrefine.cluster_restraints import from_cluster, fragment_cache
+from qrefine.restraints import from_cctbx
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+from qrefine.tests.unit.tst_10 import get_model
+from qrefine.tests.unit.tst_53 import get_parallel_params
+
+class counting_cctbx(from_cctbx):
+  """
+  cctbx restraints that count fragment evaluations.
+  """
+
+  def target_and_gradients(self, sites_cart, selection=None, index=None):
+    self.n_calls += 1
+    return from_cctbx.target_and_gradients(self, sites_cart=sites_cart,
+      selection=selection, index=index)
+
+def run(prefix):
+  """
+  Fragment cache: LRU bound, hit/miss counts, repeated coordinates are not
+  recomputed and give the same target and gradients.
+  """
+  cache = fragment_cache(size=2)
+  cache.put("a", 1)
+  cache.put("b", 2)
+  assert cache.get("a") == 1
+  cache.put("c", 3)
+  assert cache.get("b") is None
+  assert cache.get("a") == 1 and cache.get("c") == 3
+  assert cache.hits == 3 and cache.misses == 1
+  #
+  rm, cs, h = get_model()
+  fm = fragments(
+    working_folder             = "./ase/",
+    maxnum_residues_in_cluster = 2,
+    pdb_hierarchy              = h.deep_copy(),
+    qm_engine_name             = "mopac",
+    crystal_symmetry           = cs)
+  restraints_manager = counting_cctbx(restraints_manager = rm)
+  restraints_manager.n_calls = 0
+  fc = from_cluster(
+    restraints_manager = restraints_manager,
+    fragment_manager   = fm,
+    parallel_params    = get_parallel_params(persistent_pool=False),
+    fragment_cache     = fragment_cache(size=100, tolerance=1.e-5))
+  fc.parallel_params.nproc = 1
+  n_fragments = len(fm.fragment_selections)
+  sites_cart = h.atoms().extract_xyz()
+  e1, g1 = fc.target_and_gradients(sites_cart=sites_cart)
+  assert restraints_manager.n_calls == n_fragments
+  # same x: nothing recomputed
+  e2, g2 = fc.target_and_gradients(sites_cart=sites_cart)
+  assert restraints_manager.n_calls == n_fragments
+  assert approx_equal(e1, e2, eps=1.e-9)
+  assert approx_equal(g1, g2, eps=1.e-9)
+  # below tolerance: hit, moved: recomputed
+  fc.target_and_gradients(sites_cart=sites_cart+(1.e-9,0,0))
+  assert restraints_manager.n_calls == n_fragments
+  fc.target_and_gradients(sites_cart=sites_cart+(0.01,0,0))
+  assert restraints_manager.n_calls == 2*n_fragments
+  assert fc.fragment_cache.hits == 2*n_fragments
+  assert fc.fragment_cache.misses == 2*n_fragments
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,56 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import libtbx.load_env
+from scitbx.array_family import flex
+from libtbx.test_utils import approx_equal
+from qrefine.cluster_restraints import from_cluster, stale_gradients
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+from qrefine.tests.unit.tst_10 import get_model
+from qrefine.tests.unit.tst_53 import get_parallel_params
+from qrefine.tests.unit.tst_59 import counting_cctbx
+
+def run(prefix):
+  """
+  Stale-gradient reuse: fragments are recomputed only after moving more than
+  the tolerance or after max_steps reuses.
+  """
+  rm, cs, h = get_model()
+  fm = fragments(
+    working_folder             = "./ase/",
+    maxnum_residues_in_cluster = 2,
+    pdb_hierarchy              = h.deep_copy(),
+    qm_engine_name             = "mopac",
+    crystal_symmetry           = cs)
+  restraints_manager = counting_cctbx(restraints_manager = rm)
+  restraints_manager.n_calls = 0
+  fc = from_cluster(
+    restraints_manager = restraints_manager,
+    fragment_manager   = fm,
+    parallel_params    = get_parallel_params(persistent_pool=False),
+    stale_gradients    = stale_gradients(shift_tolerance=0.05, max_steps=2))
+  fc.parallel_params.nproc = 1
+  n = len(fm.fragment_selections)
+  sites_cart = h.atoms().extract_xyz()
+  # every other atom moves, so that gradients change
+  direction = flex.vec3_double([(i%2,0,0) for i in range(sites_cart.size())])
+  calls = []
+  for shift in [0, 0.01, 0.02, 0.03, 0.2, 0.21]:
+    e, g = fc.target_and_gradients(sites_cart=sites_cart+direction*shift)
+    calls.append(restraints_manager.n_calls)
+    if(shift==0): e0, g0 = e, g
+    if(shift==0.01):
+      assert approx_equal(e, e0, eps=1.e-9)
+      assert approx_equal(g, g0, eps=1.e-9)
+  # reused twice, recomputed after max_steps, recomputed after a large move
+  assert calls == [n, n, n, 2*n, 3*n, 3*n]
+  assert fc.stale_gradients.reused == 3*n
+  assert fc.stale_gradients.computed == 3*n
+  assert fc.stale_gradients.error > 0
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
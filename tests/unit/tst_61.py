@@ -0,0 +1,75 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from qrefine.plugin.ase import warm_start
+from qrefine.plugin.ase.mopac_qr import Mopac
+from qrefine.plugin.ase.orca_qr import Orca
+from qrefine.plugin.ase.xtb_qr import GFNxTB
+from qrefine.plugin.ase.turbomole_qr import Turbomole
+from qrefine.plugin.ase.gaussian_qr import Gaussian
+from qrefine.tests.unit.qm_standins import write_standins, restarts, molecules
+from qrefine.tests.unit import run_tests
+
+def run_engine(calculator):
+  for atoms in molecules():
+    calculator.run_qr(atoms, charge=0, pointcharges=None, define_str="",
+      coordinates=calculator.label+".xyz")
+    assert len(calculator.forces) == len(atoms)
+
+def run(prefix):
+  """
+  SCF warm start: restart files of a fragment are used while its atoms are
+  unchanged, not after the atoms changed or with warm_start=False.
+  """
+  write_standins()
+  expected = [False, True, False, True]
+  # MOPAC: DENOUT/OLDENS
+  for use in [True, False]:
+    calculator = Mopac()
+    calculator.set_command(os.path.abspath(os.path.join("bin", "mopac")))
+    calculator.set_nproc(1)
+    calculator.set_warm_start(use)
+    calculator.set_label(os.path.abspath("mopac_%s" % use))
+    run_engine(calculator)
+    assert restarts("mopac")[-4:] == [e and use for e in expected]
+  # ORCA: MORead of the previous .gbw
+  calculator = Orca()
+  calculator.set_warm_start(True)
+  calculator.set_label(os.path.abspath("orca"))
+  run_engine(calculator)
+  assert restarts("orca") == expected
+  # xtb: xtbrestart is kept
+  calculator = GFNxTB()
+  calculator.set_warm_start(True)
+  calculator.set_label("xtb_fragment")
+  run_engine(calculator)
+  assert restarts("xtb") == expected
+  # Turbomole: define only for new atoms
+  calculator = Turbomole()
+  calculator.set_warm_start(True)
+  calculator.set_label("turbomole_fragment")
+  run_engine(calculator)
+  assert restarts("define") == [True, True]
+  control = open(os.path.join("turbomole_fragment", "control")).read()
+  assert control.count("$rij") == 1
+  # Gaussian: %chk and guess=read
+  calculator = Gaussian(label="gaussian_fragment/gaussian_fragment",
+    command=Gaussian.command)
+  calculator.set_warm_start(True)
+  guess = []
+  for atoms in molecules():
+    calculator.set_restart(atoms)
+    calculator.write_input(atoms)
+    route = open(calculator.label+".com").read()
+    assert "%chk=gaussian_fragment.chk" in route
+    guess.append("guess=read" in route)
+    # what a finished run leaves behind
+    open(calculator.label+".chk", "w").write("checkpoint")
+    warm_start.restart_written(calculator.label, atoms, 0)
+  assert guess == expected
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,65 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from ase import Atoms
+from libtbx.test_utils import approx_equal
+from qrefine.tests.unit import run_tests
+
+def run(prefix):
+  """
+  In-process MOPAC (mopac-api): forces are the negative gradients of the
+  energy, warm starts give the same result and follow label and atoms.
+  """
+  from qrefine.plugin.ase.mopac_api_qr import MopacAPI
+  atoms = Atoms('CHHHH', [[0.03192167, 0.00638559, 0.01301679],
+                          [-0.83140486, 0.39370209, -0.26395324],
+                          [-0.66518241, -0.84461308, 0.20759389],
+                          [0.45554739, 0.54289633, 0.81170881],
+                          [0.66091919, -0.16799635, -0.91037834]])
+  # no COSMO, its gradients are approximate
+  calculator = MopacAPI(epsilon=1.0)
+  calculator.set_method('PM7')
+  calculator.run_qr(atoms, charge=0, pointcharges=None, coordinates=None)
+  e0, f0 = calculator.energy_free, calculator.forces.copy()
+  assert f0.shape == (5, 3)
+  # finite differences
+  delta = 1.e-4
+  for i, j in [(0, 0), (1, 1), (4, 2)]:
+    es = []
+    for sign in [1, -1]:
+      moved = atoms.copy()
+      moved.positions[i, j] += sign*delta
+      calculator.run_qr(moved, charge=0)
+      es.append(calculator.energy_free)
+    assert approx_equal(-(es[0]-es[1])/(2*delta), f0[i, j], eps=1.e-3)
+  assert len(calculator.states) == 0
+  # warm start
+  calculator.set_warm_start(True)
+  calculator.set_label("1")
+  calculator.run_qr(atoms, charge=0)
+  state = calculator.states["1"][1]
+  calculator.run_qr(atoms, charge=0)
+  assert calculator.states["1"][1] is state
+  assert approx_equal(calculator.energy_free, e0, eps=1.e-5)
+  assert approx_equal(calculator.forces, f0, eps=1.e-4)
+  calculator.run_qr(Atoms('NHHH', atoms.positions[:4]), charge=0)
+  assert calculator.states["1"][1] is not state
+  calculator.set_label("2")
+  calculator.run_qr(atoms, charge=0)
+  assert list(calculator.states.keys()) == ["1", "2"]
+  calculator.set_label("1")
+  calculator.run_qr(atoms, charge=0)
+  assert list(calculator.states.keys()) == ["2", "1"]
+
+if(__name__ == "__main__"):
+  mopactools_installed = False
+  try:
+    import mopactools
+    mopactools_installed = True
+  except ImportError:
+    pass
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix,
+    disable=not mopactools_installed)
@@ -0,0 +1,70 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from ase import Atoms
+from libtbx.test_utils import approx_equal
+from qrefine.tests.unit import run_tests
+
+def finite_difference(calculator, atoms, i, j, pointcharges=None,
+                      delta=1.e-4):
+  es = []
+  for sign in [1, -1]:
+    moved = atoms.copy()
+    moved.positions[i, j] += sign*delta
+    calculator.run_qr(moved, charge=0, pointcharges=pointcharges)
+    es.append(calculator.energy_free)
+  return -(es[0]-es[1])/(2*delta)
+
+def run(prefix):
+  """
+  In-process xtb: method options, forces with and without point charges,
+  one calculator per label kept while the atoms are unchanged.
+  """
+  from qrefine.plugin.ase.xtb_api_qr import GFNxTBAPI, parse_method
+  assert parse_method(" --gfn 2 --etemp 500 --acc 0.1 --gbsa h2o") is not None
+  assert parse_method("-gfn1")["param"].name == "GFN1xTB"
+  assert parse_method("--gfnff") is None
+  assert parse_method("--gfn 2 --alpb water") is None
+  #
+  atoms = Atoms('OHH', [[0.1, 0.2, 0.05], [1.0, 0.1, 0.2], [-0.2, 1.0, -0.1]])
+  with open("pointcharges.dat", "w") as f:
+    f.write("2\n\n1.0 3.5 0.0 0.0\n-0.5 0.0 -3.0 1.0\n")
+  calculator = GFNxTBAPI(method=" --gfn 2 --etemp 500 --acc 0.1 --gbsa h2o")
+  calculator.set_warm_start(True)
+  calculator.set_label("1")
+  calculator.run_qr(atoms, charge=0, pointcharges=None)
+  e0, f0 = calculator.energy_free, calculator.forces.copy()
+  calculator.run_qr(atoms, charge=0, pointcharges="pointcharges.dat")
+  e1, f1 = calculator.energy_free, calculator.forces.copy()
+  assert abs(e1-e0) > 1.e-3
+  for i, j in [(0, 0), (1, 1), (2, 0)]:
+    assert approx_equal(finite_difference(calculator, atoms, i, j), f0[i, j],
+      eps=1.e-4)
+    assert approx_equal(finite_difference(calculator, atoms, i, j,
+      pointcharges="pointcharges.dat"), f1[i, j], eps=1.e-4)
+  # calculators are kept per label and atoms
+  xtb_calculator = calculator.calculators["1"][1]
+  calculator.run_qr(atoms, charge=0)
+  assert calculator.calculators["1"][1] is xtb_calculator
+  assert approx_equal(calculator.energy_free, e0, eps=1.e-6)
+  calculator.run_qr(Atoms('NHHH', [[0, 0, 0], [1.01, 0, 0], [-0.34, 0.95, 0],
+    [-0.34, -0.48, 0.82]]), charge=0)
+  assert calculator.calculators["1"][1] is not xtb_calculator
+  calculator.max_calculators = 2
+  for label in ["2", "3"]:
+    calculator.set_label(label)
+    calculator.run_qr(atoms, charge=0)
+  assert list(calculator.calculators.keys()) == ["2", "3"]
+  assert approx_equal(calculator.energy_free, e0, eps=1.e-6)
+
+if(__name__ == "__main__"):
+  xtb_installed = False
+  try:
+    import xtb.interface
+    xtb_installed = True
+  except ImportError:
+    pass
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=not xtb_installed)
@@ -0,0 +1,82 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import time
+import numpy as np
+from ase import Atoms
+from libtbx.test_utils import approx_equal
+from qrefine.tests.unit import run_tests
+
+def fragments(n=48):
+  """
+  Molecules of different size, randomly displaced as in a refinement step.
+  """
+  ch4 = Atoms('CHHHH', [[0.03192167, 0.00638559, 0.01301679],
+                        [-0.83140486, 0.39370209, -0.26395324],
+                        [-0.66518241, -0.84461308, 0.20759389],
+                        [0.45554739, 0.54289633, 0.81170881],
+                        [0.66091919, -0.16799635, -0.91037834]])
+  nh3 = Atoms('NHHH', [[0, 0, 0], [1.01, 0, 0], [-0.34, 0.95, 0],
+                       [-0.34, -0.48, 0.82]])
+  h2o = Atoms('OHH', [[0.1, 0.2, 0.05], [1.0, 0.1, 0.2], [-0.2, 1.0, -0.1]])
+  dimer = ch4.copy()
+  dimer.extend(Atoms('NHHH', nh3.positions+[3.5, 0, 0]))
+  rng = np.random.RandomState(0)
+  result = []
+  for i in range(n):
+    atoms = [ch4, nh3, h2o, dimer][i%4].copy()
+    atoms.positions += rng.uniform(-0.05, 0.05, atoms.positions.shape)
+    result.append(atoms)
+  return result
+
+def engines():
+  result = []
+  try:
+    from qrefine.plugin.ase.torchani_qr import TorchAni
+    result.append(("torchani", TorchAni()))
+  except (ImportError, IOError, ValueError, RuntimeError):
+    pass
+  try:
+    from qrefine.plugin.ase.aimnet2_qr import AIMNet2Calculator
+    result.append(("aimnet2", AIMNet2Calculator('aimnet2')))
+  except (ImportError, IOError, ValueError, RuntimeError):
+    pass
+  return result
+
+def run(prefix):
+  """
+  Batched ML inference: one forward/backward pass for all fragments gives the
+  energies and forces of one run_qr per fragment, and is faster on CPU.
+  """
+  molecules = fragments()
+  charges = [0]*len(molecules)
+  for name, calculator in engines():
+    t0 = time.time()
+    single = []
+    for atoms, charge in zip(molecules, charges):
+      calculator.run_qr(atoms, coordinates=None, charge=charge,
+        pointcharges=None)
+      single.append((calculator.energy_free, calculator.forces.copy()))
+    t_single = time.time()-t0
+    t0 = time.time()
+    batch = calculator.run_qr_batch(molecules, charges)
+    t_batch = time.time()-t0
+    assert len(batch) == len(molecules)
+    for (e1, f1), (e2, f2), atoms in zip(single, batch, molecules):
+      assert f2.shape == (len(atoms), 3)
+      assert approx_equal(e1, e2, eps=1.e-4)
+      assert approx_equal(f1, f2, eps=1.e-4)
+    print("%s: %d fragments, per fragment %.1f/s, batched %.1f/s" % (
+      name, len(molecules), len(molecules)/t_single, len(molecules)/t_batch))
+
+if(__name__ == "__main__"):
+  ml_installed = False
+  try:
+    import torch
+    ml_installed = len(engines()) > 0
+  except ImportError:
+    pass
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=not ml_installed)
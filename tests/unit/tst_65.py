@@ -0,0 +1,52 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import sys
+import subprocess
+import multiprocessing
+from qrefine.plugin.ase import models
+from qrefine.tests.unit import run_tests
+
+loads = []
+
+def loader():
+  loads.append(os.getpid())
+  return object()
+
+def child(queue):
+  model = models.get("model", loader)
+  queue.put((id(model), len(loads)))
+
+def run(prefix):
+  """
+  ML model registry: a model is loaded once per process, on first use, and
+  forked workers use the copy of the parent. Importing the ML plugins does
+  not import torch.
+  """
+  models.clear()
+  model = models.get("model", loader)
+  assert models.get("model", loader) is model
+  assert loads == [os.getpid()]
+  assert models.loaded() == ["model"]
+  assert "model" in models.load_times
+  # a forked worker does not load it again
+  context = multiprocessing.get_context("fork")
+  queue = context.Queue()
+  process = context.Process(target=child, args=(queue,))
+  process.start()
+  assert queue.get(timeout=60) == (id(model), 1)
+  process.join()
+  models.clear()
+  assert models.loaded() == []
+  # plugin import is cheap
+  code = ("import sys\n"
+          "import qrefine.plugin.ase.torchani_qr\n"
+          "import qrefine.restraints\n"
+          "assert 'torch' not in sys.modules\n")
+  assert subprocess.call([sys.executable, "-c", code]) == 0
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
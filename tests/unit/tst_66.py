@@ -0,0 +1,67 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from libtbx.test_utils import approx_equal
+from scitbx.array_family import flex
+from qrefine.restraints import from_qm, from_periodic
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests = os.path.join(qrefine, "tests","unit")
+
+def run(prefix):
+  """
+  Periodic ML restraints: the model and its symmetry copies fill the unit
+  cell, gradients of the model atoms are the derivatives of the energy per
+  copy.
+  """
+  pdb_inp = iotbx.pdb.input(
+    os.path.join(qr_unit_tests,"data_files","p212121.pdb"))
+  ph = pdb_inp.construct_hierarchy()
+  cs = pdb_inp.crystal_symmetry()
+  fq = from_qm(
+    charge           = 0,
+    pdb_hierarchy    = ph,
+    qm_engine_name   = "torchani",
+    crystal_symmetry = cs,
+    clustering       = False)
+  restraints = from_periodic(
+    restraints_manager = fq,
+    pdb_hierarchy      = ph,
+    crystal_symmetry   = cs)
+  assert len(restraints.atoms) == 4*ph.atoms().size()
+  sites_cart = ph.atoms().extract_xyz()
+  energy, gradients = restraints.target_and_gradients(sites_cart=sites_cart)
+  assert gradients.size() == sites_cart.size()
+  # symmetry copies are where the operators put them
+  sites_frac = cs.unit_cell().fractionalize(sites_cart)
+  for k, op in enumerate(cs.space_group().all_ops()):
+    copy = cs.unit_cell().orthogonalize(
+      flex.vec3_double([op*site for site in sites_frac]))
+    positions = restraints.atoms.get_positions()[k*9:(k+1)*9]
+    assert approx_equal(copy, flex.vec3_double(positions), 1.e-4)
+  # finite differences, the model is evaluated in single precision
+  delta = 0.02
+  for i, j in [(0, 0), (3, 2), (7, 1)]:
+    es = []
+    for sign in [1, -1]:
+      moved = sites_cart.as_numpy_array()
+      moved[i, j] += sign*delta
+      es.append(restraints.target_and_gradients(
+        sites_cart=flex.vec3_double(moved))[0])
+    assert approx_equal((es[0]-es[1])/(2*delta), gradients[i][j], eps=0.5)
+
+if(__name__ == "__main__"):
+  torchani_installed = False
+  try:
+    import torch
+    from qrefine.plugin.ase.torchani_qr import TorchAni, ANImodel_file
+    torchani_installed = os.path.isfile(ANImodel_file)
+  except ImportError:
+    pass
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=not torchani_installed)
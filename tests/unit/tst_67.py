@@ -0,0 +1,152 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import threading
+import numpy as np
+from ase import Atoms
+from libtbx.test_utils import approx_equal
+from qrefine.plugin.ase import server_qr
+from qrefine.tests.unit import run_tests
+
+try:
+  from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+  pass
+
+def energy_and_forces(species, coordinates):
+  """
+  Stand-in model: harmonic pairs, E = sum (r-1)^2 * (Z_i+Z_j)/10.
+  """
+  d = coordinates[:, None, :]-coordinates[None, :, :]
+  r = np.sqrt((d**2).sum(axis=-1))+np.eye(len(species))
+  k = (species[:, None]+species[None, :])/10.
+  energy = 0.5*(k*(r-1)**2*(1-np.eye(len(species)))).sum()
+  dedr = k*(r-1)*(1-np.eye(len(species)))
+  forces = -(dedr[:, :, None]*d/r[:, :, None]).sum(axis=1)
+  return energy, forces
+
+class standin_handler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def setup(self):
+    BaseHTTPRequestHandler.setup(self)
+    self.server.stats["connections"] += 1
+
+  def log_message(self, *args):
+    pass
+
+  def reply(self, status, body, content_type):
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_POST(self):
+    stats = self.server.stats
+    data = self.rfile.read(int(self.headers["Content-Length"]))
+    with stats["lock"]:
+      stats["in_flight"] += 1
+      stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+    time.sleep(0.05)
+    try:
+      if(self.path == "/calc"):
+        stats["calc"] += 1
+        request = json.loads(data.decode())
+        e, f = energy_and_forces(np.array(request["species"]),
+          np.array(request["coordinates"]))
+        self.reply(200, json.dumps({"energy": e, "forces": f.tolist()}).encode(),
+          "application/json")
+      elif(self.path == "/calc_batch" and self.server.batch):
+        stats["calc_batch"] += 1
+        request = server_qr.decode_arrays(data)
+        stats["dtype"] = request["coordinates"].dtype
+        energies, forces = [], []
+        start = 0
+        for size in request["sizes"]:
+          e, f = energy_and_forces(request["species"][start:start+size],
+            request["coordinates"][start:start+size].astype(np.float64))
+          energies.append(e)
+          forces.append(f)
+          start += size
+        self.reply(200, server_qr.encode_arrays(energy=np.array(energies),
+          forces=np.concatenate(forces).astype(request["coordinates"].dtype)),
+          server_qr.RestAPICalculator.content_type)
+      else:
+        self.reply(404, b"not found", "text/plain")
+    finally:
+      with stats["lock"]:
+        stats["in_flight"] -= 1
+
+def start_server(batch=True):
+  server = ThreadingHTTPServer(("127.0.0.1", 0), standin_handler)
+  server.batch = batch
+  server.stats = dict(connections=0, calc=0, calc_batch=0, in_flight=0,
+    max_in_flight=0, dtype=None, lock=threading.Lock())
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server, "http://127.0.0.1:%d" % server.server_address[1]
+
+def molecules():
+  rng = np.random.RandomState(0)
+  result = []
+  for i in range(6):
+    atoms = Atoms("OHH"+"H"*(i%3), positions=rng.uniform(0, 2, (3+i%3, 3)))
+    result.append(atoms)
+  return result
+
+def run(prefix):
+  """
+  RestAPI engine: keep-alive session, all fragments in one binary request,
+  float32 payload, concurrent requests, fallback to /calc.
+  """
+  server, url = start_server()
+  stats = server.stats
+  atoms_list = molecules()
+  charges = [0]*len(atoms_list)
+  # reference: one JSON request per molecule
+  calculator = server_qr.RestAPICalculator(url=url, payload="json")
+  reference = []
+  for atoms in atoms_list:
+    calculator.run_qr(atoms, charge=0)
+    reference.append((calculator.energy_free, calculator.forces))
+  assert stats["calc"] == len(atoms_list)
+  assert stats["connections"] == 1
+  # all molecules in one binary request
+  for payload, eps in [("binary", 1.e-9), ("float32", 1.e-4)]:
+    calculator = server_qr.RestAPICalculator(url=url, payload=payload)
+    calc_batch = stats["calc_batch"]
+    for step in range(3):
+      results = calculator.run_qr_batch(atoms_list, charges)
+    assert stats["calc_batch"] == calc_batch+3
+    assert stats["dtype"] == np.dtype(payload.replace("binary", "float64"))
+    for (e1, f1), (e2, f2) in zip(reference, results):
+      assert approx_equal(e1, e2, eps=eps)
+      assert approx_equal(f1, f2, eps=eps)
+    calculator.run_qr(atoms_list[0], charge=0)
+    assert approx_equal(calculator.energy_free, reference[0][0], eps=eps)
+  assert stats["connections"] == 3
+  # batches of two molecules in flight at the same time
+  calculator = server_qr.RestAPICalculator(url=url, batch_size=2)
+  stats["max_in_flight"] = 0
+  results = calculator.run_qr_batch(atoms_list, charges)
+  assert stats["max_in_flight"] > 1
+  assert approx_equal(results[-1][0], reference[-1][0], eps=1.e-9)
+  server.shutdown()
+  # server without /calc_batch
+  server, url = start_server(batch=False)
+  calculator = server_qr.RestAPICalculator(url=url)
+  results = calculator.run_qr_batch(atoms_list, charges)
+  assert calculator.payload == "json"
+  assert server.stats["calc"] == len(atoms_list)
+  assert approx_equal(results[2][1], reference[2][1], eps=1.e-9)
+  server.shutdown()
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,96 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+import time
+import threading
+import numpy as np
+import requests
+from ase import Atoms
+from libtbx.test_utils import approx_equal
+from qrefine.plugin.ase.server_qr import RestAPICalculator
+from qrefine.tests.unit import run_tests
+
+class standin_engine(object):
+  """
+  Stand-in ML engine: energy sum_i Z_i*|x_i|^2/2 (run_qr units), records the
+  size of each batch. Fails for molecules with uranium.
+  """
+
+  def __init__(self):
+    self.batches = []
+
+  def run_qr_batch(self, atoms_list, charges):
+    self.batches.append(len(atoms_list))
+    time.sleep(0.02)
+    result = []
+    for atoms in atoms_list:
+      if(92 in atoms.get_atomic_numbers()):
+        raise RuntimeError("no parameters for U")
+      z = atoms.get_atomic_numbers()[:, None]
+      x = atoms.get_positions()
+      result.append((float((z*x**2).sum()/2), -z*x))
+    return result
+
+def run(prefix):
+  """
+  qr.server: concurrent clients are answered from shared batches, results
+  come back in eV, statistics are available at /metrics.
+  """
+  from qrefine.command_line.server import inference_server
+  engine = standin_engine()
+  server = inference_server(engine=engine, port=0, window=0.05).start()
+  rng = np.random.RandomState(0)
+  molecules = [Atoms("OHH", positions=rng.uniform(-1, 1, (3, 3)))
+               for i in range(16)]
+  results = {}
+  def client(i, payload):
+    calculator = RestAPICalculator(url=server.url, payload=payload)
+    calculator.run_qr(molecules[i], charge=0)
+    results[i] = (calculator.energy_free, calculator.forces)
+  threads = [threading.Thread(target=client,
+               args=(i, ["json", "binary", "float32"][i%3]))
+             for i in range(8)]
+  for thread in threads: thread.start()
+  for thread in threads: thread.join()
+  # a batched client
+  calculator = RestAPICalculator(url=server.url)
+  for i, result in enumerate(calculator.run_qr_batch(molecules[8:], [0]*8)):
+    results[8+i] = result
+  for i, atoms in enumerate(molecules):
+    expected = engine.run_qr_batch([atoms], [0])[0]
+    eps = [1.e-9, 1.e-9, 1.e-4][i%3] if i < 8 else 1.e-9
+    assert approx_equal(results[i][0], expected[0], eps=eps)
+    assert approx_equal(results[i][1], expected[1], eps=eps)
+  metrics = json.loads(requests.get(server.url+"/metrics").text)
+  assert metrics["molecules"] == 16
+  assert metrics["batches"] < 16
+  assert metrics["batches"] == len(engine.batches)-16
+  assert metrics["batch_latency_max"] >= 0.02
+  print(metrics)
+  # a molecule that fails in a shared batch: only its client gets the error
+  molecules[3] = Atoms("UHH", positions=molecules[3].get_positions())
+  results, errors = {}, {}
+  def failing_client(i):
+    try:
+      client(i, "binary")
+    except Exception as e:
+      errors[i] = str(e)
+  threads = [threading.Thread(target=failing_client, args=(i,))
+             for i in range(6)]
+  for thread in threads: thread.start()
+  for thread in threads: thread.join()
+  server.shutdown()
+  assert list(errors.keys()) == [3]
+  assert "no parameters for U" in errors[3]
+  assert sorted(results.keys()) == [0, 1, 2, 4, 5]
+  for i in results:
+    expected = engine.run_qr_batch([molecules[i]], [0])[0]
+    assert approx_equal(results[i][0], expected[0])
+    assert approx_equal(results[i][1], expected[1])
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
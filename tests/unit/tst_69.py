@@ -0,0 +1,135 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from libtbx.test_utils import approx_equal
+from qrefine.plugin.ase import async_qr
+from qrefine.plugin.ase.mopac_qr import Mopac
+from qrefine.plugin.ase.orca_qr import Orca
+from qrefine.plugin.ase.xtb_qr import GFNxTB
+from qrefine.plugin.ase.turbomole_qr import Turbomole
+from qrefine.plugin.ase.gaussian_qr import Gaussian
+from qrefine.tests.unit.qm_standins import write_standins, molecules
+from qrefine.tests.unit import run_tests
+
+# Slow stand-ins: log start and end, so that the number of programs running
+# at the same time can be counted.
+slow = '''#!/bin/sh
+echo start >> %(log)s
+sleep 0.1
+%(program)s "$@"
+status=$?
+echo end >> %(log)s
+exit $status
+'''
+
+def write_slow_standins():
+  log = os.path.abspath("events.log")
+  os.mkdir("slow_bin")
+  for name in ["mopac", "orca", "xtb", "ridft"]:
+    file_name = os.path.abspath(os.path.join("slow_bin", name))
+    with open(file_name, "w") as f:
+      f.write(slow % {"log": log,
+        "program": os.path.abspath(os.path.join("bin", name))})
+    os.chmod(file_name, 0o755)
+  os.environ["PATH"] = os.path.abspath("slow_bin")+os.pathsep+os.environ["PATH"]
+  os.environ["ORCA_COMMAND"] = os.path.abspath(os.path.join("slow_bin", "orca"))
+
+def in_flight():
+  """
+  Largest number of stand-ins that ran at the same time; starts over.
+  """
+  result, running = 0, 0
+  for line in open("events.log").read().splitlines():
+    running += 1 if line == "start" else -1
+    result = max(result, running)
+  os.remove("events.log")
+  return result
+
+def create(name):
+  if(name == "mopac"):
+    calculator = Mopac()
+    calculator.set_command(os.path.abspath(os.path.join("slow_bin", "mopac")))
+    calculator.set_nproc(1)
+    return calculator
+  return {"orca": Orca, "xtb": GFNxTB, "turbomole": Turbomole}[name]()
+
+def label(name, i):
+  # MOPAC and ORCA files are label.*, xtb and Turbomole use directory label
+  if(name.split("_")[0] in ["mopac", "orca"]):
+    if(not os.path.isdir(name)): os.mkdir(name)
+    return os.path.abspath(os.path.join(name, "%s_%d" % (name, i)))
+  return "%s_%d" % (name, i)
+
+def run(prefix):
+  """
+  submit_qr of file based engines: jobs run at the same time from one
+  process without changing its working directory, results as from run_qr.
+  """
+  write_standins()
+  write_slow_standins()
+  cwd = os.getcwd()
+  atoms_list = molecules()
+  for name in ["mopac", "orca", "xtb", "turbomole"]:
+    # reference, one after the other
+    calculator = create(name)
+    reference = []
+    for i, atoms in enumerate(atoms_list):
+      calculator.set_label(label(name+"_reference", i))
+      calculator.run_qr(atoms, charge=0, pointcharges=None, define_str="",
+        coordinates=calculator.label+".xyz")
+      reference.append((calculator.energy_free, calculator.forces))
+    assert in_flight() == 1
+    # a job copy has the settings of the engine, not its last results
+    job = async_qr.job_copy(calculator)
+    assert calculator.forces is not None
+    assert job.forces is None and job.atoms is None
+    assert job.command == calculator.command
+    # all jobs from one engine, at most four at a time
+    calculator = create(name)
+    submissions = []
+    for i, atoms in enumerate(atoms_list*2):
+      calculator.set_label(label(name, i))
+      submissions.append(calculator.submit_qr(atoms, charge=0,
+        pointcharges=None, define_str="", coordinates=calculator.label+".xyz"))
+    jobs = async_qr.gather(submissions, max_in_flight=4)
+    assert os.getcwd() == cwd
+    assert in_flight() in [2, 3, 4], name
+    assert calculator.energy_free is None
+    for i, job in enumerate(jobs):
+      energy, forces = reference[i%len(atoms_list)]
+      assert job.label == label(name, i)
+      assert approx_equal(job.energy_free, energy)
+      assert approx_equal(job.forces, forces)
+    assert len(jobs[2].forces) == 4
+  # a failed job is returned as its exception, the others finish
+  calculator = create("mopac")
+  submissions = []
+  for i, command in enumerate(["mopac", "false"]):
+    calculator.set_command(command)
+    calculator.set_label(label("mopac_failed", i))
+    submissions.append(calculator.submit_qr(atoms_list[0], charge=0))
+  jobs = async_qr.gather(submissions)
+  assert jobs[0].forces is not None
+  assert isinstance(jobs[1], RuntimeError)
+  # MOPAC and ORCA run in the directory of the label
+  for name in ["mopac", "orca"]:
+    calculator = create(name)
+    calculator.set_label(label(name+"_directory", 0))
+    command, directory = next(calculator.qr_job(atoms_list[0], charge=0,
+      pointcharges=None, define_str="", coordinates=calculator.label+".xyz"))
+    assert directory == os.path.abspath(name+"_directory")
+    assert command.split()[1] == os.path.basename(calculator.label)+ \
+      {"mopac": ".mop", "orca": ".inp"}[name]
+  # Gaussian runs g16 in the directory of the label
+  calculator = Gaussian(label="gaussian_fragment/gaussian_fragment",
+    command=Gaussian.command)
+  command, directory = next(calculator.qr_job(atoms_list[0], charge=0))
+  assert command == "g16 < gaussian_fragment.com > gaussian_fragment.log"
+  assert os.path.abspath(directory) == os.path.abspath("gaussian_fragment")
+  assert os.path.isfile(os.path.join(directory, "gaussian_fragment.com"))
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
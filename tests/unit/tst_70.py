@@ -0,0 +1,40 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import copy
+import iotbx.pdb
+import libtbx.load_env
+from libtbx.test_utils import approx_equal
+from mmtbx.pair_interaction import pair_interaction
+from qrefine.utils.contact_index import contact_index
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests_data = os.path.join(qrefine,"tests","unit","data_files")
+
+def run(prefix):
+  """
+  contact_index.pair_interaction gives the same core atoms, fragment atoms and
+  molecules as pair_interaction.run on a copy of the whole hierarchy, for a
+  model with four chains and waters: cores at the first and the last residue
+  and across chain ends. The hierarchy of the contact index is not changed.
+  """
+  ph = iotbx.pdb.input(file_name=os.path.join(qr_unit_tests_data,
+    "2ona_box_S.pdb")).construct_hierarchy()
+  ci = contact_index(ph)
+  xyz = ph.atoms().extract_xyz().deep_copy()
+  i_seqs = [a.i_seq for a in ph.atoms()]
+  # residues 1-6 chain A, 7-12 B, 13-18 C, 19-24 D, 25-30 waters
+  assert ci.n_residues == 30
+  for core in [[1], [6,7], [12,13], [24,25], [30]]:
+    expected = pair_interaction.run(copy.deepcopy(ph), core)
+    result = ci.pair_interaction(core)
+    assert [sorted(x) for x in result] == [sorted(x) for x in expected], core
+    assert approx_equal(ph.atoms().extract_xyz(), xyz)
+    assert [a.i_seq for a in ph.atoms()] == i_seqs
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
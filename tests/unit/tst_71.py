@@ -0,0 +1,99 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import random
+from scitbx.array_family import flex
+from libtbx.test_utils import approx_equal
+from qrefine.fragment import fragment_plan, deduplicate_fragments
+from qrefine.tests.unit import run_tests
+
+# fix random seed in this script
+random.seed(0)
+flex.set_random_seed(0)
+
+def get_fragments(system_size, super_size, n_fragments, n_copies):
+  """
+  Random clusters and fragments (1-based atoms, buffer atoms also from the
+  super-sphere), some fragments repeated as for altloc hierarchies with own
+  gradient scales.
+  """
+  cluster_atoms, fragment_super_atoms, fragment_scales = [], [], []
+  for i in range(n_fragments):
+    master = random.sample(range(1, system_size+1), 8)
+    cluster = master[:3]
+    fragment = master+random.sample(range(system_size+1, super_size+1), 4)
+    random.shuffle(fragment)
+    cluster_atoms.append(cluster)
+    fragment_super_atoms.append(fragment)
+    fragment_scales.append([random.choice([0.5, 1.0]) for j in master])
+  for i in range(n_copies):
+    fragment = fragment_super_atoms[i][:]
+    random.shuffle(fragment)
+    cluster_atoms.append(cluster_atoms[i][::-1])
+    fragment_super_atoms.append(fragment)
+    fragment_scales.append([0.5]*(len(fragment)-4))
+  return cluster_atoms, fragment_super_atoms, fragment_scales
+
+def run(prefix):
+  """
+  Target and gradients accumulated fragment by fragment through
+  fragment_plan.add_gradients, in any order of completion, match assembling
+  full-size gradients of every fragment copy at once, also for fragments
+  merged by deduplicate_fragments (weighted by their multiplicities).
+  """
+  system_size, super_size = 30, 45
+  copies = get_fragments(system_size=system_size, super_size=super_size,
+    n_fragments=8, n_copies=3)
+  cluster_atoms, fragment_super_atoms, fragment_scales, multiplicities = \
+    deduplicate_fragments(*copies, system_size=system_size)
+  assert len(cluster_atoms) == 8
+  assert sorted(multiplicities) == [1]*5+[2]*3
+  plan = fragment_plan(
+    cluster_atoms           = cluster_atoms,
+    fragment_super_atoms    = fragment_super_atoms,
+    fragment_scales         = fragment_scales,
+    system_size             = system_size,
+    super_size              = super_size,
+    fragment_multiplicities = multiplicities)
+  # QM result of each distinct fragment: gradients of its master atoms in
+  # ascending order
+  energies = [random.random() for i in range(plan.n_fragments)]
+  qm_gradients = [flex.vec3_double(flex.random_double(plan.master_sizes[i]*3))
+    for i in range(plan.n_fragments)]
+  # all at once, every copy on its own as before deduplication and streaming
+  index = dict([((frozenset(c), frozenset(f)), i) for i, (c, f) in
+    enumerate(zip(cluster_atoms, fragment_super_atoms))])
+  target = 0
+  gradients = flex.vec3_double(system_size)
+  for cluster, fragment, scales in zip(*copies):
+    i = index[(frozenset(cluster), frozenset(fragment))]
+    master = [j for j in fragment if j <= system_size]
+    scale = dict(zip(master, scales))
+    master = sorted(master)
+    g = qm_gradients[i]*flex.double([scale[j] for j in master])
+    fragment_selection = flex.bool(system_size,
+      flex.size_t([j-1 for j in master]))
+    buffer_selection = fragment_selection.deep_copy().set_selected(
+      flex.size_t([j-1 for j in cluster]), False)
+    gradients_i = flex.vec3_double(system_size)
+    gradients_i = gradients_i.set_selected(fragment_selection, g)
+    gradients_i = gradients_i.set_selected(buffer_selection, [0,0,0])
+    gradients += gradients_i
+    target += energies[i]
+  # streamed, in some order of completion
+  order = list(range(plan.n_fragments))
+  random.shuffle(order)
+  target_streamed = 0
+  gradients_streamed = flex.vec3_double(system_size)
+  for i in order:
+    target_streamed += energies[i]*plan.multiplicities[i]
+    plan.add_gradients(gradients=gradients_streamed, i=i,
+      fragment_gradients=qm_gradients[i]*plan.scales(i))
+  assert approx_equal(target_streamed, target)
+  assert approx_equal(gradients_streamed, gradients)
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
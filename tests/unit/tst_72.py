@@ -0,0 +1,65 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from scitbx.array_family import flex
+from qrefine.cluster_restraints import fragment_batch_task
+from qrefine.tests.unit import run_tests
+
+class batch_restraints(object):
+  """
+  Stand-in for from_qm with a batched engine: fragment 3 fails, and with it
+  any batch it is part of.
+  """
+
+  def __init__(self, failing=3):
+    self.failing = failing
+    self.batch_calls = []
+    self.single_calls = []
+
+  def result(self, index):
+    if(index == self.failing):
+      raise RuntimeError("fragment %d failed" % index)
+    return index*1.5, flex.vec3_double([(index, 0, 0)])
+
+  def target_and_gradients_batch(self, selections, indices):
+    self.batch_calls.append(list(indices))
+    return [self.result(index) for index in indices]
+
+  def __call__(self, selection_and_sites_cart):
+    self.single_calls.append(selection_and_sites_cart[2])
+    return self.result(selection_and_sites_cart[2])
+
+def run(prefix):
+  """
+  A failed batch call is followed by evaluating its fragments one at a time:
+  only the fragment that fails on its own is reported failed.
+  """
+  selection_and_sites_cart = [[None, None, i] for i in range(6)]
+  indices = [5, 1, 3, 0]
+  # all fragments fine: one call
+  rm = batch_restraints(failing=None)
+  results = fragment_batch_task(rm)(selection_and_sites_cart, indices)
+  assert rm.batch_calls == [indices]
+  assert rm.single_calls == []
+  assert [r[0] for r in results] == indices
+  assert [r[4] for r in results] == [None]*4
+  # one fragment fails: the others still give results
+  rm = batch_restraints(failing=3)
+  results = fragment_batch_task(rm)(selection_and_sites_cart, indices)
+  assert rm.batch_calls == [indices]
+  assert rm.single_calls == indices
+  assert [r[0] for r in results] == indices
+  for index, result, elapsed, worker, error in results:
+    if(index == 3):
+      assert result is None
+      assert "fragment 3 failed" in error
+    else:
+      assert error is None
+      assert result[0] == index*1.5
+      assert list(result[1]) == [(index, 0, 0)]
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
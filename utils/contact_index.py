@@ -0,0 +1,114 @@
+from __future__ import division
+from __future__ import absolute_import
+import math
+import numpy as np
+from scitbx.array_family import flex
+from mmtbx.pair_interaction import pair_interaction
+
+# pair_interaction.run(ph, core) keeps non-core atoms within 15 bohr of core
+pair_interaction_cutoff = 15./pair_interaction.A2B
+
+class contact_index(object):
+  """
+  Cell list over the atoms of a hierarchy, built once per set of coordinates.
+  Answers "which atoms/residues are near these residues" queries without
+  copying the hierarchy. Residues are numbered 1..n in residue_groups()
+  order, as in pair_interaction.
+  """
+
+  def __init__(self, pdb_hierarchy, cell_size=pair_interaction_cutoff):
+    self.pdb_hierarchy = pdb_hierarchy
+    self.cell_size = cell_size
+    self.xyz = pdb_hierarchy.atoms().extract_xyz().as_numpy_array()
+    self.n_atoms = self.xyz.shape[0]
+    # residue atom ranges: atoms of residue r are residue_start[r-1:r]
+    residue_start = [0]
+    for rg in pdb_hierarchy.residue_groups():
+      residue_start.append(residue_start[-1]+rg.atoms_size())
+    assert residue_start[-1] == self.n_atoms
+    self.residue_start = np.array(residue_start, dtype=np.int64)
+    self.n_residues = len(residue_start)-1
+    self.atom_in_residue = np.repeat(
+      np.arange(1, self.n_residues+1), np.diff(self.residue_start))
+    # cell list
+    self.cells = np.floor(
+      (self.xyz-self.xyz.min(axis=0))/cell_size).astype(np.int64)
+    keys = [tuple(c) for c in self.cells]
+    self.cell_atoms = {}
+    for i, key in enumerate(keys):
+      self.cell_atoms.setdefault(key, []).append(i)
+    for key in self.cell_atoms:
+      self.cell_atoms[key] = np.array(self.cell_atoms[key], dtype=np.int64)
+
+  def residue_atoms(self, residues):
+    """
+    0-based atom indices of the given 1-based residues, in hierarchy order.
+    """
+    if(len(residues)==0): return np.zeros(0, dtype=np.int64)
+    return np.concatenate([
+      np.arange(self.residue_start[r-1], self.residue_start[r])
+      for r in sorted(set(residues))])
+
+  def atoms_within(self, atom_indices, radius):
+    """
+    Boolean mask of atoms closer than radius to any of the given atoms
+    (0-based indices); the given atoms themselves are included.
+    """
+    result = np.zeros(self.n_atoms, dtype=bool)
+    atom_indices = np.asarray(atom_indices, dtype=np.int64)
+    if(atom_indices.size==0): return result
+    result[atom_indices] = True
+    reach = int(math.ceil(radius/self.cell_size))
+    offsets = range(-reach, reach+1)
+    radius_sq = radius*radius
+    groups = {}
+    for i in atom_indices:
+      groups.setdefault(tuple(self.cells[i]), []).append(i)
+    for key, group in groups.items():
+      candidates = []
+      for dx in offsets:
+        for dy in offsets:
+          for dz in offsets:
+            atoms = self.cell_atoms.get((key[0]+dx, key[1]+dy, key[2]+dz))
+            if(atoms is not None): candidates.append(atoms)
+      candidates = np.concatenate(candidates)
+      d = self.xyz[candidates][np.newaxis,:,:]-self.xyz[group][:,np.newaxis,:]
+      close = ((d*d).sum(axis=2) < radius_sq).any(axis=0)
+      result[candidates[close]] = True
+    return result
+
+  def residues_within(self, residues, radius):
+    """
+    Sorted 1-based residues with an atom closer than radius to an atom of
+    the given residues.
+    """
+    mask = self.atoms_within(self.residue_atoms(residues), radius)
+    return sorted(set(self.atom_in_residue[mask].tolist()))
+
+  def pair_interaction(self, core):
+    """
+    Same result as pair_interaction.run(copy.deepcopy(pdb_hierarchy), core),
+    but the neighbour search runs on a sub-hierarchy of the residues within
+    the pair_interaction cutoff of core. Returned atoms are 1-based positions
+    in pdb_hierarchy, residues are 1-based residue numbers.
+    """
+    residues = set(self.residues_within(core, pair_interaction_cutoff))
+    # pair_interaction.run marks selection[atom_list.index(atom)-1] for each
+    # atom within its cutoff, i.e. the atom preceding it in the hierarchy, and
+    # for atom 0 index -1, the last atom. Keep the preceding residue, and the
+    # last residue for residue 1, so that the same atoms get selected here.
+    residues |= set([r-1 for r in residues if r>1])
+    if(1 in residues): residues.add(self.n_residues)
+    residues = sorted(residues)
+    sub_residue = dict([(r, i+1) for i, r in enumerate(residues)])
+    atom_indices = self.residue_atoms(residues)
+    selection = flex.bool(self.n_atoms, flex.size_t(atom_indices.tolist()))
+    # pair_interaction.run scales coordinates to bohr in place
+    sub_ph = self.pdb_hierarchy.select(selection, copy_atoms=True)
+    sub_ph.atoms().reset_i_seq()
+    core_atoms, fragment_atoms, molecules = pair_interaction.run(
+      sub_ph, [sub_residue[r] for r in core])
+    core_atoms = (atom_indices[np.array(core_atoms, dtype=np.int64)-1]+1)
+    fragment_atoms = (atom_indices[np.array(fragment_atoms,dtype=np.int64)-1]+1)
+    return (core_atoms.tolist(), fragment_atoms.tolist(),
+      [residues[m-1] for m in molecules])